@@ -1,12 +1,68 @@
 from django.contrib.admin import *
 from django.forms import ModelForm
+from django.utils.html import escape
 
 from models import *
 
+import jobs
+
+class SubtreeFilter(SimpleListFilter):
+    '''
+    Narrows the list to one subtree. Offers the top-level pages, and the
+    children of whichever subtree is selected, so that one can drill down.
+    '''
+    title = 'subtree'
+    parameter_name = 'subtree'
+
+    def lookups(self, request, model_admin):
+        pgs = ['/']
+        if self.value():
+            pgs.append(self.value())
+        pages = Page.objects.filter(parent__pg__in=pgs).order_by('pg')
+        return [(pg, pg) for pg in pages.values_list('pg', flat=True)]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(pg__startswith=self.value())
+        return queryset
+
+
+def queue(action, description):
+    def queue_action(modeladmin, request, queryset):
+        pgs = list(queryset.values_list('pg', flat=True))
+        jobs.enqueue(action, pgs)
+        modeladmin.message_user(request, 'Queued for {} pages: {}'.format(len(pgs), description.lower()))
+    queue_action.short_description = description
+    queue_action.__name__ = str(action)
+    return queue_action
+
+
 class PageAdmin(ModelAdmin):
-    # list_filter = []
-    list_display = ['pg', 'raw_title', 'update_date']
+    list_filter = [SubtreeFilter]
+    list_display = ['tree_title', 'pg', 'update_date']
+    list_per_page = 200
+    ordering = ['pg']
+    search_fields = ['pg', 'raw_title']
     # fields = []
     readonly_fields = ['parent', 'raw_title', 'subtitle', 'author']
-    
+
+    # run by jobs.work(), not within the request
+    actions = [
+        queue('rerender', 'Re-render'),
+        queue('rebuild_figures', 'Rebuild figures'),
+        queue('refresh_docinfo', 'Refresh docinfo'),
+        queue('export_pdf', 'Export PDF'),
+    ]
+
+    def queryset(self, request):
+        # the list only needs metadata, never the (possibly huge) content
+        return super(PageAdmin, self).queryset(request).defer('raw_content')
+
+    def tree_title(self, page):
+        depth = page.pg.count('/') - 1
+        return '&nbsp;' * 4 * depth + escape(page.title)
+    tree_title.allow_tags = True
+    tree_title.short_description = 'title'
+    tree_title.admin_order_field = 'pg'
+
 site.register(Page, PageAdmin)
@@ -0,0 +1,451 @@
+'''
+Benchmarks for the rendering pipeline, run against a synthetic wiki.
+
+Designed to be run from shell::
+
+    >>> from wiki import benchmarks
+    >>> benchmarks.run('bench-before.json')
+    ... (change something) ...
+    >>> benchmarks.run('bench-after.json')
+    >>> benchmarks.compare('bench-before.json', 'bench-after.json')
+
+determinism() checks that rendering the same wiki twice gives the same bytes,
+which ETags and the caches rely on.
+
+Everything happens in a throwaway test database, page folder and sysgen
+folder. Figure builds and PDF compiles are stubbed out, so results measure
+our own code rather than LaTeX, Ghostscript or matplotlib.
+'''
+
+from __future__ import division
+from __future__ import unicode_literals
+
+import datetime
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import get_cache
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import RequestFactory
+from django.test.utils import setup_test_environment
+from django.test.utils import teardown_test_environment
+
+from PIL import Image
+
+import config
+import models
+import utils
+import views
+from models import Page
+from templatetags.docutils_extensions import directives
+from templatetags.docutils_extensions import sections
+from templatetags.docutils_extensions import sysgen
+from templatetags.docutils_extensions import utils as rst_utils
+
+## -------------------------------------------------------------------------- ##
+
+# Corpus generator. All randomness comes from one seeded generator, so the
+# same parameters always give the same wiki.
+
+WORDS = '''
+    energy momentum vector field charge current voltage resistance force mass
+    acceleration velocity wave frequency photon electron proton neutron atom
+    nucleus orbit spin quantum entropy heat work power pressure volume density
+    the a of and to in is that for with as by on from at which this
+    '''.split()
+
+def sentence(rng, n=12):
+    words = [rng.choice(WORDS) for i in range(n)]
+    return ' '.join(words).capitalize() + '.'
+
+
+def paragraph(rng, roles=True):
+    text = []
+    for i in range(rng.randint(3, 7)):
+        text.append(sentence(rng))
+        if roles:
+            text.append(':sci:`{:.2f}E{}`'.format(rng.uniform(1, 10), rng.randint(-30, 30)))
+            text.append(':atm:`{}-{}`'.format(rng.choice(['U', 'C', 'He', 'Fe']), rng.randint(4, 240)))
+            text.append('A :jargon:`{}` appears.'.format(rng.choice(WORDS)))
+    return '\n'.join(text)
+
+
+def grid_table(rng, rows, cols, width=12):
+    line = '+' + '+'.join(['-' * width] * cols) + '+'
+    head = '+' + '+'.join(['=' * width] * cols) + '+'
+    def row(cells):
+        return '|' + '|'.join(' ' + c.ljust(width - 1) for c in cells) + '|'
+    text = [line, row(['Col {}'.format(j) for j in range(cols)]), head]
+    for i in range(rows):
+        text.append(row([':sci:`{}E{}`'.format(rng.randint(1, 9), rng.randint(-9, 9)) for j in range(cols)]))
+        text.append(line)
+    return text
+
+
+def indent(lines, prefix='    '):
+    return '\n'.join(prefix + line if line else line for line in lines)
+
+
+def tbl(rng, rows=12, cols=4):
+    return '.. tbl:: A big table\n    :cols: {}\n\n{}'.format(
+        'c' * cols, indent(grid_table(rng, rows, cols)))
+
+
+def problem_set(rng, n=50):
+    lines = []
+    for i in range(n):
+        lines.append('- question: "{} :sci:`{}E{}`"'.format(sentence(rng), rng.randint(1, 9), rng.randint(-9, 9)))
+        lines.append('  answer: "{} m/s"'.format(rng.randint(1, 100)))
+        lines.append('  solution: "{}"'.format(sentence(rng)))
+    return '.. problem-set:: Homework\n    :answers: toggle\n\n{}'.format(indent(lines))
+
+
+def tikz(rng):
+    return '.. fig:: A drawing\n\n{}'.format(indent([
+        '\\begin{tikzpicture}',
+        '\\draw (0,0) -- ({:.3f},{:.3f});'.format(rng.random(), rng.random()),
+        '\\end{tikzpicture}',
+    ]))
+
+
+def page_content(rng, title, sections=4, tables=1, problems=1, figures=1):
+    text = ['=' * len(title), title, '=' * len(title), '', ':Author: Benchmark', '']
+    text.append(paragraph(rng))
+    for i in range(sections):
+        heading = 'Section {}'.format(i + 1)
+        text += ['', heading, '-' * len(heading), '', paragraph(rng), '', paragraph(rng)]
+    for i in range(tables):
+        text += ['', tbl(rng)]
+    for i in range(problems):
+        text += ['', problem_set(rng)]
+    for i in range(figures):
+        text += ['', tikz(rng)]
+    return '\n'.join(text) + '\n'
+
+
+def generate_corpus(seed=0, depth=2, breadth=3, series=12, long_sections=40):
+    '''
+    Returns [(pg, raw_content), ...] for a wiki with a tree of the given
+    depth and breadth, one series, and one very long page.
+    '''
+    rng = random.Random(seed)
+    corpus = []
+
+    def branch(pg, level):
+        title = 'Page {}'.format(pg.strip('/').replace('/', ' ') or 'root')
+        corpus.append((pg, page_content(rng, title)))
+        if level < depth:
+            for i in range(breadth):
+                branch('{}p{}/'.format(pg, i), level + 1)
+
+    branch('/bench/', 0)
+    for i in range(1, series + 1):
+        pg = '/bench/lesson_{:03}/'.format(i)
+        corpus.append((pg, page_content(rng, 'Lesson {}'.format(i), sections=2)))
+    corpus.append(('/bench/long/', page_content(rng, 'A long page',
+        sections=long_sections, tables=3, problems=3, figures=10)))
+    return corpus
+
+## -------------------------------------------------------------------------- ##
+
+def stub_build_image(self, image_path, content, type, template):
+    d = os.path.dirname(image_path)
+    if not os.path.isdir(d):
+        os.makedirs(d)
+    if image_path.endswith('.png'):
+        Image.new('RGB', (400, 300), 'white').save(image_path, 'png')
+    return image_path
+
+
+class Sandbox(object):
+    '''
+    Points the wiki at a test database and temporary folders, and stubs out
+    the external toolchains, until closed.
+    '''
+
+    def __init__(self):
+        self.patches = []
+        self.path = tempfile.mkdtemp(prefix='wiki-bench-')
+        pages_path = os.path.join(self.path, 'wiki-pages')
+        os.makedirs(pages_path)
+        pdf_path = os.path.join(self.path, 'pdf')
+
+        def stub_make_pdf(latex, repeat=1, name=None, date=None):
+            if not os.path.isdir(pdf_path):
+                os.makedirs(pdf_path)
+            path = os.path.join(pdf_path, 'stub.pdf')
+            f = open(path, 'wb')
+            f.write(b'%PDF-1.4\n')
+            f.close()
+            return path
+
+        self.patch(config, 'wiki_pages_path', pages_path)
+        self.patch(models, 'wiki_pages_path', pages_path)
+        self.patch(utils, 'wiki_pages_path', pages_path)
+        self.patch(sysgen, 'SYSGEN_PATH', os.path.join(self.path, 'sysgen'))
+        self.patch(utils, 'SYSGEN_PATH', os.path.join(self.path, 'sysgen'))
+        cache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+        self.patch(models, 'cache', cache)
+        self.patch(views, 'cache', cache)
+        self.patch(sections, 'cache', cache)
+        self.patch(directives.fig_directive, 'build_image', stub_build_image)
+        self.patch(views, 'make_pdf', stub_make_pdf)
+
+        setup_test_environment()
+        self.old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+    def patch(self, obj, name, value):
+        self.patches.append((obj, name, getattr(obj, name)))
+        setattr(obj, name, value)
+
+    def close(self):
+        connection.creation.destroy_test_db(self.old_name, verbosity=0)
+        teardown_test_environment()
+        for obj, name, value in reversed(self.patches):
+            setattr(obj, name, value)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class quiet(object):
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def measure(fn, repeat=5):
+    times = []
+    for i in range(repeat):
+        with quiet():
+            start = time.time()
+            fn()
+            times.append(time.time() - start)
+    times.sort()
+    return {
+        'runs'   : repeat,
+        'min'    : times[0],
+        'median' : times[len(times) // 2],
+        'mean'   : sum(times) / len(times),
+    }
+
+## -------------------------------------------------------------------------- ##
+
+def benchmarks(corpus):
+    '''
+    Returns [(name, callable), ...] for a loaded corpus.
+    '''
+    long_page = Page.objects.get(pg='/bench/long/')
+    sample = [Page.objects.get(pg=pg) for pg, content in corpus[::5]]
+    factory = RequestFactory()
+    edits = itertools.count()
+
+    def view(fn, pg, name='wiki_show'):
+        request = factory.get(reverse(name, args=[pg]))
+        request.user = AnonymousUser()
+        return fn(request, pg)
+
+    return [
+        ('rst2html:long', lambda: rst_utils.rst2html(long_page.content)),
+        ('rst2latex:long', lambda: rst_utils.rst2latex(long_page.content)),
+        ('rst2xml:long', lambda: rst_utils.rst2xml(long_page.raw_content)),
+        ('rst2html_sections:long', lambda: sections.rst2html_sections(long_page.content)),
+        ('rst2html_sections:edit', lambda: sections.rst2html_sections(long_page.content.replace(
+            '\n---------\n', '\n---------\n\nEdit number {}.\n'.format(next(edits)), 1))),
+        ('rst2html:sample', lambda: [rst_utils.rst2html(p.content) for p in sample]),
+        ('Page.content:all', lambda: [p.content for p in Page.objects.all()]),
+        ('views.show:long', lambda: view(views.show, long_page.pg)),
+        ('views.show:sample', lambda: [view(views.show, p.pg) for p in sample]),
+        ('views.ppdf:long', lambda: view(views.ppdf, long_page.pg, 'wiki_ppdf')),
+        ('utils.rebuild', lambda: utils.rebuild(interactive=False)),
+    ]
+
+
+# Importing the app must not load the rendering stack (see register() in
+# docutils_extensions.utils), and should stay within this many seconds
+STARTUP_BUDGET = 0.25
+STARTUP_MODULES = ['models', 'admin', 'urls', 'views', 'templatetags.restructuredtext_tags']
+HEAVY_MODULES = ['docutils', 'yaml', 'PIL']
+
+STARTUP_SCRIPT = """
+import json, sys, time
+from django.conf import settings
+settings.INSTALLED_APPS
+import django.db.models
+start = time.time()
+for name in %r:
+    __import__(name)
+print(json.dumps({
+    'seconds': time.time() - start,
+    'heavy': [name for name in %r if name in sys.modules],
+}))
+"""
+
+def startup(repeat=5):
+    '''
+    Designed to be run from shell.
+    Times importing the app in fresh interpreters. Prints a warning if it
+    is over STARTUP_BUDGET, or if it loads any of HEAVY_MODULES.
+    '''
+    package = __name__.rsplit('.', 1)[0]
+    modules = ['{}.{}'.format(package, name) for name in STARTUP_MODULES]
+    script = STARTUP_SCRIPT % (modules, HEAVY_MODULES)
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([cwd] + sys.path))
+
+    times = []
+    for i in range(repeat):
+        p = subprocess.Popen([sys.executable, '-c', script], cwd=cwd, env=env, stdout=subprocess.PIPE)
+        out, err = p.communicate()
+        report = json.loads(out.strip().splitlines()[-1])
+        times.append(report['seconds'])
+    times.sort()
+
+    result = {
+        'runs'   : repeat,
+        'min'    : times[0],
+        'median' : times[len(times) // 2],
+        'mean'   : sum(times) / len(times),
+        'heavy'  : report['heavy'],
+        'budget' : STARTUP_BUDGET,
+    }
+    if result['median'] > STARTUP_BUDGET:
+        print('* WARNING: startup took {:.3f}s (budget {}s)'.format(result['median'], STARTUP_BUDGET))
+    if result['heavy']:
+        print('* WARNING: startup loaded {}'.format(', '.join(result['heavy'])))
+    return result
+
+
+def git_commit():
+    try:
+        cmd = ['git', 'rev-parse', 'HEAD']
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        p = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        return out.strip().decode('utf-8')
+    except OSError:
+        return ''
+
+
+def run(outfile=None, repeat=5, only=None, **corpus_options):
+    '''
+    Designed to be run from shell.
+    Times the rendering pipeline on a synthetic corpus and returns the
+    results, also writing them to ``outfile`` as JSON if given. ``only`` is
+    an optional list of benchmark names.
+    '''
+    results = {}
+    if not only or 'startup' in only:
+        results['startup'] = startup(repeat)
+        print('{:<24} {:>10.4f}s (median of {})'.format('startup', results['startup']['median'], repeat))
+
+    sandbox = Sandbox()
+    try:
+        corpus = generate_corpus(**corpus_options)
+        with quiet():
+            for pg, raw_content in corpus:
+                page = Page(pg=pg)
+                page.raw_content = raw_content
+                page.save()
+
+        for name, fn in benchmarks(corpus):
+            if only and name not in only:
+                continue
+            results[name] = measure(fn, repeat)
+            print('{:<24} {:>10.4f}s (median of {})'.format(name, results[name]['median'], repeat))
+    finally:
+        sandbox.close()
+
+    report = {
+        'commit'  : git_commit(),
+        'date'    : datetime.datetime.now().isoformat(),
+        'python'  : platform.python_version(),
+        'corpus'  : dict(corpus_options, pages=len(corpus)),
+        'results' : results,
+    }
+    if outfile:
+        f = open(outfile, 'w')
+        f.write(json.dumps(report, indent=2, sort_keys=True))
+        f.close()
+    return report
+
+
+def determinism(**corpus_options):
+    '''
+    Designed to be run from shell.
+    Renders every page of a synthetic corpus twice, from cold caches, and
+    checks that each rendering (HTML, LaTeX, the page PDF's LaTeX and the
+    page view) comes out byte-identical. Returns the ones that don't.
+    '''
+    from django.template import Context, loader
+    from templatetags.docutils_extensions import mathml
+
+    sandbox = Sandbox()
+    try:
+        corpus = generate_corpus(**corpus_options)
+        with quiet():
+            for pg, raw_content in corpus:
+                page = Page(pg=pg)
+                page.raw_content = raw_content
+                page.save()
+
+        factory = RequestFactory()
+        template = loader.get_template('wiki/ppdf.tex')
+
+        def render():
+            views.cache.clear()
+            mathml.memo.clear()
+            renders = {}
+            with quiet():
+                for page in Page.objects.all():
+                    request = factory.get(reverse('wiki_show', args=[page.pg]))
+                    request.user = AnonymousUser()
+                    renders[page.pg, 'rst2html'] = rst_utils.rst2html(page.content).encode('utf-8')
+                    renders[page.pg, 'rst2latex'] = rst_utils.rst2latex(page.content).encode('utf-8')
+                    renders[page.pg, 'ppdf.tex'] = template.render(Context({'page': page}, autoescape=False)).encode('utf-8')
+                    renders[page.pg, 'views.show'] = views.show(request, page.pg).content
+            return renders
+
+        first = render()
+        second = render()
+    finally:
+        sandbox.close()
+
+    differ = sorted(key for key in first if first[key] != second.get(key))
+    for pg, name in differ:
+        print('* DIFFERS: {} {}'.format(name, pg))
+    print('{} of {} renderings identical'.format(len(first) - len(differ), len(first)))
+    return differ
+
+
+def compare(before, after):
+    '''
+    Designed to be run from shell.
+    Prints the change in median time between two saved runs.
+    '''
+    reports = []
+    for path in [before, after]:
+        f = open(path)
+        reports.append(json.load(f))
+        f.close()
+    before, after = reports
+
+    print('{:<24} {:>10} {:>10} {:>8}'.format('', before['commit'][:8], after['commit'][:8], 'ratio'))
+    for name in sorted(set(before['results']) | set(after['results'])):
+        a = before['results'].get(name, {}).get('median')
+        b = after['results'].get(name, {}).get('median')
+        if a and b:
+            print('{:<24} {:>10.4f} {:>10.4f} {:>8.2f}'.format(name, a, b, b / a))
+        else:
+            print('{:<24} {:>10} {:>10}'.format(name, a or '-', b or '-'))
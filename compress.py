@@ -0,0 +1,120 @@
+'''
+Precompressed page views. A rendered page is compressed once, in every
+encoding we offer (gzip, and Brotli if the brotli package is installed),
+and those bytes are what gets cached and served; nothing is compressed per
+request. A client accepting neither gets the gzip bytes decompressed.
+'''
+
+from __future__ import division
+from __future__ import unicode_literals
+
+import gzip
+import re
+import zlib
+from cStringIO import StringIO
+
+from config import wiki_compact_html
+
+## -------------------------------------------------------------------------- ##
+
+# Whitespace is significant within these, so compact() leaves them alone
+PRESERVE = re.compile(r'(<(pre|textarea|script|style)\b.*?</\2\s*>)', re.DOTALL | re.IGNORECASE)
+BETWEEN_TAGS = re.compile(r'>\s+<')
+WHITESPACE = re.compile(r'[ \t\r\n]{2,}')
+
+
+def compact(html):
+    '''
+    Collapses runs of whitespace in (unicode) HTML, except within pre,
+    textarea, script and style elements. Whitespace between two tags
+    becomes one newline, as it may still separate inline elements.
+    '''
+    parts = PRESERVE.split(html)
+    result = []
+    for i in range(0, len(parts), 3):
+        text = BETWEEN_TAGS.sub('>\n<', parts[i])
+        result.append(WHITESPACE.sub(' ', text))
+        if i + 1 < len(parts):
+            result.append(parts[i + 1])
+    return ''.join(result)
+
+## -------------------------------------------------------------------------- ##
+
+def brotli_supported():
+    try:
+        import brotli
+    except ImportError:
+        return False
+    return True
+
+
+def gzip_bytes(data):
+    f = StringIO()
+    g = gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=f, mtime=0)
+    g.write(data)
+    g.close()
+    return f.getvalue()
+
+
+def brotli_bytes(data):
+    import brotli
+
+    return brotli.compress(data, mode=brotli.MODE_TEXT, quality=11)
+
+
+def encodings():
+    if brotli_supported():
+        return ['br', 'gzip']
+    return ['gzip']
+
+
+def encode(html):
+    '''
+    Returns {encoding: bytes} for the (unicode) HTML of a page.
+    '''
+    if wiki_compact_html:
+        html = compact(html)
+    data = html.encode('utf-8')
+
+    encoded = {'gzip': gzip_bytes(data)}
+    if 'br' in encodings():
+        encoded['br'] = brotli_bytes(data)
+    return encoded
+
+
+def decode(encoded, encoding):
+    if encoding == 'identity':
+        return zlib.decompress(encoded['gzip'], 16 + zlib.MAX_WBITS)
+    return encoded[encoding]
+
+
+def negotiate(accept_encoding, available):
+    '''
+    Returns the best of the available encodings that the Accept-Encoding
+    header allows: Brotli, then gzip, then identity.
+    '''
+    q = {}
+    for item in accept_encoding.split(','):
+        params = item.strip().split(';')
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        weight = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        q[coding] = weight
+    if 'x-gzip' in q and 'gzip' not in q:
+        q['gzip'] = q['x-gzip']
+
+    best = 'identity'
+    best_q = 0.0
+    for coding in ['br', 'gzip']:
+        weight = q.get(coding, q.get('*', 0.0))
+        if coding in available and weight > best_q:
+            best, best_q = coding, weight
+    return best
@@ -7,8 +7,60 @@ from django.conf import settings
 wiki_pages_path = os.path.join('..', '_', 'wiki-pages')
 wiki_pages_path = os.path.join(os.path.dirname(os.path.abspath( __file__ )), wiki_pages_path)
 
-if not os.path.exists(wiki_pages_path):
-    os.makedirs(wiki_pages_path)
+def make_wiki_pages_path():
+    if not os.path.exists(wiki_pages_path):
+        os.makedirs(wiki_pages_path)
 
 wiki_image_path = os.path.join(settings.MEDIA_ROOT, 'wiki')
 
+# Cache lifetime (in seconds) of page views for anonymous readers; they are
+# always revalidated against the page's ETag/Last-Modified once it runs out
+wiki_cache_max_age = getattr(settings, 'WIKI_CACHE_MAX_AGE', 0)
+
+# How long (in seconds) tree versions are kept in the cache
+wiki_tree_version_timeout = getattr(settings, 'WIKI_TREE_VERSION_TIMEOUT', 30 * 24 * 60 * 60)
+
+# How long (in seconds) compressed page views are cached (see compress.py),
+# and whether their HTML is first compacted by collapsing whitespace
+wiki_response_cache_timeout = getattr(settings, 'WIKI_RESPONSE_CACHE_TIMEOUT', 7 * 24 * 60 * 60)
+wiki_compact_html = getattr(settings, 'WIKI_COMPACT_HTML', False)
+
+# Time every request (Server-Timing header) rather than only staff requests
+# with ?profile in the URL; needs wiki.middleware.ProfilingMiddleware
+wiki_profiling = getattr(settings, 'WIKI_PROFILING', False)
+
+# Spool folder for background jobs queued from the admin (see jobs.py)
+wiki_jobs_path = getattr(settings, 'WIKI_JOBS_PATH',
+    os.path.join(os.path.dirname(wiki_pages_path), 'wiki-jobs'))
+
+# Folder for the revision history of pages (see revisions.py)
+wiki_revisions_path = getattr(settings, 'WIKI_REVISIONS_PATH',
+    os.path.join(os.path.dirname(wiki_pages_path), 'wiki-revisions'))
+
+# Folder for the editor's autosaved drafts (see drafts.py)
+wiki_drafts_path = getattr(settings, 'WIKI_DRAFTS_PATH',
+    os.path.join(os.path.dirname(wiki_pages_path), 'wiki-drafts'))
+
+# Time (in seconds) the editor's live preview may spend rendering per request;
+# sections left over are rendered on the editor's next request
+wiki_preview_budget = getattr(settings, 'WIKI_PREVIEW_BUDGET', 0.5)
+
+# Remote mirror of the wiki's pages and images (see sync.py): a folder such
+# as 'file:///mnt/backup/wiki', or 'dropbox:///wiki' (with the access token
+# in DROPBOX_ACCESS_TOKEN, see dropbox.py). The sync state is kept in
+# WIKI_SYNC_STATE_PATH; files go WIKI_SYNC_WORKERS at a time, in chunks of
+# WIKI_SYNC_CHUNK_SIZE bytes. Image folders in WIKI_SYNC_SKIP aren't synced
+# (system-generated files can always be built again).
+wiki_sync_remote = getattr(settings, 'WIKI_SYNC_REMOTE', '')
+wiki_sync_state_path = getattr(settings, 'WIKI_SYNC_STATE_PATH',
+    os.path.join(os.path.dirname(wiki_pages_path), 'wiki-sync.sqlite'))
+wiki_sync_workers = getattr(settings, 'WIKI_SYNC_WORKERS', 4)
+wiki_sync_chunk_size = getattr(settings, 'WIKI_SYNC_CHUNK_SIZE', 4 * 1024 * 1024)
+wiki_sync_skip = getattr(settings, 'WIKI_SYNC_SKIP', ['sysgen'])
+
+# Page views are counted in the cache for WIKI_HITS_TIMEOUT seconds from a
+# page's first view, so that utils.warm() can warm the busiest pages first;
+# warm() keeps its progress in WIKI_WARM_STATE_PATH so it can resume
+wiki_hits_timeout = getattr(settings, 'WIKI_HITS_TIMEOUT', 7 * 24 * 60 * 60)
+wiki_warm_state_path = getattr(settings, 'WIKI_WARM_STATE_PATH',
+    os.path.join(os.path.dirname(wiki_pages_path), 'wiki-warm.json'))
@@ -0,0 +1,163 @@
+'''
+Drafts kept by the editor's autosave, one per user and page, apart from the
+published page until it is submitted.
+
+The editor sends the whole buffer first and patches after that: each
+replaces the range [start, end) of the draft with some text, and names the
+revision of the draft it was made against. A patch against any other
+revision is refused (the editor then sends the whole buffer instead).
+Offsets count UTF-16 code units, as JavaScript strings do, and lines end
+with a bare newline, as they do in the editor's buffer.
+
+A draft also remembers the revision of the published page it started from,
+so that submitting it over somebody else's newer version is refused too.
+'''
+
+from __future__ import division
+from __future__ import unicode_literals
+
+import codecs
+import difflib
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+
+from config import wiki_drafts_path
+
+import revisions
+
+## -------------------------------------------------------------------------- ##
+
+class Conflict(Exception):
+    pass
+
+
+def revision(content):
+    return hashlib.md5(content.encode('utf-8')).hexdigest()
+
+
+def draft_path(user, pg):
+    name = '{}-{}.json'.format(user.pk, hashlib.md5(pg.encode('utf-8')).hexdigest())
+    return os.path.join(wiki_drafts_path, name)
+
+
+def load(user, pg):
+    '''
+    Returns the user's draft of the page, or None.
+    '''
+    try:
+        f = codecs.open(draft_path(user, pg), 'r', 'utf-8')
+    except IOError:
+        return None
+    draft = json.loads(f.read())
+    f.close()
+    return draft
+
+
+def store(user, pg, draft):
+    if not os.path.isdir(wiki_drafts_path):
+        os.makedirs(wiki_drafts_path)
+    path = draft_path(user, pg)
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    f = codecs.open(temp_path, 'w', 'utf-8')
+    f.write(json.dumps(draft))
+    f.close()
+    os.rename(temp_path, path)
+
+
+def saved_date(draft):
+    return datetime.fromtimestamp(draft['saved'])
+
+
+def discard(user, pg):
+    try:
+        os.remove(draft_path(user, pg))
+    except OSError:
+        pass
+
+## -------------------------------------------------------------------------- ##
+
+def patch(content, start, end, text):
+    '''
+    Returns content with [start, end) (in UTF-16 code units) replaced by text.
+    '''
+    data = content.encode('utf-16-le')
+    if not 0 <= start <= end <= len(data) // 2:
+        raise Conflict('Patch out of range')
+    data = data[:2 * start] + text.encode('utf-16-le') + data[2 * end:]
+    return data.decode('utf-16-le')
+
+
+def autosave(user, pg, published, base, start=None, end=None, text=None, content=None):
+    '''
+    Saves the user's draft of the page and returns it. Either the whole
+    ``content`` is given, or a patch (``start``, ``end``, ``text``) made
+    against revision ``base`` of the draft (or, if there is none yet, of
+    the published page). Raises Conflict if the patch can't be applied.
+    '''
+    draft = load(user, pg)
+    if content is None:
+        if draft:
+            current = draft['content']
+        else:
+            from models import Page
+            try:
+                current = Page.objects.get(pg=pg).raw_content.replace('\r\n', '\n')
+            except Page.DoesNotExist:
+                current = ''
+        if revision(current) != base:
+            raise Conflict('Draft has changed')
+        content = patch(current, start, end, text)
+    content = content.replace('\r\n', '\n')
+
+    if draft is None or draft['published'] != published:
+        draft = {'published': published}
+    draft['content'] = content
+    draft['revision'] = revision(content)
+    draft['saved'] = time.time()
+    store(user, pg, draft)
+    return draft
+
+
+def rebase(user, pg, published):
+    '''
+    Makes the user's draft of the page start from revision ``published``
+    of it, once they have been shown that version: submitting the draft
+    then replaces it.
+    '''
+    draft = load(user, pg)
+    if draft:
+        draft['published'] = published
+        store(user, pg, draft)
+
+
+def changes(pg, draft, published):
+    '''
+    Returns what was published over the revision of the page the draft
+    started from: the diff from that revision to ``published`` (the page's
+    content now), or ``published`` itself if the history doesn't have it.
+    '''
+    n = revisions.find(pg, draft['published'])
+    if n is None:
+        return published
+    return '\n'.join(difflib.unified_diff(
+        revisions.get(pg, n).splitlines(), published.splitlines(),
+        '{}@{}'.format(pg, n), pg, lineterm=''))
+
+
+def prune(max_age=30 * 24 * 60 * 60):
+    '''
+    Designed to be run from shell.
+    Removes drafts that haven't been saved for ``max_age`` seconds.
+    '''
+    if not os.path.isdir(wiki_drafts_path):
+        return []
+    removed = []
+    for name in os.listdir(wiki_drafts_path):
+        path = os.path.join(wiki_drafts_path, name)
+        if time.time() - os.path.getmtime(path) > max_age:
+            os.remove(path)
+            removed.append(path)
+    return removed
@@ -1,47 +1,53 @@
+'''
+Mirrors the wiki to Dropbox (see sync.py). Designed to be run from shell::
+
+    >>> from wiki import dropbox
+    >>> dropbox.link()   # once, then put the token in DROPBOX_ACCESS_TOKEN
+    >>> dropbox.mirror()
+'''
+
 from __future__ import division
+from __future__ import absolute_import
 from __future__ import unicode_literals
 
-# https://www.dropbox.com/developers/core/start/python
-
-import dropbox
+# https://www.dropbox.com/developers/documentation/python
 
 from django.conf import settings
 
-app_key = settings.DROPBOX_APP_KEY
-app_secret = settings.DROPBOX_APP_SECRET
-
-flow = dropbox.client.DropboxOAuth2FlowNoRedirect(app_key, app_secret)
-
-authorize_url = flow.start()
+from . import sync
 
-# Have the user sign in and authorize this token
-authorize_url = flow.start()
-print '1. Go to: ' + authorize_url
-print '2. Click "Allow" (you might have to log in first)'
-print '3. Copy the authorization code.'
-code = raw_input("Enter the authorization code here: ").strip()
+DEFAULT_FOLDER = '/wiki'
 
-# This will fail if the user enters an invalid authorization code
-access_token, user_id = flow.finish(code)
 
-client = dropbox.client.DropboxClient(access_token)
-print 'linked account: ', client.account_info()
+def link():
+    '''
+    Designed to be run from shell.
+    Walks through linking a Dropbox account to the app and returns the
+    access token.
+    '''
+    import dropbox
 
-## Uploading files
+    flow = dropbox.DropboxOAuth2FlowNoRedirect(settings.DROPBOX_APP_KEY, settings.DROPBOX_APP_SECRET)
+    authorize_url = flow.start()
 
-f = open('working-draft.txt', 'rb')
-response = client.put_file('/magnum-opus.txt', f)
-print "uploaded:", response
+    # Have the user sign in and authorize this token
+    print('1. Go to: ' + authorize_url)
+    print('2. Click "Allow" (you might have to log in first)')
+    print('3. Copy the authorization code.')
+    code = raw_input('Enter the authorization code here: ').strip()
 
-## Listing folders
+    # This will fail if the user enters an invalid authorization code
+    result = flow.finish(code)
 
-folder_metadata = client.metadata('/')
-print "metadata:", folder_metadata
+    client = dropbox.Dropbox(result.access_token)
+    print('linked account: ' + client.users_get_current_account().email)
+    return result.access_token
 
-## Downloading files
 
-f, metadata = client.get_file_and_metadata('/magnum-opus.txt')
-out = open('magnum-opus.txt', 'wb')
-out.write(f.read())
-out.close()
-print metadata
\ No newline at end of file
+def mirror(folder=DEFAULT_FOLDER, direction='both', dry_run=False):
+    '''
+    Designed to be run from shell.
+    Syncs the wiki with a Dropbox folder, using DROPBOX_ACCESS_TOKEN.
+    '''
+    remote = sync.DropboxRemote(folder, settings.DROPBOX_ACCESS_TOKEN)
+    return sync.sync(remote, direction=direction, dry_run=dry_run)
@@ -0,0 +1,174 @@
+'''
+Background jobs, queued from the admin and run by a worker.
+
+Jobs are JSON files in a spool folder (WIKI_JOBS_PATH) moving through
+
+    pending/ --> running/ --> done/ (or failed/)
+
+A worker claims a job by renaming it into running/, so any number of them
+can share one spool. Designed to be run from shell::
+
+    >>> from wiki import jobs
+    >>> jobs.work()
+'''
+
+from __future__ import division
+from __future__ import unicode_literals
+
+import codecs
+import json
+import os
+import time
+import traceback
+import uuid
+
+from config import wiki_jobs_path
+from models import Page
+from templatetags.docutils_extensions import governor
+
+## -------------------------------------------------------------------------- ##
+
+def rerender(page):
+    '''
+    Re-reads the page and renders it through ``show`` as an anonymous
+    reader would, so that its sections and response are cached afresh.
+    '''
+    from django.contrib.auth.models import AnonymousUser
+    from django.core.urlresolvers import reverse
+    from django.test.client import RequestFactory
+
+    import views
+
+    page.update(force_update=True)
+    request = RequestFactory().get(reverse('wiki_show', args=[page.pg]))
+    request.user = AnonymousUser()
+    request.wiki_internal = True # not a reader's view
+    views.show(request, page.pg)
+
+
+def rebuild_figures(page):
+    from templatetags.docutils_extensions import sysgen
+    from templatetags.docutils_extensions.utils import rst2html
+    from templatetags.docutils_extensions.utils import sysgen_refs
+
+    for name in sysgen_refs(page.content):
+        sysgen.remove(name)
+    rst2html(page.content)
+
+
+def refresh_docinfo(page):
+    page.save(pull_docinfo=True)
+
+
+def export_pdf(page):
+    from views import page_pdf
+
+    if not os.path.exists(page_pdf(page)):
+        raise IOError('No PDF')
+
+
+ACTIONS = {
+    'rerender'          : rerender,
+    'rebuild_figures'   : rebuild_figures,
+    'refresh_docinfo'   : refresh_docinfo,
+    'export_pdf'        : export_pdf,
+}
+
+## -------------------------------------------------------------------------- ##
+
+def spool(state):
+    d = os.path.join(wiki_jobs_path, state)
+    if not os.path.isdir(d):
+        os.makedirs(d)
+    return d
+
+
+def write_job(path, job):
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    f = codecs.open(temp_path, 'w', 'utf-8')
+    f.write(json.dumps(job, indent=2))
+    f.close()
+    os.rename(temp_path, path)
+
+
+def enqueue(action, pgs):
+    '''
+    Queues ``action`` for each of the given pages; returns the job's name.
+    '''
+    if action not in ACTIONS:
+        raise ValueError('Unknown action: {}'.format(action))
+    name = '{:.6f}-{}.json'.format(time.time(), uuid.uuid4().hex[:8])
+    job = {
+        'action'    : action,
+        'pgs'       : list(pgs),
+        'queued'    : time.time(),
+    }
+    write_job(os.path.join(spool('pending'), name), job)
+    return name
+
+
+def claim():
+    '''
+    Returns (name, job) for the oldest pending job, now moved to running/,
+    or None if there are none.
+    '''
+    pending = spool('pending')
+    running = spool('running')
+    for name in sorted(os.listdir(pending)):
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(running, name)
+        try:
+            os.rename(os.path.join(pending, name), path)
+        except OSError: # another worker got there first
+            continue
+        f = codecs.open(path, 'r', 'utf-8')
+        job = json.loads(f.read())
+        f.close()
+        return name, job
+    return None
+
+
+def run_job(name, job):
+    action = ACTIONS[job['action']]
+    job['started'] = time.time()
+    job['errors'] = {}
+    for pg in job['pgs']:
+        print('{}: {}'.format(job['action'], pg))
+        try:
+            with governor.patient(): # no hurry, wait for slots
+                action(Page.objects.get(pg=pg))
+        except Exception:
+            job['errors'][pg] = traceback.format_exc()
+    job['finished'] = time.time()
+
+    state = 'failed' if job['errors'] else 'done'
+    write_job(os.path.join(spool(state), name), job)
+    os.remove(os.path.join(spool('running'), name))
+    return job
+
+
+def work(poll=1.0, once=False):
+    '''
+    Designed to be run from shell.
+    Runs queued jobs, oldest first, polling for new ones every ``poll``
+    seconds. With ``once``, returns when the queue is empty.
+    '''
+    while True:
+        claimed = claim()
+        if claimed:
+            job = run_job(*claimed)
+            print('{} {} pages, {} errors'.format(job['action'], len(job['pgs']), len(job['errors'])))
+        elif once:
+            return
+        else:
+            time.sleep(poll)
+
+
+def status():
+    '''
+    Designed to be run from shell.
+    Returns the number of jobs in each state.
+    '''
+    return dict((state, len(os.listdir(spool(state))))
+                for state in ['pending', 'running', 'done', 'failed'])
@@ -0,0 +1,91 @@
+from __future__ import division
+from __future__ import unicode_literals
+
+import time
+
+from django.db import connection
+from django.template import Context, loader
+
+from config import wiki_profiling
+from templatetags.docutils_extensions import profiling
+
+## -------------------------------------------------------------------------- ##
+
+class ProfilingMiddleware(object):
+    '''
+    Times the rendering pipeline (docutils phases, directives, roles,
+    subprocesses, templates and DB queries) and reports it in a
+    Server-Timing header. Staff adding ?profile to a URL also get a panel
+    at the bottom of the page.
+
+    Goes after AuthenticationMiddleware in MIDDLEWARE_CLASSES. Only staff
+    requests with ?profile are timed unless WIKI_PROFILING is set.
+    '''
+
+    def panel_requested(self, request):
+        user = getattr(request, 'user', None)
+        return 'profile' in request.GET and user is not None and user.is_staff
+
+    def process_request(self, request):
+        request.wiki_profile_panel = self.panel_requested(request)
+        if not (wiki_profiling or request.wiki_profile_panel):
+            return None
+
+        profiling.start()
+        request.wiki_profile = {
+            'start'             : time.time(),
+            'queries'           : len(connection.queries),
+            'use_debug_cursor'  : connection.use_debug_cursor,
+        }
+        connection.use_debug_cursor = True
+        return None
+
+    def process_response(self, request, response):
+        profile = getattr(request, 'wiki_profile', None)
+        if profile is None:
+            return response
+
+        total = time.time() - profile['start']
+        timings = profiling.stop()
+        queries = connection.queries[profile['queries']:]
+        connection.use_debug_cursor = profile['use_debug_cursor']
+        del request.wiki_profile
+
+        timings['db'] = [len(queries), sum(float(q['time']) for q in queries)]
+        timings['total'] = [1, total]
+        timings = sorted(timings.items(), key=lambda item: -item[1][1])
+
+        response['Server-Timing'] = ', '.join(
+            '{};dur={:.1f};desc="{} calls"'.format(name, seconds * 1000, calls)
+            for name, (calls, seconds) in timings
+        )
+
+        if request.wiki_profile_panel and response.status_code == 200 \
+                and response.get('Content-Type', '').startswith('text/html') \
+                and not response.has_header('Content-Encoding'):
+            self.add_panel(response, timings, queries, total)
+
+        return response
+
+    def add_panel(self, response, timings, queries, total):
+        rows = []
+        for name, (calls, seconds) in timings:
+            rows.append({
+                'name'      : name,
+                'calls'     : calls,
+                'ms'        : seconds * 1000,
+                'percent'   : 100 * seconds / total if total else 0,
+            })
+        queries = sorted(queries, key=lambda q: -float(q['time']))
+
+        t = loader.get_template('wiki/profile.html')
+        panel = t.render(Context({'rows': rows, 'queries': queries[:20]}))
+
+        content = response.content.decode('utf-8')
+        index = content.rfind('</body>')
+        if index == -1:
+            return
+        content = content[:index] + panel + content[index:]
+        response.content = content.encode('utf-8')
+        if response.has_header('Content-Length'):
+            response['Content-Length'] = str(len(response.content))
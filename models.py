@@ -2,17 +2,54 @@ from __future__ import division
 from __future__ import unicode_literals
 
 from django.db.models import *
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 
 import codecs
+import hashlib
 import os
 import re
+import time
 
+from config import make_wiki_pages_path
 from config import wiki_pages_path
 from config import wiki_image_path
+from config import wiki_tree_version_timeout
 
+import revisions
+
+from templatetags.docutils_extensions import governor
 from templatetags.docutils_extensions.utils import rst2xml
+from templatetags.docutils_extensions.utils import sysgen_refs
+from templatetags.docutils_extensions.sysgen import forget_refs
+from templatetags.docutils_extensions.sysgen import record_refs
+
+## -------------------------------------------------------------------------- ##
+
+# Each page's navigation shows its children, its siblings (or series) and its
+# parent. A "tree version" is a timestamp kept in the cache for the list of
+# pages directly below a given pg; it changes whenever a page in that list is
+# created, renamed, retitled or deleted.
+
+def tree_version_key(pg):
+    return 'wiki-tree:{}'.format(hashlib.md5(pg.encode('utf-8')).hexdigest())
+
+
+def tree_versions(pgs):
+    keys = [tree_version_key(pg) for pg in pgs]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions: # unknown, so start afresh
+            cache.add(key, time.time(), wiki_tree_version_timeout)
+            versions[key] = cache.get(key) or time.time()
+    return [versions[key] for key in keys]
+
+
+def bump_tree_version(pg):
+    cache.set(tree_version_key(pg), time.time(), wiki_tree_version_timeout)
 
 ## -------------------------------------------------------------------------- ##
 
@@ -27,6 +64,14 @@ class Page(Model):
     
     create_date = DateTimeField(auto_now_add=True)
     update_date = DateTimeField(auto_now=True)
+
+    def __init__(self, *args, **kwargs):
+        super(Page, self).__init__(*args, **kwargs)
+        self._tree_state = self.tree_state
+
+    @property
+    def tree_state(self):
+        return (self.pk, self.pg, self.raw_title, self.parent_id)
     
     @property
     def fp(self):
@@ -112,6 +157,10 @@ class Page(Model):
     def children(self):
         return Page.objects.filter(parent=self)
         
+    @property
+    def descendants(self):
+        return Page.objects.filter(pg__startswith=self.pg).exclude(pk=self.pk)
+
     @property
     def siblings(self):
         return Page.objects.filter(parent=self.parent).exclude(pk=self.pk)
@@ -128,8 +177,19 @@ class Page(Model):
                         series.append(s)
         series = sorted(series, key=lambda page: page.pg)
         return series
+
+    @property
+    def nav_version(self):
+        # children, then siblings/series, then the parent's title
+        pgs = [self.pg]
+        if self.parent:
+            pgs.append(self.parent.pg)
+            if self.parent.parent:
+                pgs.append(self.parent.parent.pg)
+        return tree_versions(pgs)
         
     def update(self, force_update=False, pull_docinfo=True): # check file system for updated version
+        should_save = force_update or self.pk is None
         if os.path.isfile(self.fp):
             should_update = True
             if self.update_date:
@@ -142,9 +202,11 @@ class Page(Model):
                 raw_content = f.read()
                 f.close
                 self.raw_content = raw_content
-        self.save(pull_docinfo=pull_docinfo)
+                should_save = True
+        if should_save:
+            self.save(pull_docinfo=pull_docinfo)
         
-    def save(self, pull_docinfo=True, args=[], kwargs={}):
+    def save(self, pull_docinfo=True, editor='', args=[], kwargs={}):
         if pull_docinfo:
             try:
                 root = rst2xml(self.raw_content)
@@ -166,6 +228,7 @@ class Page(Model):
             
         # save a copy to the file system
 
+        make_wiki_pages_path()
         fp = self.fp
         if not os.path.isfile(fp): # then will have to do something unusual
             if os.path.isdir(fp): # then save the content in a special file
@@ -190,8 +253,53 @@ class Page(Model):
 
         super(Page, self).save(*args, **kwargs)
 
+        # keep the history (renamed pages take theirs along)
+        old_pg = self._tree_state[1]
+        if self._tree_state[0] is not None and old_pg != self.pg:
+            revisions.move(old_pg, self.pg)
+        if self.raw_content or revisions.count(self.pg):
+            revisions.record(self.pg, self.raw_content, editor)
+
+        # remember which figures we use so that sysgen GC leaves them alone,
+        # and build those missing, so that readers needn't wait for them
+        try:
+            with governor.patient():
+                record_refs(self.pg, sysgen_refs(self.content, build=True))
+        except:
+            pass
+
+    def bump_tree_versions(self):
+        old_pg = self._tree_state[1]
+        old_parent_id = self._tree_state[3]
+        pgs = set([self.pg, old_pg])
+        for id in set([old_parent_id, self.parent_id]):
+            if id is not None:
+                pgs.update(Page.objects.filter(pk=id).values_list('pg', flat=True))
+        for pg in pgs:
+            if pg:
+                bump_tree_version(pg)
+
     def __unicode__(self):
         return self.pg    
 
     class Meta:
         ordering = ['pg']
+
+## -------------------------------------------------------------------------- ##
+
+# These run on signals rather than in Page.save/delete, so that queryset
+# deletes and cascades (a page's children go with it) are seen too.
+
+def page_saved(sender, instance, **kwargs):
+    if instance.tree_state != instance._tree_state:
+        instance.bump_tree_versions()
+        instance._tree_state = instance.tree_state
+
+
+def page_deleted(sender, instance, **kwargs):
+    forget_refs(instance.pg)
+    instance.bump_tree_versions()
+
+
+post_save.connect(page_saved, sender=Page, dispatch_uid='wiki-page-saved')
+post_delete.connect(page_deleted, sender=Page, dispatch_uid='wiki-page-deleted')
@@ -0,0 +1,387 @@
+'''
+Revision history of pages, kept in WIKI_REVISIONS_PATH.
+
+Each page has a pack (the revisions, one zlib-compressed record after the
+other) and an index (one fixed-size entry per revision: where its record
+is, what it is a delta against, when and by whom it was saved, and the
+hash of its content). Records are only ever appended.
+
+A record is either a snapshot (the whole content) or a delta: the lines
+it shares with its base revision, by range, and the lines it doesn't.
+Revision n is a delta against revision s + (m & (m - 1)), where s is the
+last snapshot and m = n - s, i.e. against the revision with m's lowest
+set bit cleared. Any revision is then at most log2(SNAPSHOT_INTERVAL)
+deltas away from a snapshot, and a new snapshot is taken every
+SNAPSHOT_INTERVAL revisions. Designed to be run from shell::
+
+    >>> from wiki import revisions
+    >>> revisions.log('/some/page/')
+    >>> print(revisions.diff('/some/page/', 3, 7))
+'''
+
+from __future__ import division
+from __future__ import unicode_literals
+
+import binascii
+import difflib
+import fcntl
+import hashlib
+import json
+import os
+import struct
+import time
+import zlib
+
+from config import wiki_revisions_path
+
+## -------------------------------------------------------------------------- ##
+
+# offset, length and base (-1 for a snapshot) of the record, time, content
+# md5 and editor
+INDEX = struct.Struct(str('>QIid16s32s'))
+
+SNAPSHOT_INTERVAL = 64
+
+# Records are written quickly on save and compressed harder by repack()
+SAVE_LEVEL = 1
+REPACK_LEVEL = 9
+
+
+def page_path(pg):
+    return os.path.join(wiki_revisions_path, hashlib.md5(pg.encode('utf-8')).hexdigest())
+
+
+def pack_path(pg):
+    return page_path(pg) + '.pack'
+
+
+def index_path(pg):
+    return page_path(pg) + '.idx'
+
+
+def base_of(n, snapshot):
+    '''
+    Returns the revision n is a delta against (-1 for a snapshot), given the
+    last snapshot before it.
+    '''
+    m = n - snapshot
+    if n == 0 or m >= SNAPSHOT_INTERVAL:
+        return -1
+    return snapshot + (m & (m - 1))
+
+## -------------------------------------------------------------------------- ##
+
+def make_delta(base, content):
+    '''
+    Returns the ops turning base into content: [start, end] copies those
+    lines of base, a list of strings inserts those lines.
+    '''
+    a = base.splitlines(True)
+    b = content.splitlines(True)
+    ops = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(b[j1:j2])
+    return ops
+
+
+def apply_delta(base, ops):
+    a = base.splitlines(True)
+    lines = []
+    for op in ops:
+        if len(op) == 2 and isinstance(op[0], int):
+            lines.extend(a[op[0]:op[1]])
+        else:
+            lines.extend(op)
+    return ''.join(lines)
+
+
+def encode(data, level):
+    return zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8'), level)
+
+
+def decode(record):
+    return json.loads(zlib.decompress(record).decode('utf-8'))
+
+## -------------------------------------------------------------------------- ##
+
+class Lock(object):
+    '''
+    Holds an exclusive lock on a page's history while writing it.
+    '''
+    def __init__(self, pg):
+        if not os.path.isdir(wiki_revisions_path):
+            os.makedirs(wiki_revisions_path)
+        self.f = open(page_path(pg) + '.lock', 'a')
+
+    def __enter__(self):
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
+
+def read_index(pg):
+    '''
+    Returns the page's index entries: one dict per revision.
+    '''
+    try:
+        f = open(index_path(pg), 'rb')
+    except IOError:
+        return []
+    data = f.read()
+    f.close()
+
+    entries = []
+    for i in range(len(data) // INDEX.size):
+        offset, length, base, saved, digest, editor = INDEX.unpack_from(data, i * INDEX.size)
+        entries.append({
+            'number'    : i,
+            'offset'    : offset,
+            'length'    : length,
+            'base'      : base,
+            'time'      : saved,
+            'md5'       : digest,
+            'editor'    : editor.rstrip(b'\0').decode('utf-8', 'replace'),
+        })
+    return entries
+
+
+def read_records(pg, entries, numbers):
+    '''
+    Returns {number: decoded record} for the given revisions.
+    '''
+    records = {}
+    f = open(pack_path(pg), 'rb')
+    for n in sorted(numbers):
+        f.seek(entries[n]['offset'])
+        records[n] = decode(f.read(entries[n]['length']))
+    f.close()
+    return records
+
+
+def chain(entries, n):
+    '''
+    Returns the revisions needed to rebuild revision n, snapshot first.
+    '''
+    numbers = [n]
+    while entries[numbers[-1]]['base'] != -1:
+        numbers.append(entries[numbers[-1]]['base'])
+    return numbers[::-1]
+
+
+def rebuild(pg, entries, n, records=None):
+    numbers = chain(entries, n)
+    if records is None:
+        records = read_records(pg, entries, numbers)
+    content = None
+    for number in numbers:
+        if entries[number]['base'] == -1:
+            content = records[number]
+        else:
+            content = apply_delta(content, records[number])
+    return content
+
+## -------------------------------------------------------------------------- ##
+
+def record(pg, content, editor=''):
+    '''
+    Appends content as the page's newest revision, unless it is the same as
+    the newest already. Returns the revision's number, or None.
+    '''
+    digest = hashlib.md5(content.encode('utf-8')).digest()
+    with Lock(pg):
+        entries = read_index(pg)
+        if entries and entries[-1]['md5'] == digest:
+            return None
+
+        n = len(entries)
+        snapshot = max([e['number'] for e in entries if e['base'] == -1] or [0])
+        base = base_of(n, snapshot)
+        if base == -1:
+            data = encode(content, SAVE_LEVEL)
+        else:
+            data = encode(make_delta(rebuild(pg, entries, base), content), SAVE_LEVEL)
+
+        f = open(pack_path(pg), 'ab')
+        f.seek(0, os.SEEK_END)
+        offset = f.tell()
+        f.write(data)
+        f.close()
+
+        editor = editor.encode('utf-8')[:32]
+        f = open(index_path(pg), 'ab')
+        f.write(INDEX.pack(offset, len(data), base, time.time(), digest, editor))
+        f.close()
+    return n
+
+
+def count(pg):
+    try:
+        return os.path.getsize(index_path(pg)) // INDEX.size
+    except OSError:
+        return 0
+
+
+def get(pg, n=-1):
+    '''
+    Returns the content of revision n of the page (by default the newest).
+    '''
+    entries = read_index(pg)
+    if n < 0:
+        n += len(entries)
+    if not 0 <= n < len(entries):
+        raise IndexError('No revision {} of {}'.format(n, pg))
+    return rebuild(pg, entries, n)
+
+
+def find(pg, digest):
+    '''
+    Returns the number of the page's newest revision with the given content
+    md5 (in hex), or None.
+    '''
+    for entry in reversed(read_index(pg)):
+        if binascii.hexlify(entry['md5']) == digest:
+            return entry['number']
+    return None
+
+
+def log(pg):
+    '''
+    Designed to be run from shell.
+    Returns the page's revisions, newest first: (number, time, editor).
+    '''
+    return [(e['number'], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(e['time'])), e['editor'])
+            for e in reversed(read_index(pg))]
+
+
+def diff(pg, a, b=-1, context=3):
+    '''
+    Designed to be run from shell.
+    Returns the unified diff between revisions a and b of the page.
+    '''
+    entries = read_index(pg)
+    a, b = [n + len(entries) if n < 0 else n for n in [a, b]]
+    numbers = set(chain(entries, a) + chain(entries, b))
+    records = read_records(pg, entries, numbers)
+    lines = difflib.unified_diff(
+        rebuild(pg, entries, a, records).splitlines(True),
+        rebuild(pg, entries, b, records).splitlines(True),
+        '{}@{}'.format(pg, a), '{}@{}'.format(pg, b), n=context)
+    return ''.join(lines)
+
+
+def restore(pg, n):
+    '''
+    Designed to be run from shell.
+    Saves revision n as the page's newest.
+    '''
+    from models import Page
+
+    page = Page.objects.get(pg=pg)
+    page.raw_content = get(pg, n)
+    page.save()
+
+
+def move(old_pg, new_pg):
+    '''
+    Gives the history of old_pg to new_pg (when a page is renamed). Keeps
+    new_pg's own history, if any, ahead of it.
+    '''
+    if not count(old_pg):
+        return
+    if count(new_pg):
+        for entry in read_index(old_pg):
+            record(new_pg, get(old_pg, entry['number']), entry['editor'])
+        remove(old_pg)
+        return
+    with Lock(old_pg):
+        for path in [pack_path, index_path]:
+            os.rename(path(old_pg), path(new_pg))
+
+
+def remove(pg):
+    for path in [pack_path(pg), index_path(pg), page_path(pg) + '.lock']:
+        if os.path.exists(path):
+            os.remove(path)
+
+## -------------------------------------------------------------------------- ##
+
+def repack(pg=None):
+    '''
+    Designed to be run from shell.
+    Rewrites the history of a page (or of every page) with the strongest
+    compression and fresh deltas, checking every revision on the way.
+    Returns the sizes (in bytes) before and after.
+    '''
+    if pg is None:
+        from models import Page
+
+        total = [0, 0]
+        for pg in Page.objects.values_list('pg', flat=True):
+            before, after = repack(pg)
+            total[0] += before
+            total[1] += after
+        return tuple(total)
+
+    with Lock(pg):
+        entries = read_index(pg)
+        if not entries:
+            return 0, 0
+        before = os.path.getsize(pack_path(pg))
+
+        temp_pack = '{}.{}.tmp'.format(pack_path(pg), os.getpid())
+        temp_index = '{}.{}.tmp'.format(index_path(pg), os.getpid())
+        pack = open(temp_pack, 'wb')
+        index = open(temp_index, 'wb')
+
+        contents = {}
+        snapshot = 0
+        for e in entries:
+            n = e['number']
+            content = rebuild(pg, entries, n)
+            if hashlib.md5(content.encode('utf-8')).digest() != e['md5']:
+                raise ValueError('Revision {} of {} is corrupt'.format(n, pg))
+            contents[n] = content
+
+            base = base_of(n, snapshot)
+            if base == -1:
+                snapshot = n
+                data = encode(content, REPACK_LEVEL)
+            else:
+                data = encode(make_delta(contents[base], content), REPACK_LEVEL)
+            offset = pack.tell()
+            pack.write(data)
+            index.write(INDEX.pack(offset, len(data), base, e['time'], e['md5'], e['editor'].encode('utf-8')[:32]))
+
+            # later revisions are only ever deltas against this snapshot's
+            for m in list(contents):
+                if m < snapshot:
+                    del contents[m]
+
+        pack.close()
+        index.close()
+        os.rename(temp_pack, pack_path(pg))
+        os.rename(temp_index, index_path(pg))
+        after = os.path.getsize(pack_path(pg))
+    return before, after
+
+
+def footprint():
+    '''
+    Designed to be run from shell.
+    Returns the number of revisions kept and the bytes they take.
+    '''
+    revisions = 0
+    size = 0
+    if os.path.isdir(wiki_revisions_path):
+        for name in os.listdir(wiki_revisions_path):
+            path = os.path.join(wiki_revisions_path, name)
+            if name.endswith('.idx'):
+                revisions += os.path.getsize(path) // INDEX.size
+            size += os.path.getsize(path)
+    return revisions, size
@@ -127,3 +127,153 @@ $('textarea').live('keydown', function(e){
         $(this).get(0).selectionEnd = end + 2 * mark.length;
     }
 });
+
+// Live preview: the buffer is rendered by the server (wiki_preview) shortly
+// after typing stops. Sections that didn't fit in the server's time budget
+// come back null and are asked for again; unchanged ones are left alone.
+var preview = {
+    on: false,
+    timer: null,
+    request: null,
+    delay: 300,
+
+    toggle: function() {
+        preview.on = !preview.on;
+        $('body').toggleClass('previewing', preview.on);
+        if ( preview.on ) preview.schedule(0);
+    },
+    schedule: function(delay) {
+        clearTimeout(preview.timer);
+        if ( preview.on ) preview.timer = setTimeout(preview.fetch, delay);
+    },
+    fetch: function() {
+        if ( preview.request ) preview.request.abort();
+        var form = $('#editor');
+        preview.request = $.post(form.data('preview'), {
+            content: $('#content').val(),
+            pg: form.find('input[name="pg"]').val(),
+            csrfmiddlewaretoken: form.find('input[name="csrfmiddlewaretoken"]').val()
+        }, preview.show, 'json');
+    },
+    show: function(data) {
+        preview.request = null;
+        var container = $('#preview');
+        var parts = container.children('.preview-part');
+        for ( var i = parts.length; i > data.parts.length; i-- ) parts.eq(i - 1).remove();
+        for ( var i = 0; i < data.parts.length; i++ ) {
+            var part = container.children('.preview-part').eq(i);
+            if ( part.length == 0 ) part = $('<div class="preview-part"></div>').appendTo(container);
+            if ( data.parts[i] === null ) {
+                part.addClass('pending');
+            } else if ( part.data('html') !== data.parts[i] || part.hasClass('pending') ) {
+                part.removeClass('pending').data('html', data.parts[i]).html(data.parts[i]);
+                if ( typeof MathJax != 'undefined' ) MathJax.Hub.Queue(['Typeset', MathJax.Hub, part.get(0)]);
+            }
+        }
+        if ( data.pending ) preview.schedule(0);
+    }
+};
+$('button[name="preview"]').live('click', function(e) {
+    e.preventDefault();
+    preview.toggle();
+});
+$('#content').live('input', function() {
+    preview.schedule(preview.delay);
+});
+
+// Autosave: every few seconds, the changes since the last save are sent as
+// one patch (the range that changed and its new text) against the draft's
+// revision. The first save sends the whole buffer, since the browser's copy
+// of the page needn't match the server's to the character (line endings),
+// as does any save the server has something else for.
+// Submit and Update save the draft first, then publish it by revision
+// rather than posting the whole buffer again.
+var autosave = {
+    saved: null,
+    revision: null,
+    request: null,
+    waiting: [],
+    interval: 5000,
+
+    init: function() {
+        var form = $('#editor');
+        if ( form.length == 0 || !form.data('autosave') ) return;
+        autosave.saved = $('#content').val();
+        setInterval(function() { autosave.flush(); }, autosave.interval);
+    },
+    delta: function(old, now) {
+        var start = 0;
+        while ( start < old.length && start < now.length && old[start] == now[start] ) start++;
+        var end = 0;
+        while ( end < old.length - start && end < now.length - start
+                && old[old.length - 1 - end] == now[now.length - 1 - end] ) end++;
+        return { start: start, end: old.length - end, text: now.slice(start, now.length - end) };
+    },
+    flush: function(done) {
+        if ( done ) autosave.waiting.push(done);
+        if ( autosave.request ) return; // flushed again when it returns
+
+        var now = $('#content').val();
+        if ( now == autosave.saved ) {
+            autosave.done(true);
+            return;
+        }
+        autosave.send(now, autosave.revision === null); // whole, until the server has it
+    },
+    done: function(ok) {
+        var waiting = autosave.waiting;
+        autosave.waiting = [];
+        for ( var i in waiting ) waiting[i](ok);
+    },
+    send: function(now, whole) {
+        var form = $('#editor');
+        var data = {
+            pg: form.find('input[name="pg"]').val(),
+            published: form.attr('data-published'),
+            csrfmiddlewaretoken: form.find('input[name="csrfmiddlewaretoken"]').val()
+        };
+        if ( whole ) {
+            data.content = now;
+        } else {
+            var d = autosave.delta(autosave.saved, now);
+            data.base = autosave.revision;
+            data.start = d.start;
+            data.end = d.end;
+            data.text = d.text;
+        }
+        autosave.request = $.ajax({
+            type: 'POST',
+            url: form.data('autosave'),
+            data: data,
+            dataType: 'json',
+            success: function(result) {
+                autosave.request = null;
+                autosave.saved = now;
+                autosave.revision = result.revision;
+                autosave.flush();
+            },
+            error: function(xhr) {
+                autosave.request = null;
+                if ( xhr.status == 409 && !whole ) autosave.send(now, true);
+                else autosave.done(false);
+            }
+        });
+    },
+    submit: function(button) {
+        var form = $('#editor');
+        autosave.flush(function(ok) {
+            if ( ok && autosave.revision ) { // else post the whole buffer, as without autosave
+                form.find('input[name="draft"]').val(autosave.revision).prop('disabled', false);
+                form.find('#content').prop('disabled', true);
+            }
+            $('<input type="hidden">').attr('name', button).val('').appendTo(form);
+            form.get(0).submit();
+        });
+    }
+};
+$(autosave.init);
+$('button[name="submit"], button[name="update"]').live('click', function(e) {
+    if ( !$('#editor').data('autosave') ) return;
+    e.preventDefault();
+    autosave.submit($(this).attr('name'));
+});
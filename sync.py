@@ -0,0 +1,428 @@
+'''
+Two-way mirror of the wiki's pages and images to remote storage.
+
+A state database (WIKI_SYNC_STATE_PATH) remembers, for every file, its hash
+when it was last in sync, and its local size and mtime then. A sync
+
+1. scans the local tree, hashing only files whose size or mtime changed,
+2. lists the remote tree (metadata only, hashes included),
+3. compares the three: whichever side changed since the last sync wins, and
+   files changed on both sides are left alone and reported as conflicts,
+4. transfers what changed, WIKI_SYNC_WORKERS files at a time, uploads in
+   chunks of WIKI_SYNC_CHUNK_SIZE, retrying each step a few times.
+
+So syncing an unchanged tree costs one stat per file and one listing.
+Hashes are Dropbox's content hash, which any remote can compute. Designed
+to be run from shell::
+
+    >>> from wiki import sync
+    >>> sync.sync()
+    >>> from wiki import utils
+    >>> utils.rebuild() # if pages came down
+'''
+
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import hashlib
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+from .config import wiki_image_path
+from .config import wiki_pages_path
+from .config import wiki_sync_chunk_size
+from .config import wiki_sync_remote
+from .config import wiki_sync_skip
+from .config import wiki_sync_state_path
+from .config import wiki_sync_workers
+
+## -------------------------------------------------------------------------- ##
+
+# Local folders and their names in the remote tree
+ROOTS = [
+    ('pages', wiki_pages_path),
+    ('images', wiki_image_path),
+]
+
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+RETRIES = 5
+BACKOFF = 0.5 # seconds, doubled after each failure
+
+
+def content_hash(f):
+    '''
+    Dropbox's content hash of a file: the SHA-256 of the SHA-256s of its
+    4 MB blocks.
+    '''
+    overall = hashlib.sha256()
+    while True:
+        block = f.read(HASH_BLOCK_SIZE)
+        if not block:
+            break
+        overall.update(hashlib.sha256(block).digest())
+    return overall.hexdigest()
+
+
+def file_hash(path):
+    f = open(path, 'rb')
+    try:
+        return content_hash(f)
+    finally:
+        f.close()
+
+
+def retry(fn, *args):
+    for attempt in range(RETRIES):
+        try:
+            return fn(*args)
+        except Exception: # what a remote raises depends on the remote
+            if attempt == RETRIES - 1:
+                raise
+            time.sleep(BACKOFF * 2 ** attempt)
+
+
+def skipped(name):
+    parts = name.split('/')
+    if any(part.startswith('.') for part in parts) or name.endswith('.tmp'):
+        return True
+    return parts[0] == 'images' and len(parts) > 2 and parts[1] in wiki_sync_skip
+
+
+def local_path(name):
+    root, _, rest = name.partition('/')
+    return os.path.join(dict(ROOTS)[root], *rest.split('/'))
+
+## -------------------------------------------------------------------------- ##
+
+class LocalRemote(object):
+    '''
+    A remote tree kept in a local folder: a mounted share, or a stand-in
+    for a real server when trying things out.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.uploads = os.path.join(root, '.uploads')
+        self.hashes = {}
+
+    def path(self, name):
+        return os.path.join(self.root, *name.split('/'))
+
+    def list(self):
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, self.root).replace(os.sep, '/')
+                st = os.stat(path)
+                key = (name, st.st_size, st.st_mtime)
+                if key not in self.hashes:
+                    self.hashes[key] = file_hash(path)
+                files[name] = self.hashes[key]
+        return files
+
+    def start_upload(self):
+        if not os.path.isdir(self.uploads):
+            os.makedirs(self.uploads)
+        session = uuid.uuid4().hex
+        open(os.path.join(self.uploads, session), 'wb').close()
+        return session
+
+    def append(self, session, offset, data):
+        f = open(os.path.join(self.uploads, session), 'r+b')
+        f.seek(offset)
+        f.write(data)
+        f.truncate()
+        f.close()
+
+    def finish_upload(self, session, name, size):
+        upload_path = os.path.join(self.uploads, session)
+        if os.path.getsize(upload_path) != size:
+            raise IOError('Upload of {} is incomplete'.format(name))
+        path = self.path(name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        os.rename(upload_path, path)
+        return file_hash(path)
+
+    def download(self, name, f):
+        src = open(self.path(name), 'rb')
+        shutil.copyfileobj(src, f, wiki_sync_chunk_size)
+        src.close()
+
+    def delete(self, name):
+        try:
+            os.remove(self.path(name))
+        except OSError:
+            pass
+
+
+class DropboxRemote(object):
+    '''
+    A remote tree in a Dropbox folder. Needs the dropbox package (API v2),
+    which is why this module imports absolutely: ``import dropbox`` would
+    find our own dropbox.py otherwise.
+    '''
+
+    def __init__(self, root, access_token):
+        import dropbox
+
+        self.dbx = dropbox.Dropbox(access_token)
+        self.root = '/' + root.strip('/')
+
+    def path(self, name):
+        return '/'.join([self.root.rstrip('/'), name])
+
+    def list(self):
+        import dropbox
+
+        files = {}
+        try:
+            result = self.dbx.files_list_folder(self.root, recursive=True)
+        except dropbox.exceptions.ApiError as e:
+            if e.error.is_path() and e.error.get_path().is_not_found():
+                return files
+            raise
+        while True:
+            for entry in result.entries:
+                if isinstance(entry, dropbox.files.FileMetadata):
+                    files[entry.path_display[len(self.root.rstrip('/')) + 1:]] = entry.content_hash
+            if not result.has_more:
+                break
+            result = self.dbx.files_list_folder_continue(result.cursor)
+        return files
+
+    def start_upload(self):
+        return self.dbx.files_upload_session_start(b'').session_id
+
+    def append(self, session, offset, data):
+        import dropbox
+
+        cursor = dropbox.files.UploadSessionCursor(session, offset)
+        try:
+            self.dbx.files_upload_session_append_v2(data, cursor)
+        except dropbox.exceptions.ApiError as e:
+            # a retry of a chunk that did go through the first time
+            lookup = e.error.get_incorrect_offset() if e.error.is_incorrect_offset() else None
+            if lookup is None or lookup.correct_offset != offset + len(data):
+                raise
+
+    def finish_upload(self, session, name, size):
+        import dropbox
+
+        cursor = dropbox.files.UploadSessionCursor(session, size)
+        commit = dropbox.files.CommitInfo(self.path(name), mode=dropbox.files.WriteMode.overwrite)
+        return self.dbx.files_upload_session_finish(b'', cursor, commit).content_hash
+
+    def download(self, name, f):
+        metadata, response = self.dbx.files_download(self.path(name))
+        for chunk in response.iter_content(wiki_sync_chunk_size):
+            f.write(chunk)
+        response.close()
+
+    def delete(self, name):
+        self.dbx.files_delete_v2(self.path(name))
+
+
+def get_remote():
+    '''
+    Returns the remote configured in WIKI_SYNC_REMOTE.
+    '''
+    scheme, _, location = wiki_sync_remote.partition('://')
+    if scheme == 'file':
+        return LocalRemote(location)
+    elif scheme == 'dropbox':
+        return DropboxRemote(location, settings.DROPBOX_ACCESS_TOKEN)
+    raise ValueError('Unknown sync remote: {!r}'.format(wiki_sync_remote))
+
+## -------------------------------------------------------------------------- ##
+
+def open_state():
+    d = os.path.dirname(wiki_sync_state_path)
+    if not os.path.isdir(d):
+        os.makedirs(d)
+    db = sqlite3.connect(wiki_sync_state_path)
+    db.execute('CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, size INTEGER, mtime REAL, hash TEXT)')
+    return db
+
+
+def scan(state):
+    '''
+    Returns {name: (size, mtime, hash)} for the local tree. Files whose size
+    and mtime are as they were at the last sync aren't read again.
+    '''
+    files = {}
+    for root_name, root in ROOTS:
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = '/'.join([root_name, os.path.relpath(path, root).replace(os.sep, '/')])
+                if skipped(name):
+                    continue
+                st = os.stat(path)
+                known = state.get(name)
+                if known and known[0] == st.st_size and known[1] == st.st_mtime:
+                    digest = known[2]
+                else:
+                    digest = file_hash(path)
+                files[name] = (st.st_size, st.st_mtime, digest)
+    return files
+
+
+def plan(local, remote, state, direction='both'):
+    '''
+    Returns (tasks, conflicts): tasks are (action, name), for each file
+    that differs between the two sides or from the state database.
+    '''
+    tasks = []
+    conflicts = []
+    for name in sorted(set(local) | set(remote) | set(state)):
+        here = local[name][2] if name in local else None
+        there = remote.get(name)
+        base = state[name][2] if name in state else None
+
+        if here == there:
+            if here is None:
+                tasks.append(('forget', name))
+            elif base != here:
+                tasks.append(('record', name))
+        elif there == base:
+            if direction != 'down':
+                tasks.append(('delete-remote' if here is None else 'upload', name))
+        elif here == base:
+            if direction != 'up':
+                tasks.append(('delete-local' if there is None else 'download', name))
+        else:
+            conflicts.append(name)
+    return tasks, conflicts
+
+
+def upload(remote, name):
+    session = retry(remote.start_upload)
+    f = open(local_path(name), 'rb')
+    offset = 0
+    while True:
+        data = f.read(wiki_sync_chunk_size)
+        if not data:
+            break
+        retry(remote.append, session, offset, data)
+        offset += len(data)
+    f.close()
+    return retry(remote.finish_upload, session, name, offset)
+
+
+def download(remote, name, expected):
+    path = local_path(name)
+    if not os.path.isdir(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError: # made by another worker meanwhile
+            pass
+    temp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+
+    def fetch():
+        f = open(temp_path, 'wb')
+        try:
+            remote.download(name, f)
+        finally:
+            f.close()
+        if file_hash(temp_path) != expected:
+            raise IOError('Download of {} is corrupt'.format(name))
+
+    try:
+        retry(fetch)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    os.rename(temp_path, path)
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime, expected)
+
+
+def sync(remote=None, direction='both', dry_run=False, verbose=True):
+    '''
+    Designed to be run from shell.
+    Brings the local and remote trees in line (or only the remote, with
+    direction='up', or only the local one, with 'down'). Returns what was
+    done, by action, with the conflicts and errors.
+    '''
+    if remote is None:
+        remote = get_remote()
+    db = open_state()
+    state = dict((name, (size, mtime, digest)) for name, size, mtime, digest
+                 in db.execute('SELECT name, size, mtime, hash FROM files'))
+
+    local = scan(state)
+    remote_files = dict((name, digest) for name, digest in retry(remote.list).items() if not skipped(name))
+    tasks, conflicts = plan(local, remote_files, state, direction)
+
+    report = {'conflicts': conflicts, 'errors': []}
+    for name in conflicts:
+        if verbose:
+            print('Conflict (changed on both sides): {}'.format(name))
+    if dry_run:
+        for action, name in tasks:
+            report.setdefault(action, []).append(name)
+        db.close()
+        return report
+
+    # Bookkeeping needs no transfer
+    with db:
+        for action, name in tasks:
+            if action == 'record':
+                db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', (name,) + local[name])
+            elif action == 'forget':
+                db.execute('DELETE FROM files WHERE name = ?', (name,))
+    for action, name in tasks:
+        report.setdefault(action, []).append(name)
+    transfers = [(action, name) for action, name in tasks if action not in ['record', 'forget']]
+
+    def execute(task):
+        action, name = task
+        try:
+            if action == 'upload':
+                digest = upload(remote, name)
+                if digest != local[name][2]:
+                    raise IOError('Upload of {} is corrupt'.format(name))
+                return task, local[name], None
+            elif action == 'download':
+                return task, download(remote, name, remote_files[name]), None
+            elif action == 'delete-remote':
+                retry(remote.delete, name)
+            elif action == 'delete-local':
+                os.remove(local_path(name))
+            return task, None, None
+        except Exception as e:
+            return task, None, '{}: {}'.format(type(e).__name__, e)
+
+    pool = ThreadPool(wiki_sync_workers)
+    try:
+        for (action, name), row, error in pool.imap_unordered(execute, transfers):
+            if error:
+                report[action].remove(name)
+                report['errors'].append((name, error))
+                if verbose:
+                    print('Failed to {} {}: {}'.format(action.replace('-', ' '), name, error))
+                continue
+            with db:
+                if row:
+                    db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', (name,) + row)
+                else:
+                    db.execute('DELETE FROM files WHERE name = ?', (name,))
+            if verbose:
+                print('{}: {}'.format(action.capitalize().replace('-', ' '), name))
+    finally:
+        pool.close()
+        pool.join()
+        db.close()
+    return report
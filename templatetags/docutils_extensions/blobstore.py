@@ -0,0 +1,364 @@
+from __future__ import division
+from __future__ import unicode_literals
+
+import calendar
+import errno
+import os
+import shutil
+import socket
+import time
+import uuid
+
+import governor
+from config import *
+from profiling import timer
+
+## -------------------------------------------------------------------------- ##
+
+# Sysgen files and PDFs are named by the hash of what they are built from, so
+# a file built on one node is good for every node. With a shared blob store
+# configured (WIKI_BLOBSTORE), obtain() looks for a file in
+#
+#   1. this node's own folder (SYSGEN_PATH, PDF_PATH), which is a read-through
+#      cache of the store,
+#   2. the store, copying it into this node's folder,
+#
+# and only then builds it. Building takes a lease on the file in the store
+# first: while another node holds one, we wait for its file instead of
+# building the same thing again. A lease older than BLOBSTORE_LEASE is taken
+# to be left over from a node that died, and is taken over. Requests don't
+# wait longer than they would for a slot of their own (GOVERNOR_WAIT).
+#
+# Blobs are named like 'sysgen/3f/3fa2...e1.png' and 'pdf/<name>.pdf'.
+
+POLL_INTERVAL = 0.5
+
+LEASE_SUFFIX = '.lease'
+
+# Seconds for racing writes of a lease to an S3 store to settle, where it
+# can't write conditionally
+LEASE_SETTLE = 1.0
+
+
+def holder():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def copy_into(src, dst):
+    '''
+    Copies src to dst atomically, as another request may be reading dst.
+    '''
+    d = os.path.dirname(dst)
+    if not os.path.isdir(d):
+        try:
+            os.makedirs(d)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    temp_path = '{}.{}.tmp'.format(dst, os.getpid())
+    shutil.copyfile(src, temp_path)
+    os.rename(temp_path, dst)
+
+
+class LocalBlobStore(object):
+    '''
+    Blobs kept in a folder, e.g. on a file system every node mounts.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, name):
+        return os.path.join(self.root, *name.split('/'))
+
+    def exists(self, name):
+        return os.path.isfile(self.path(name))
+
+    def fetch(self, name, path):
+        try:
+            copy_into(self.path(name), path)
+        except IOError:
+            return False
+        return True
+
+    def store(self, path, name):
+        copy_into(path, self.path(name))
+
+    def delete(self, name):
+        try:
+            os.remove(self.path(name))
+        except OSError:
+            pass
+
+    def lease(self, name, timeout=BLOBSTORE_LEASE):
+        lease_path = self.path(name) + LEASE_SUFFIX
+        if not os.path.isdir(os.path.dirname(lease_path)):
+            try:
+                os.makedirs(os.path.dirname(lease_path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        for attempt in range(2):
+            try:
+                fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                try:
+                    lease = os.stat(lease_path)
+                except OSError: # just released
+                    continue
+                if time.time() - lease.st_mtime <= timeout:
+                    return False
+                if not self.take_over(lease_path, lease):
+                    return False
+                continue
+            os.write(fd, holder().encode('utf-8'))
+            os.close(fd)
+            return True
+        return False
+
+    def take_over(self, lease_path, stale):
+        '''
+        Removes the stale lease (``stale`` being its stat) unless another
+        node got to it first. Of nodes racing to, only one can rename it
+        aside; any other renames aside nothing, or the lease the first one
+        has taken since, which it puts back.
+        '''
+        aside = '{}.{}'.format(lease_path, uuid.uuid4().hex)
+        try:
+            os.rename(lease_path, aside)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        lease = os.stat(aside)
+        taken = (lease.st_ino, lease.st_mtime) == (stale.st_ino, stale.st_mtime)
+        if not taken:
+            try:
+                os.link(aside, lease_path)
+            except OSError:
+                pass
+        os.remove(aside)
+        return taken
+
+    def release(self, name):
+        try:
+            os.remove(self.path(name) + LEASE_SUFFIX)
+        except OSError:
+            pass
+
+
+class S3BlobStore(object):
+    '''
+    Blobs kept in an S3 bucket, or anything speaking the S3 API (give its
+    endpoint_url in WIKI_BLOBSTORE_OPTIONS). Needs boto3.
+    '''
+
+    def __init__(self, bucket, prefix='', client=None, **options):
+        if client is None:
+            import boto3
+
+            client = boto3.client('s3', **options)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.conditional = BLOBSTORE_CONDITIONAL # until the store (or boto3) can't
+
+    def key(self, name):
+        return '/'.join([self.prefix, name]) if self.prefix else name
+
+    def error_code(self, e):
+        return e.response.get('Error', {}).get('Code', '')
+
+    def head(self, name):
+        from botocore.exceptions import ClientError
+
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except ClientError as e:
+            if self.error_code(e) in ['404', 'NoSuchKey', 'NotFound']:
+                return None
+            raise
+
+    def exists(self, name):
+        return self.head(name) is not None
+
+    def fetch(self, name, path):
+        from botocore.exceptions import ClientError
+
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        try:
+            self.client.download_file(self.bucket, self.key(name), temp_path)
+        except ClientError as e:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            if self.error_code(e) in ['404', 'NoSuchKey', 'NotFound']:
+                return False
+            raise
+        os.rename(temp_path, path)
+        return True
+
+    def store(self, path, name):
+        self.client.upload_file(path, self.bucket, self.key(name))
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+    def lease(self, name, timeout=BLOBSTORE_LEASE):
+        '''
+        Takes the lease if there is none (or only a stale one) with a
+        conditional write: if there was none, if none has been written since
+        (If-None-Match), else if the stale one is still there (If-Match).
+        Only one of the nodes racing for it succeeds.
+        '''
+        from botocore.exceptions import ClientError
+        from botocore.exceptions import ParamValidationError
+
+        lease_name = name + LEASE_SUFFIX
+        lease = self.head(lease_name)
+        condition = {'IfNoneMatch': '*'}
+        if lease is not None:
+            age = time.time() - calendar.timegm(lease['LastModified'].utctimetuple())
+            if age <= timeout:
+                return False
+            condition = {'IfMatch': lease['ETag']}
+
+        token = '{}:{}'.format(holder(), uuid.uuid4().hex)
+        if self.conditional:
+            try:
+                self.client.put_object(Bucket=self.bucket, Key=self.key(lease_name),
+                    Body=token.encode('utf-8'), **condition)
+                return True
+            except ParamValidationError: # a boto3 that doesn't know them
+                self.conditional = False
+            except ClientError as e:
+                if self.error_code(e) in ['PreconditionFailed', 'ConditionalRequestConflict', '412', '409']:
+                    return False
+                if self.error_code(e) not in ['NotImplemented', '501']:
+                    raise
+                self.conditional = False
+        return self.settled_lease(lease_name, token)
+
+    def settled_lease(self, lease_name, token):
+        '''
+        Takes the lease without a conditional write: writes our own, waits
+        LEASE_SETTLE seconds and reads it back. Of nodes racing for it, only
+        the one whose write landed last finds its own there.
+        '''
+        from botocore.exceptions import ClientError
+
+        self.client.put_object(Bucket=self.bucket, Key=self.key(lease_name), Body=token.encode('utf-8'))
+        time.sleep(LEASE_SETTLE)
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=self.key(lease_name))['Body'].read()
+        except ClientError as e:
+            if self.error_code(e) in ['404', 'NoSuchKey', 'NotFound']: # released already
+                return False
+            raise
+        return body.decode('utf-8') == token
+
+    def release(self, name):
+        self.delete(name + LEASE_SUFFIX)
+
+## -------------------------------------------------------------------------- ##
+
+stores = {}
+
+
+def get_store():
+    '''
+    Returns the configured blob store, or None.
+    '''
+    if not BLOBSTORE:
+        return None
+    if BLOBSTORE not in stores:
+        scheme, _, location = BLOBSTORE.partition('://')
+        if scheme == 'file':
+            stores[BLOBSTORE] = LocalBlobStore(location)
+        elif scheme == 's3':
+            bucket, _, prefix = location.partition('/')
+            stores[BLOBSTORE] = S3BlobStore(bucket, prefix, **BLOBSTORE_OPTIONS)
+        else:
+            raise ValueError('Unknown blob store: {}'.format(BLOBSTORE))
+    return stores[BLOBSTORE]
+
+
+def fetch(name, path):
+    '''
+    Copies the blob to path if this node hasn't got it yet. Returns whether
+    path exists now.
+    '''
+    if os.path.exists(path):
+        return True
+    store = get_store()
+    if store is None:
+        return False
+    with timer('blob.fetch'):
+        return store.fetch(name, path)
+
+
+def publish(name, path):
+    store = get_store()
+    if store is not None and os.path.exists(path):
+        with timer('blob.store'):
+            store.store(path, name)
+
+
+def discard(name):
+    '''
+    Removes the blob from the store (so that it is built afresh).
+    '''
+    store = get_store()
+    if store is not None:
+        store.delete(name)
+
+
+def obtain(name, path, build, extras=[], kind='figure'):
+    '''
+    Makes sure path holds the blob: this node's copy, the store's, or else
+    what build() leaves at path. Only one node builds a blob at a time; the
+    others wait for it. ``extras`` are (name, path) of other files build()
+    makes along the way (e.g. a video's poster), stored and fetched with it.
+    Returns path. Raises governor.Saturated, for the ``kind`` of work, if
+    another node is still building it after GOVERNOR_WAIT seconds (unless
+    governor.patient(), which waits for as long as a lease lasts).
+    '''
+    if os.path.exists(path):
+        return path
+    store = get_store()
+    if store is None:
+        build()
+        return path
+
+    patient = governor.is_patient()
+    deadline = time.time() + (BLOBSTORE_LEASE if patient else GOVERNOR_WAIT)
+    while True:
+        if fetch(name, path):
+            for extra_name, extra_path in extras:
+                fetch(extra_name, extra_path)
+            return path
+        if store.lease(name):
+            break
+        if time.time() > deadline:
+            if not patient:
+                raise governor.saturated(kind)
+            build() # waited long enough, build it anyway
+            return path
+        time.sleep(POLL_INTERVAL)
+
+    try:
+        build()
+        # extras first: whoever sees the blob may go looking for them
+        for extra_name, extra_path in extras:
+            publish(extra_name, extra_path)
+        publish(name, path)
+    finally:
+        store.release(name)
+    return path
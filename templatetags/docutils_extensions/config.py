@@ -2,6 +2,7 @@ from __future__ import division
 from __future__ import unicode_literals
 
 import os
+from tempfile import gettempdir
 
 from django.conf import settings
 
@@ -22,3 +23,74 @@ WIKI_IMAGE_URL = '/'.join([settings.MEDIA_URL, WIKI_IMAGE_FOLDER])
 
 # Directory within WIKI_IMAGE_FOLDER where system-generated images will go
 SYSGEN_FOLDER = 'sysgen'
+SYSGEN_PATH = os.path.join(WIKI_IMAGE_PATH, SYSGEN_FOLDER)
+SYSGEN_URL = '/'.join([WIKI_IMAGE_URL, SYSGEN_FOLDER])
+
+# Directory within SYSGEN_FOLDER where page references to sysgen files are kept
+SYSGEN_REFS_FOLDER = '_refs'
+
+# Unreferenced sysgen files younger than this (in seconds) are spared by GC
+SYSGEN_GC_GRACE = getattr(settings, 'WIKI_SYSGEN_GC_GRACE', 60 * 60)
+
+# Compiled PDFs not asked for in this long (in seconds) are removed by
+# collect_pdfs(), as are the least recently asked for beyond PDF_MAX_SIZE
+# bytes in all (None for no limit)
+PDF_MAX_AGE = getattr(settings, 'WIKI_PDF_MAX_AGE', 30 * 24 * 60 * 60)
+PDF_MAX_SIZE = getattr(settings, 'WIKI_PDF_MAX_SIZE', None)
+
+# Responsive variants: widths (px) to derive from each image, and the folder
+# beside the image where they are kept
+VARIANT_WIDTHS = getattr(settings, 'WIKI_VARIANT_WIDTHS', [320, 640, 960, 1280])
+VARIANT_FOLDER = '_variants'
+
+# External programs (LaTeX, Ghostscript, ffmpeg, python) are killed after
+# RUNNER_TIMEOUT seconds or when they use more than RUNNER_MEMORY bytes of
+# address space, and at most RUNNER_SLOTS heavy ones run at once per host
+# (counted across processes through lock files in RUNNER_LOCK_PATH)
+RUNNER_TIMEOUT = getattr(settings, 'WIKI_RUNNER_TIMEOUT', 5 * 60)
+RUNNER_MEMORY = getattr(settings, 'WIKI_RUNNER_MEMORY', 2 * 1024 ** 3)
+RUNNER_SLOTS = getattr(settings, 'WIKI_RUNNER_SLOTS', 2)
+# How long a job waits for a slot before giving up (background work, see
+# governor.patient, waits as long as a job may run)
+RUNNER_SLOT_WAIT = getattr(settings, 'WIKI_RUNNER_SLOT_WAIT', 10)
+RUNNER_LOCK_PATH = getattr(settings, 'WIKI_RUNNER_LOCK_PATH',
+    os.path.join(gettempdir(), 'wiki-runner'))
+
+# How long (in seconds) rendered sections of long pages are cached
+SECTION_CACHE_TIMEOUT = getattr(settings, 'WIKI_SECTION_CACHE_TIMEOUT', 30 * 24 * 60 * 60)
+
+# How long (in seconds) sections rendered for the editor's live preview are
+# cached; they may show placeholders for figures that weren't built yet
+PREVIEW_CACHE_TIMEOUT = getattr(settings, 'WIKI_PREVIEW_CACHE_TIMEOUT', 60 * 60)
+
+# How math is rendered in HTML: 'MathJax' (in the browser) or 'MathML' (as
+# pages are rendered, leaving only what can't be converted to MathJax)
+MATH_OUTPUT = getattr(settings, 'WIKI_MATH_OUTPUT', 'MathJax')
+
+# Folder of the problem bank, referenced by slug from problem-set directives
+# (see problems.py); by default beside the wiki's pages
+PROBLEM_BANK_PATH = getattr(settings, 'WIKI_PROBLEM_BANK_PATH',
+    os.path.abspath(os.path.join(WORK_PATH, '..', '..', '..', '_', 'problem-bank')))
+
+# Blob store shared by all nodes for sysgen files and PDFs, so each is built
+# once per cluster (see blobstore.py): '' (none, every node builds its own),
+# a folder such as 'file:///srv/wiki-blobs', or 's3://bucket/prefix' (with
+# WIKI_BLOBSTORE_OPTIONS passed to boto3's client, e.g. an endpoint_url).
+# A node building a file holds a lease on it for at most BLOBSTORE_LEASE
+# seconds; the others wait for the file meanwhile.
+BLOBSTORE = getattr(settings, 'WIKI_BLOBSTORE', '')
+BLOBSTORE_OPTIONS = getattr(settings, 'WIKI_BLOBSTORE_OPTIONS', {})
+BLOBSTORE_LEASE = getattr(settings, 'WIKI_BLOBSTORE_LEASE', 3 * RUNNER_TIMEOUT)
+# Whether to take leases on an S3 store with conditional writes; turn it off
+# for a stand-in that accepts If-None-Match but ignores it
+BLOBSTORE_CONDITIONAL = getattr(settings, 'WIKI_BLOBSTORE_CONDITIONAL', True)
+
+# Admission control for heavy work (see governor.py): at most
+# GOVERNOR_SLOTS[kind] PDF compiles or figure builds run at once per host,
+# the rest wait in line, fairly, for at most GOVERNOR_WAIT seconds. With
+# GOVERNOR_QUEUE already waiting, requests are turned away at once.
+GOVERNOR_SLOTS = getattr(settings, 'WIKI_GOVERNOR_SLOTS', {'pdf': 1, 'figure': 2})
+GOVERNOR_QUEUE = getattr(settings, 'WIKI_GOVERNOR_QUEUE', 8)
+GOVERNOR_WAIT = getattr(settings, 'WIKI_GOVERNOR_WAIT', 20)
+GOVERNOR_PATH = getattr(settings, 'WIKI_GOVERNOR_PATH',
+    os.path.join(gettempdir(), 'wiki-governor'))
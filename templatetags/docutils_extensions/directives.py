@@ -3,24 +3,34 @@ from __future__ import unicode_literals
 
 import codecs
 import hashlib
-import json
 import os
-import random
 import re
 import shutil
-import yaml
 
-from subprocess import Popen, PIPE
+from tempfile import mkdtemp
 from PIL import Image
 
+from django.utils.html import escape
+
 from docutils import nodes
 from docutils.parsers import rst
 
 from utils import rst2html
 from utils import rst2latex
 from utils import get_latex_path
+from utils import writes
+from sysgen import sysgen_path
+from sysgen import sysgen_url
+from sysgen import poster_name
+from sysgen import blob_name
+from variants import srcset
+import blobstore
+import governor
+import problems
 
 from config import *
+from runner import run
+from profiling import timer
 
 ## -------------------------------------------------------------------------- ##
 
@@ -87,8 +97,11 @@ class tbl_directive(rst.Directive):
             except:
                 tbl = None
 
+        # Only the output being written is made (and its cells rendered)
+        settings = self.state.document.settings
+
         text = ''
-        if tbl:
+        if tbl and writes(settings, 'html'):
             # parser.parse() returns a list of three items
             #
             # 1. A list of column widths
@@ -153,17 +166,18 @@ class tbl_directive(rst.Directive):
             text += '</table>\n'
             text += '</div>\n'
 
-        node = nodes.raw(text=text, format='html', **self.options)
-        node_list += [node]
+        if writes(settings, 'html'):
+            node = nodes.raw(text=text, format='html', **self.options)
+            node_list += [node]
 
-        
-        
-        
+        if not writes(settings, 'latex'):
+            return node_list
         
 # Create latex node
         
         text = ''
         if tbl:
+            colspecs, headrows, bodyrows = tbl
             
             label = ''
             if 'label' in self.options.keys():
@@ -315,7 +329,9 @@ class fig_directive(rst.Directive):
     :scale:     Used to scale the image.
     :label:     Used for hyperlinks references. See ``fig`` role.
     :template:  Used to point to proper templale when creating image. Default 
-                is ``latex-preview``.
+                is ``latex-preview``. ``matplotlib-animation-pool`` renders
+                animation frames in parallel; its ``animate(i)`` must depend
+                only on ``i``.
 
     Notes
     -----
@@ -340,6 +356,11 @@ class fig_directive(rst.Directive):
         node_list = []
 
         text = ''
+
+        # Only the output being written is made: a LaTeX figure is drawn from
+        # the content itself, so only HTML needs the image built
+        settings = self.state.document.settings
+        html = writes(settings, 'html')
         
         try:
             scale = float(self.options['scale'])
@@ -356,7 +377,7 @@ class fig_directive(rst.Directive):
                 image_path = os.path.join(WIKI_IMAGE_PATH, image_name)
                 image_url = '/'.join([WIKI_IMAGE_URL, image_name])
 
-                if not os.path.exists(image_path):
+                if html and not os.path.exists(image_path):
                     print '* ERROR: Missing: ' + image_path
                     text += '<p class="warning">'
                     text += 'Missing image : {}'.format(image_name)
@@ -368,32 +389,58 @@ class fig_directive(rst.Directive):
             image_hash = hashlib.md5(content.encode('utf-8')).hexdigest()
 
             if 'template' in self.options:
-                type, template = self.options['template'].split('-')
+                type, template = self.options['template'].split('-', 1)
             else:
                 type = 'latex'
                 template = 'preview'
 
-            if template == 'animation':
+            if template.startswith('animation'):
                 image_name = '{}.mp4'.format(image_hash)
             else:
                 image_name = '{}.png'.format(image_hash)
 
-            image_path = os.path.join(WIKI_IMAGE_PATH, SYSGEN_FOLDER, image_name)
-            image_url = '/'.join([WIKI_IMAGE_URL, SYSGEN_FOLDER, image_name])
+            image_path = sysgen_path(image_name)
+            image_url = sysgen_url(image_name)
+
+            # Only collecting references? Then don't build anything.
+            refs = getattr(settings, 'sysgen_refs', None)
+            if refs is not None:
+                refs.append(image_name)
+            if not getattr(settings, 'sysgen_build', True):
+                return []
                 
-            if not os.path.exists(image_path):
-                self.build_image(image_path, content, type, template)
+            # Previews don't wait for figures to be built (but take them from
+            # the blob store if another node built them). Of the documents
+            # not written to HTML, only those collecting references build.
+            if not html and refs is None:
+                pass
 
-            if not os.path.exists(image_path):
+            elif not blobstore.fetch(blob_name(image_name), image_path) and getattr(settings, 'sysgen_placeholders', False):
+                text += '<div class="warning">\n'
+                text += '<h4>Figure not built yet (it will be when the page is saved)</h4>\n'
+                text += '<pre><code>'
+                text += escape('\n'.join(self.content)) + '\n'
+                text += '</code></pre>\n'
+                text += '</div>\n\n'
+
+            elif not os.path.exists(image_path):
+                def build():
+                    with timer('fig.build'):
+                        self.build_image(image_path, content, type, template)
+
+                extras = [(blob_name(poster_name(image_name)), sysgen_path(poster_name(image_name)))]
+                blobstore.obtain(blob_name(image_name), image_path, governor.governed('figure', build), extras, kind='figure')
+
+            if html and not text and not os.path.exists(image_path):
                 print '* ERROR: Missing: ' + image_path
                 text += '<div class="warning">\n'
                 text += '<h4>File generation error:</h4>\n'
                 text += '<pre><code>'
-                text += '\n'.join(self.content) + '\n'
+                text += escape('\n'.join(self.content)) + '\n'
                 text += '</code></pre>\n'
                 text += '</div>\n\n'
                 
-        if not text:
+        if html and not text:
             if 'label' in self.options.keys():
                 label = nodes.make_id(self.options['label'])
             else:
@@ -407,23 +454,41 @@ class fig_directive(rst.Directive):
                     i = Image.open(image_path)
                     x = int(scale * i.size[0])
                     y = int(scale * i.size[1])
-                    text += '<img width="{1}px" height="{2}"px src="{0}">\n'.format(image_url, x, y)
+
+                    # Offer smaller/lighter variants when they're ready
+                    sets = srcset(image_path, image_url, i.size)
+                    sizes = '(max-width: {0}px) 100vw, {0}px'.format(x)
+                    if sets:
+                        text += '<picture>\n'
+                        if 'webp' in sets:
+                            text += '<source type="image/webp" srcset="{}" sizes="{}">\n'.format(sets['webp'], sizes)
+                    text += '<img width="{1}" height="{2}" src="{0}"'.format(image_url, x, y)
+                    ext = image_path.rsplit('.', 1)[-1].lower()
+                    if sets and ext in sets:
+                        text += ' srcset="{}" sizes="{}"'.format(sets[ext], sizes)
+                    text += ' loading="lazy">\n'
+                    if sets:
+                        text += '</picture>\n'
                 else:
-                    text += '<img src="{0}">\n'.format(image_url)
+                    text += '<img src="{0}" loading="lazy">\n'.format(image_url)
             except:
                 ext = os.path.basename(image_path).rsplit('.')[1]
                 if ext == 'mp4':
                     cmd = [FFMPEG_CMD, '-i', image_path]
-                    p = Popen(cmd,stdout=PIPE,stderr=PIPE)
-                    out, err = p.communicate()
+                    result = run(cmd, timeout=10, heavy=False)
                     
-                    m = re.search(r'Stream.*Video.*, (\d+)x(\d+)', err)
+                    m = re.search(r'Stream.*Video.*, (\d+)x(\d+)', result.stderr)
+
+                    poster = ''
+                    if os.path.exists(sysgen_path(poster_name(image_name))):
+                        poster = ' poster="{}" preload="none"'.format(sysgen_url(poster_name(image_name)))
+
                     if m:
                         x = int(scale * float(m.group(1)))
                         y = int(scale * float(m.group(2)))
-                        text += '<video width="{1}px" height="{2}px" controls><source src="{0}" type="video/mp4"></video>\n'.format(image_url, x, y)
+                        text += '<video width="{1}px" height="{2}px"{3} controls><source src="{0}" type="video/mp4"></video>\n'.format(image_url, x, y, poster)
                     else:
-                        text += '<video controls><source src="{0}" type="video/mp4"></video>\n'.format(image_url)
+                        text += '<video{1} controls><source src="{0}" type="video/mp4"></video>\n'.format(image_url, poster)
             text += '</a>\n'            
 
             if self.arguments:
@@ -431,11 +496,12 @@ class fig_directive(rst.Directive):
 
             text += '</div>\n'            
             
-        node = nodes.raw(text=text, format='html', **self.options)
-        node_list += [node]
-
-
+        if html:
+            node = nodes.raw(text=text, format='html', **self.options)
+            node_list += [node]
 
+        if not writes(settings, 'latex'):
+            return node_list
 
         
 # LaTeX writer specifics start (offset is ignored for HTML writer)
@@ -497,119 +563,131 @@ class fig_directive(rst.Directive):
         print '* Trying to build {}'.format(image_path)
 
         ext = os.path.basename(image_path).split('.')[1]
-        tempfile = '.'.join(['temp', ext])
         
         # try:
         if 1==1:
-            # Let's remember where we came from...
-            curdir = os.getcwd()
             newdir = os.path.join(WORK_PATH, type, '_')
             template_dir = os.path.normpath(os.path.join(newdir, '..'))
 
-            # Move to proper working directory for this type of content
-            os.chdir(newdir)
-            print '* Moved to work directory at {}'.format(newdir)
-            if os.path.isfile(tempfile):
-                os.remove(tempfile)
+            # Work in a private job folder within the proper working directory
+            # for this type of content (so builds can run at once; the
+            # programs are run in it, as our own cwd is shared by threads)
+            jobdir = mkdtemp(dir=newdir)
+            tempfile = os.path.join(jobdir, '.'.join(['temp', ext]))
+            posterfile = os.path.join(jobdir, 'temp.poster.png')
+            try:
+                print '* Working in {}'.format(jobdir)
                 
-            print '* Construction template = {}-{}'.format(type, template)
-            if type == 'latex':
+                print '* Construction template = {}-{}'.format(type, template)
+                results = []
+                if type == 'latex':
             
-                # Load template to memory
-                template += '.tex'
-                template_path = os.path.join(template_dir, template)
-                f = codecs.open(template_path, 'r', 'utf-8')
-                template = f.read()
-                f.close()
-                print '* Template found at {}'.format(template_path)
+                    # Load template to memory
+                    template += '.tex'
+                    template_path = os.path.join(template_dir, template)
+                    f = codecs.open(template_path, 'r', 'utf-8')
+                    template = f.read()
+                    f.close()
+                    print '* Template found at {}'.format(template_path)
                 
-                # Write the LaTeX file to the working folder
-                f = codecs.open('temp.tex', 'w', 'utf-8')
-                f.write(template % content)
-                f.close()
-
-                print '* Running LaTeX (temp.tex --> temp.pdf)'
-                cmd = os.path.join(LATEX_PATH, 'pdflatex')
-                cmd = [cmd, '--interaction=nonstopmode', 'temp.tex']
-                p = Popen(cmd,stdout=PIPE,stderr=PIPE)
-                out, err = p.communicate()
-
-                print '* Running LaTeX (temp.tex --> temp.pdf)'
-                cmd = os.path.join(LATEX_PATH, 'pdflatex')
-                cmd = [cmd, '--interaction=nonstopmode', 'temp.tex']
-                p = Popen(cmd,stdout=PIPE,stderr=PIPE)
-                out, err = p.communicate()
-
-                print '* Running Ghostscript (temp.pdf --> temp.png)'
-                cmd = [GS_COMMAND,
-                '-q',
-                '-dBATCH',
-                '-dNOPAUSE',
-                '-sDEVICE=png16m',
-                '-r600', # this number should be changed with img_scale below
-                '-dTextAlphaBits=4',
-                '-dGraphicsAlphaBits=4',
-                '-sOutputFile=temp.png',
-                'temp.pdf',
-                ]
-                p = Popen(cmd,stdout=PIPE,stderr=PIPE)
-                out, err = p.communicate()
+                    # Write the LaTeX file to the working folder
+                    f = codecs.open(os.path.join(jobdir, 'temp.tex'), 'w', 'utf-8')
+                    f.write(template % content)
+                    f.close()
+
+                    print '* Running LaTeX (temp.tex --> temp.pdf)'
+                    cmd = os.path.join(LATEX_PATH, 'pdflatex')
+                    cmd = [cmd, '--interaction=nonstopmode', 'temp.tex']
+                    env = dict(os.environ, TEXINPUTS=newdir + os.pathsep)
+                    results.append(run(cmd, cwd=jobdir, env=env))
+
+                    # (pdflatex fails on errors it recovers from, and still
+                    # writes a PDF worth keeping)
+                    if not results[-1].cut_short:
+                        print '* Running LaTeX (temp.tex --> temp.pdf)'
+                        results.append(run(cmd, cwd=jobdir, env=env))
+
+                    cmd = [GS_COMMAND,
+                    '-q',
+                    '-dBATCH',
+                    '-dNOPAUSE',
+                    '-sDEVICE=png16m',
+                    '-r600', # this number should be changed with img_scale below
+                    '-dTextAlphaBits=4',
+                    '-dGraphicsAlphaBits=4',
+                    '-sOutputFile=temp.png',
+                    'temp.pdf',
+                    ]
+                    if not results[-1].cut_short and os.path.exists(os.path.join(jobdir, 'temp.pdf')):
+                        print '* Running Ghostscript (temp.pdf --> temp.png)'
+                        results.append(run(cmd, cwd=jobdir))
                 
-                img_scale = 0.20 # not sure why, but this just "looks right"
+                    img_scale = 0.20 # not sure why, but this just "looks right"
                 
-            elif type == 'matplotlib':
+                elif type == 'matplotlib':
                 
-                # Have to have some serious protection here....
-                if '\nimport' in content:
-                    assert False
+                    # Have to have some serious protection here....
+                    if '\nimport' in content:
+                        assert False
                     
-                # Load template to memory
-                template += '.py'
-                template_path = os.path.join(template_dir, template)
-                f = codecs.open(template_path, 'r', 'utf-8')
-                template = f.read()
-                f.close()
-                print '* Template found at {}'.format(template_path)
-
-                # Write the matplotlib file to the working folder
-                f = codecs.open('temp.py', 'w', 'utf-8')
-                f.write(template % content)
-                f.close()
+                    # Load template to memory
+                    template += '.py'
+                    template_path = os.path.join(template_dir, template)
+                    f = codecs.open(template_path, 'r', 'utf-8')
+                    template = f.read()
+                    f.close()
+                    print '* Template found at {}'.format(template_path)
+
+                    # Write the matplotlib file to the working folder
+                    f = codecs.open(os.path.join(jobdir, 'temp.py'), 'w', 'utf-8')
+                    f.write(template % content)
+                    f.close()
                 
-                # Run matplotlib ...
-                cmd = [PYTHON_CMD, 'temp.py']
-                p = Popen(cmd,stdout=PIPE,stderr=PIPE)
-                out, err = p.communicate()
+                    # Run matplotlib ...
+                    cmd = [PYTHON_CMD, 'temp.py']
+                    env = dict(os.environ, FFMPEG_CMD=FFMPEG_CMD)
+                    results.append(run(cmd, cwd=jobdir, env=env))
 
-                img_scale = 0.70 # not sure why, but this just "looks right"
+                    img_scale = 0.70 # not sure why, but this just "looks right"
                 
-            else:
+                else:
             
-                type = None
-                img_scale = 1.00
-
-            if type: # then capture the file we just built            
-
-                if ext == 'png':
-                    print '* Resizing {}'.format(tempfile)
-                    img = Image.open(tempfile)
-                    x = int(img_scale * img.size[0])
-                    y = int(img_scale * img.size[1])
-                    img = img.resize((x, y), Image.ANTIALIAS)
-                    img.save(tempfile, 'png')
-
-                # Is the output folder even there?
-                d = os.path.dirname(image_path)
-                if not os.path.exists(d):
-                    os.makedirs(d)
-
-                # Finally, move the image file and clean up
-                if os.path.exists(tempfile):
-                    shutil.copyfile(tempfile, image_path)
-                    os.remove(tempfile)
-
-                print '* New file saved at {}'.format(image_path)
-                os.chdir(curdir)
+                    type = None
+                    img_scale = 1.00
+
+                for result in results:
+                    print '* {}'.format(result)
+
+                # Capture the file we just built, unless a step was cut short
+                # and it may be incomplete
+                cut_short = any(result.cut_short for result in results)
+                if type and not cut_short and os.path.exists(tempfile):
+
+                    if ext == 'png':
+                        print '* Resizing {}'.format(tempfile)
+                        img = Image.open(tempfile)
+                        x = int(img_scale * img.size[0])
+                        y = int(img_scale * img.size[1])
+                        img = img.resize((x, y), Image.ANTIALIAS)
+                        img.save(tempfile, 'png')
+
+                    # Is the output folder even there?
+                    d = os.path.dirname(image_path)
+                    if not os.path.exists(d):
+                        os.makedirs(d)
+
+                    # Finally, move the image file into place (atomically,
+                    # since another page view may be reading it)
+                    for src, dst in [(tempfile, image_path),
+                                     (posterfile, os.path.join(d, poster_name(image_path)))]:
+                        if os.path.exists(src):
+                            temp_path = '{}.{}.tmp'.format(dst, os.getpid())
+                            shutil.copyfile(src, temp_path)
+                            os.rename(temp_path, dst)
+
+                    print '* New file saved at {}'.format(image_path)
+            finally:
+                shutil.rmtree(jobdir, ignore_errors=True)
                 
         # except:
             # pass
@@ -662,7 +740,9 @@ class problem_set_directive(rst.Directive):
     * Argument will be used as a subtitle.
     * Content required. 
     * Content may mix explicit problem dictionaries with slug references
-    * Attempt to parse content as YAML then JSON. Malformed content will be returned.
+      to the problem bank (see problems.py), either bare or as a dictionary
+      with a ``slug`` and any parts to use instead of the bank's.
+    * Attempt to parse content as JSON then YAML. Malformed content will be returned.
     """
 
     required_arguments = 0
@@ -677,41 +757,8 @@ class problem_set_directive(rst.Directive):
     has_content = True
 
     def unpack(self, problem, format):
-    
-        question = problem.get('question','')
-        answer = problem.get('answer','')
-        solution = problem.get('solution','')
-
-        if not question:
-            question = ':highlight:`Question not available`'
-        if not answer:
-            answer = ':highlight:`Missing`'
-        if not solution:
-            solution = ':highlight:`No solution available`'
-        
-        if format == 'html':
-            writer = rst2html
-            kwargs = {'inline': True}
-        elif format == 'latex':
-            writer = rst2latex
-            kwargs = {}
-        else:
-            writer = None
-            kwargs = {}
-
-        def write_part(part, writer=None, kwargs={}):
-            if writer:
-                part = part.strip()
-                if part[0] == '(': part = '\\' + part
-                return writer(part, **kwargs)
-            else:
-                return part
-            
-        question = write_part(question, writer, kwargs)
-        answer = write_part(answer, writer, kwargs)
-        solution = write_part(solution, writer, kwargs)
-            
-        return question, answer, solution        
+        # bank problems come pre-rendered
+        return problems.render(problem, format)
         
     def run(self):
 
@@ -754,16 +801,15 @@ class problem_set_directive(rst.Directive):
             
         node_list = []
 
-        for load in [yaml.load, json.loads]:
-            try:
-                problem_set = load(content)
-            except:
-                problem_set = []
-            if problem_set: break
+        problem_set = problems.parse(content) or []
+
+        # Only the output being written is made (and its problems rendered)
+        settings = self.state.document.settings
+        html = writes(settings, 'html')
                 
         # HTML writer specifics start...
         
-        if problem_set:
+        if problem_set and html:
             text = ''
             
             if caption:
@@ -776,11 +822,21 @@ class problem_set_directive(rst.Directive):
                     # ERROR: not sure why this markup does not seem to catch for list_start > 1 ...
                     text += '<ol start="{:02}" class="inside-list">\n'.format(list_start)
 
+            # toggle ids come from the problem set and where it is, so the
+            # same source always renders the same: its line, and the section
+            # it is in (lines count from the start of the part when a page
+            # is rendered section by section, see sections.py)
+            section = self.state.parent
+            while section is not None and not isinstance(section, nodes.section):
+                section = section.parent
+            where = ' '.join(section['ids']) if section is not None else ''
+            set_id = hashlib.md5('{}:{}:{}'.format(where, self.lineno, content).encode('utf-8')).hexdigest()[:9]
+
             n = list_start - 1
             for problem in problem_set:
                 n += 1
                 q, a, s = self.unpack(problem, format='html')
-                toggle_id = '{:09}'.format(random.randrange(0,1e9))
+                toggle_id = '{}-{}'.format(set_id, n)
 
                 if numbering: 
                     text += '<li>\n'
@@ -820,11 +876,15 @@ class problem_set_directive(rst.Directive):
                     text += '</ul>\n'
                 else:
                     text += '</ol>\n'
-        else:
+        elif html:
             text = '<pre>Malformed input\n\n{}</pre>'.format(content)
 
-        node = nodes.raw(text=text, format='html', **self.options)
-        node_list += [node]
+        if html:
+            node = nodes.raw(text=text, format='html', **self.options)
+            node_list += [node]
+
+        if not writes(settings, 'latex'):
+            return node_list
 
         # LaTeX writer specifics
         
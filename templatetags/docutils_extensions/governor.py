@@ -0,0 +1,240 @@
+from __future__ import division
+from __future__ import unicode_literals
+
+import codecs
+import errno
+import fcntl
+import json
+import math
+import os
+import threading
+import time
+
+from config import *
+from profiling import record
+
+## -------------------------------------------------------------------------- ##
+
+# Admission control for heavy work: compiling PDFs, building figures. Each
+# kind of work has GOVERNOR_SLOTS[kind] slots per host. Whoever wants one
+# takes a ticket and waits in line; tickets are served strictly in order,
+# so nobody is overtaken by a luckier poller. Requests that would wait too
+# long (more than GOVERNOR_WAIT seconds, or behind GOVERNOR_QUEUE others)
+# get Saturated instead, which views turn into a 503 with Retry-After.
+#
+# The line and the slots are kept in a JSON file per kind, under an flock,
+# so they are shared by every process on the host. Tickets of processes
+# that died are dropped. The same file keeps the numbers: how many were
+# admitted, turned away or timed out, how long they waited, and how long
+# the work took. Designed to be run from shell::
+#
+#     >>> from wiki.templatetags.docutils_extensions import governor
+#     >>> governor.status()
+
+POLL_INTERVAL = 0.1
+
+# Assumed length of a job before any has been timed (seconds)
+DEFAULT_SERVICE = 10.0
+
+_local = threading.local()
+
+
+class Saturated(Exception):
+
+    def __init__(self, kind, retry_after):
+        Exception.__init__(self, 'Too much {} work queued'.format(kind))
+        self.kind = kind
+        self.retry_after = retry_after
+
+
+class patient(object):
+    '''
+    Context manager for background work (e.g. jobs): heavy work within it
+    waits for its turn however long that takes, rather than giving up.
+    '''
+
+    def __enter__(self):
+        self.was = getattr(_local, 'patient', False)
+        _local.patient = True
+        return self
+
+    def __exit__(self, *args):
+        _local.patient = self.was
+
+
+def is_patient():
+    return getattr(_local, 'patient', False)
+
+## -------------------------------------------------------------------------- ##
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def state_path(kind):
+    return os.path.join(GOVERNOR_PATH, '{}.json'.format(kind))
+
+
+def empty_state():
+    return {
+        'next'      : 0,
+        'waiting'   : [], # [ticket, pid, since], in line
+        'running'   : [], # [ticket, pid, since]
+        'stats'     : {
+            'admitted'  : 0,
+            'rejected'  : 0,
+            'timed_out' : 0,
+            'waited'    : 0.0,  # total seconds waited by those admitted
+            'max_wait'  : 0.0,
+            'max_depth' : 0,
+            'served'    : 0,
+            'service'   : None, # moving average of the work's duration
+        },
+    }
+
+
+class State(object):
+    '''
+    Context manager holding the lock on the state of a kind of work, and
+    giving the state (saved on the way out, whatever happens).
+    '''
+
+    def __init__(self, kind):
+        self.kind = kind
+
+    def __enter__(self):
+        if not os.path.isdir(GOVERNOR_PATH):
+            try:
+                os.makedirs(GOVERNOR_PATH)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self.lock = open(state_path(self.kind) + '.lock', 'a')
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        try:
+            f = codecs.open(state_path(self.kind), 'r', 'utf-8')
+            self.state = json.loads(f.read())
+            f.close()
+        except (IOError, ValueError):
+            self.state = empty_state()
+        for line in ['waiting', 'running']:
+            self.state[line] = [t for t in self.state[line] if alive(t[1])]
+        return self.state
+
+    def __exit__(self, *args):
+        temp_path = '{}.{}.tmp'.format(state_path(self.kind), os.getpid())
+        f = codecs.open(temp_path, 'w', 'utf-8')
+        f.write(json.dumps(self.state))
+        f.close()
+        os.rename(temp_path, state_path(self.kind))
+        fcntl.flock(self.lock, fcntl.LOCK_UN)
+        self.lock.close()
+
+
+def retry_after(state, slots):
+    '''
+    Seconds until a request turned away now might get in: the time to work
+    through the line ahead of it.
+    '''
+    service = state['stats']['service'] or DEFAULT_SERVICE
+    return max(1, int(math.ceil(service * (len(state['waiting']) + 1) / max(slots, 1))))
+
+
+def saturated(kind):
+    '''
+    Returns Saturated for a kind of work waited on elsewhere (e.g. on
+    another node), with the time to work through our own line as the
+    guess at when to try again.
+    '''
+    with State(kind) as state:
+        return Saturated(kind, retry_after(state, GOVERNOR_SLOTS.get(kind, 1)))
+
+## -------------------------------------------------------------------------- ##
+
+class admit(object):
+    '''
+    Context manager holding a slot for a kind of work ('pdf', 'figure')
+    while it runs. Raises Saturated if it can't get one in time.
+    '''
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.slots = GOVERNOR_SLOTS.get(kind, 1)
+
+    def __enter__(self):
+        patient = is_patient()
+        start = time.time()
+        with State(self.kind) as state:
+            if not patient and len(state['waiting']) >= GOVERNOR_QUEUE:
+                state['stats']['rejected'] += 1
+                raise Saturated(self.kind, retry_after(state, self.slots))
+            self.ticket = state['next']
+            state['next'] += 1
+            state['waiting'].append([self.ticket, os.getpid(), start])
+            state['stats']['max_depth'] = max(state['stats']['max_depth'], len(state['waiting']))
+
+        while True:
+            with State(self.kind) as state:
+                free = self.slots - len(state['running'])
+                if self.ticket in [t[0] for t in state['waiting'][:max(free, 0)]]:
+                    self.start = time.time()
+                    waited = self.start - start
+                    state['waiting'] = [t for t in state['waiting'] if t[0] != self.ticket]
+                    state['running'].append([self.ticket, os.getpid(), self.start])
+                    stats = state['stats']
+                    stats['admitted'] += 1
+                    stats['waited'] += waited
+                    stats['max_wait'] = max(stats['max_wait'], waited)
+                    record('governor.{}.wait'.format(self.kind), waited)
+                    return self
+                if not patient and time.time() - start > GOVERNOR_WAIT:
+                    state['waiting'] = [t for t in state['waiting'] if t[0] != self.ticket]
+                    state['stats']['timed_out'] += 1
+                    record('governor.{}.wait'.format(self.kind), time.time() - start)
+                    raise Saturated(self.kind, retry_after(state, self.slots))
+            time.sleep(POLL_INTERVAL)
+
+    def __exit__(self, *args):
+        with State(self.kind) as state:
+            state['running'] = [t for t in state['running'] if t[0] != self.ticket]
+            stats = state['stats']
+            duration = time.time() - self.start
+            stats['served'] += 1
+            if stats['service'] is None:
+                stats['service'] = duration
+            else:
+                stats['service'] = 0.8 * stats['service'] + 0.2 * duration
+
+
+def governed(kind, fn):
+    '''
+    Returns fn, run in one of the slots for the kind of work.
+    '''
+    def wrapper(*args, **kwargs):
+        with admit(kind):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def status():
+    '''
+    Designed to be run from shell.
+    Returns, for each kind of work, the queue depth, the number running,
+    and the numbers kept so far (with the mean wait of those admitted).
+    '''
+    report = {}
+    for kind in GOVERNOR_SLOTS:
+        with State(kind) as state:
+            stats = dict(state['stats'])
+            stats['mean_wait'] = stats['waited'] / stats['admitted'] if stats['admitted'] else 0.0
+            report[kind] = {
+                'slots'     : GOVERNOR_SLOTS[kind],
+                'waiting'   : len(state['waiting']),
+                'running'   : len(state['running']),
+                'stats'     : stats,
+            }
+    return report
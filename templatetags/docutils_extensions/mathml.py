@@ -0,0 +1,186 @@
+from __future__ import division
+from __future__ import unicode_literals
+
+import hashlib
+import re
+
+from django.core.cache import cache
+
+from config import *
+
+## -------------------------------------------------------------------------- ##
+
+# With WIKI_MATH_OUTPUT = 'MathML', math is converted to MathML as pages are
+# rendered, so that readers needn't wait for MathJax. docutils' converter
+# knows less LaTeX than MathJax does: whatever it can't convert is left to
+# MathJax as before, and only pages left with such math load MathJax.
+
+# Our MathJax macros (see mathjax.html) as (body, number of arguments)
+MACROS = {
+    'implies'   : (r'\Rightarrow', 0),
+    'half'      : (r'{\tfrac{1}{2}}', 0),
+    'dg'        : (r'{^\circ}', 0),
+    'unit'      : (r'{\text{ #1}}', 1),
+    'vect'      : (r'{\boldsymbol{#1}}', 1),
+    'vhat'      : (r'{\hat{\boldsymbol{#1}}}', 1),
+    'vmag'      : (r'{\text{mag} \vect{#1}}', 1),
+    'vang'      : (r'{\text{ang} \vect{#1}}', 1),
+    'sci'       : (r'{#1 \times 10^{#2}}', 2),
+    'abs'       : (r'{\left\vert #1 \right\vert}', 1),
+    'avg'       : (r'{\langle #1 \rangle}', 1),
+    'Avg'       : (r'{\left \langle #1 \right \rangle}', 1),
+    'pd'        : (r'{\frac{\partial{#1}}{\partial{#2}}}', 2),
+    'pdd'       : (r'{\frac{\partial{#1}^2}{\partial{#2}^2}}', 2),
+    'tpd'       : (r'{\partial{#1} / \partial{#2}}', 2),
+    'tpdd'      : (r'{\partial{#1}^2 / \partial{#2}^2}', 2),
+    'real'      : (r'{\text{Re}}', 0),
+    'grad'      : (r'{\nabla}', 0),
+    'vdiv'      : (r'{\nabla \cdot}', 0),
+    'curl'      : (r'{\nabla \times}', 0),
+    'bra'       : (r'{\langle #1 \vert}', 1),
+    'ket'       : (r'{\vert #1 \rangle}', 1),
+    'braket'    : (r'{\langle #1 \vert #2 \rangle}', 2),
+    'd'         : (r'{\; d}', 0),
+    'L'         : (r'{\mathcal{L}}', 0),
+    'H'         : (r'{\mathcal{H}}', 0),
+    'A'         : (r'{\mathcal{A}}', 0),
+    'M'         : (r'{\mathcal{M}}', 0),
+    'D'         : (r'{\mathcal{D}}', 0),
+    'S'         : (r'{\mathcal{S}}', 0),
+    'O'         : (r'{\mathcal{O}}', 0),
+}
+
+# LaTeX the converter doesn't know, but has a near enough equivalent for
+REWRITES = [
+    (re.compile(r'\\[td]frac(?![a-zA-Z])'), r'\\frac'),
+    (re.compile(r'\\boldsymbol(?![a-zA-Z])'), r'\\mathbf'),
+    (re.compile(r'\\(;|:|quad|qquad)(?![a-zA-Z])'), r'\\,'),
+    (re.compile(r'\\[Bb]igg?[lr]?(?![a-zA-Z])'), r''),
+    (re.compile(r'\\(left|right)\s*\\vert(?![a-zA-Z])'), r'\\\1|'),
+]
+
+COMMAND = re.compile(r'\\([a-zA-Z]+)')
+
+MATHML_CACHE_TIMEOUT = 30 * 24 * 60 * 60
+
+# Converted expressions, also kept in process (up to MEMO_SIZE of them)
+memo = {}
+MEMO_SIZE = 10000
+
+
+def argument(latex, i):
+    '''
+    Returns (argument, index past it) for the macro argument at latex[i:].
+    '''
+    while i < len(latex) and latex[i].isspace():
+        i += 1
+    if i >= len(latex):
+        raise SyntaxError('Missing argument')
+    if latex[i] != '{':
+        return latex[i], i + 1
+    depth = 0
+    for j in range(i, len(latex)):
+        if latex[j] == '{':
+            depth += 1
+        elif latex[j] == '}':
+            depth -= 1
+            if depth == 0:
+                return latex[i + 1:j], j + 1
+    raise SyntaxError('Missing right-brace')
+
+
+def expand_macros(latex, depth=0):
+    if depth > 10:
+        raise SyntaxError('Macros nested too deeply')
+    result = []
+    i = 0
+    for m in COMMAND.finditer(latex):
+        if m.start() < i or m.group(1) not in MACROS:
+            continue
+        body, count = MACROS[m.group(1)]
+        result.append(latex[i:m.start()])
+        i = m.end()
+        for n in range(count):
+            arg, i = argument(latex, i)
+            body = body.replace('#{}'.format(n + 1), arg)
+        result.append(expand_macros(body, depth + 1))
+    result.append(latex[i:])
+    return ''.join(result)
+
+
+def escape_text(node):
+    '''
+    Escapes the text in the converter's tree, which it writes out as it is
+    (``\\text{a<b}`` would otherwise be markup in the page).
+    '''
+    from xml.sax.saxutils import escape
+
+    if hasattr(node, 'text'): # mtext
+        node.text = escape(node.text)
+    elif hasattr(node, 'data'): # mi, mn, mo
+        node.data = escape(node.data)
+    for child in getattr(node, 'children', []):
+        escape_text(child)
+
+
+def convert(latex, display=False):
+    '''
+    Returns the MathML for the LaTeX math, or None if it can't be converted.
+    '''
+    from docutils.utils.math.latex2mathml import parse_latex_math
+
+    try:
+        latex = expand_macros(latex)
+        for pattern, repl in REWRITES:
+            latex = pattern.sub(repl, latex)
+        tree = parse_latex_math(latex, inline=not display)
+        escape_text(tree)
+        mathml = ''.join(tree.xml())
+        return mathml.replace(' mode="display"', ' display="block"') # as browsers expect
+    except Exception: # SyntaxError mostly, but the converter isn't robust
+        return None
+
+
+def to_mathml(latex, display=False):
+    '''
+    Same as convert(), cached per expression.
+    '''
+    key = '|'.join([latex, repr(display)])
+    if key in memo:
+        return memo[key] or None
+
+    # (keyed anew since conversions are escaped, see escape_text)
+    cache_key = 'wiki-mathml-escaped:{}'.format(hashlib.md5(key.encode('utf-8')).hexdigest())
+    mathml = cache.get(cache_key)
+    if mathml is None:
+        mathml = convert(latex, display) or ''
+        cache.set(cache_key, mathml, MATHML_CACHE_TIMEOUT)
+
+    if len(memo) >= MEMO_SIZE:
+        memo.clear()
+    memo[key] = mathml
+    return mathml or None
+
+
+def math_output(settings):
+    return getattr(settings, 'wiki_math_output', 'MathJax')
+
+
+def inline_html(latex, settings):
+    '''
+    Returns the HTML for inline math made by roles: MathML if the document
+    is rendered with WIKI_MATH_OUTPUT = 'MathML' and the math converts, else
+    the LaTeX for MathJax.
+    '''
+    if math_output(settings) == 'MathML':
+        mathml = to_mathml(latex)
+        if mathml:
+            return mathml
+    return r'\(%s\)' % latex
+
+
+def needs_mathjax(html):
+    '''
+    Whether rendered HTML still has math for MathJax to typeset.
+    '''
+    return any(delimiter in html for delimiter in [r'\(', r'\[', r'\begin{', '$$'])
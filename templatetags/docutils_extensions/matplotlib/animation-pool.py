@@ -0,0 +1,79 @@
+"""
+Matplotlib Animation, rendered in parallel
+
+Same content as the ``animation`` template, but frames are drawn by a pool of
+worker processes and streamed, in order, into a single ffmpeg encoder.
+
+Each worker forks with its own copy of everything defined by the content, so
+``animate(i)`` must depend only on ``i`` (not on state left by earlier frames).
+The content may override ``frames``, ``fps`` and ``workers``.
+"""
+
+from __future__ import division
+
+import os
+import subprocess
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+from numpy import sin, cos
+
+from scipy import integrate
+from scipy.fftpack import fft,ifft
+from scipy.spatial.distance import pdist, squareform
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib import pyplot as plt
+from matplotlib import animation
+
+fig = plt.figure()
+
+frames = 200
+fps = 30
+workers = cpu_count()
+chunk_size = 10
+
+%s
+
+def render(chunk):
+    init()
+    buffers = []
+    for i in chunk:
+        animate(i)
+        fig.canvas.draw()
+        buffers.append(fig.canvas.tostring_rgb())
+    return buffers
+
+width, height = fig.canvas.get_width_height()
+
+cmd = [
+    os.environ.get('FFMPEG_CMD', 'ffmpeg'), '-y',
+    '-f', 'rawvideo',
+    '-vcodec', 'rawvideo',
+    '-s', '{}x{}'.format(width, height),
+    '-pix_fmt', 'rgb24',
+    '-r', str(fps),
+    '-i', '-',
+    '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2', # libx264 wants even sizes
+    '-vcodec', 'libx264',
+    '-pix_fmt', 'yuv420p',
+    'temp.mp4',
+]
+encoder = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+chunks = [range(i, min(i + chunk_size, frames)) for i in range(0, frames, chunk_size)]
+pool = Pool(workers)
+for buffers in pool.imap(render, chunks):
+    for buffer in buffers:
+        encoder.stdin.write(buffer)
+pool.close()
+pool.join()
+
+encoder.stdin.close()
+encoder.wait()
+
+# Poster frame, shown until the video loads
+init()
+animate(0)
+plt.savefig('temp.poster.png')
@@ -26,3 +26,8 @@ fig = plt.figure()
 
 ani = animation.FuncAnimation(fig, animate, init_func=init, frames=200, interval=20, blit=True)
 ani.save('temp.mp4', fps=30, extra_args=['-vcodec', 'libx264', '-pix_fmt', 'yuv420p'])
+
+# Poster frame, shown until the video loads
+init()
+animate(0)
+plt.savefig('temp.poster.png')
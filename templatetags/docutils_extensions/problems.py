@@ -0,0 +1,228 @@
+from __future__ import division
+from __future__ import unicode_literals
+
+import codecs
+import json
+import os
+
+from config import *
+from utils import rst2html
+from utils import rst2latex
+
+## -------------------------------------------------------------------------- ##
+
+# The problem bank: problems kept once, in YAML (or JSON) files anywhere
+# below PROBLEM_BANK_PATH, and referenced by slug from problem-set
+# directives. Each file holds one problem or a list of them, each with a
+# slug (by default the file's name, and its position in the list).
+#
+# index() reads the bank and renders every problem's parts to HTML and
+# LaTeX once, into an index file. Looking a problem up then costs one
+# dictionary access; the index is reloaded when its file changes. Run
+# index() again after editing the bank (it only re-reads changed files).
+
+INDEX_NAME = '.index.json'
+BANK_EXTENSIONS = ['.yaml', '.yml', '.json']
+
+# The index as last loaded: {'mtime': ..., 'problems': {slug: entry}}
+loaded = {'mtime': None, 'problems': {}}
+
+
+def parse(text):
+    '''
+    Returns the problems in JSON or YAML text (JSON first, as it is the
+    quicker to try), as a list, or None if there are none.
+    '''
+    try:
+        data = json.loads(text)
+    except ValueError:
+        import yaml
+
+        try:
+            data = yaml.load(text, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+        except yaml.YAMLError:
+            return None
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list) or not data:
+        return None
+    return data
+
+## -------------------------------------------------------------------------- ##
+
+def write_part(part, format):
+    part = '{}'.format(part).strip()
+    if part[0] == '(': part = '\\' + part
+    if format == 'html':
+        return rst2html(part, inline=True)
+    elif format == 'latex':
+        return rst2latex(part)
+    return part
+
+
+def render_problem(problem, format):
+    '''
+    Returns the problem's question, answer and solution, in the format.
+    '''
+    question = problem.get('question','')
+    answer = problem.get('answer','')
+    solution = problem.get('solution','')
+
+    if not question:
+        question = ':highlight:`Question not available`'
+    if not answer:
+        answer = ':highlight:`Missing`'
+    if not solution:
+        solution = ':highlight:`No solution available`'
+
+    return tuple(write_part(part, format) for part in [question, answer, solution])
+
+
+def render(item, format):
+    '''
+    Returns (question, answer, solution) for an item of a problem set: a
+    problem, a slug, or {'slug': ...} with parts to use instead of the
+    bank's. Pre-rendered parts are used when the bank has them.
+    '''
+    if isinstance(item, basestring):
+        item = {'slug': item}
+    if not isinstance(item, dict):
+        item = {'question': '{}'.format(item)}
+    if 'slug' not in item:
+        return render_problem(item, format)
+
+    entry = lookup(item['slug'])
+    if entry is None:
+        return render_problem({'question': ':highlight:`Unknown problem: {}`'.format(item['slug'])}, format)
+
+    overrides = dict((k, v) for k, v in item.items() if k != 'slug')
+    if not overrides and format in entry and entry.get('math_output') == MATH_OUTPUT:
+        return tuple(entry[format])
+    problem = dict(entry['problem'])
+    problem.update(overrides)
+    return render_problem(problem, format)
+
+## -------------------------------------------------------------------------- ##
+
+def index_path():
+    return os.path.join(PROBLEM_BANK_PATH, INDEX_NAME)
+
+
+def bank_files():
+    for root, dirs, files in os.walk(PROBLEM_BANK_PATH):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for name in sorted(files):
+            if name.startswith('.'): # e.g. the index itself
+                continue
+            if os.path.splitext(name)[1].lower() in BANK_EXTENSIONS:
+                yield os.path.join(root, name)
+
+
+def read_index():
+    try:
+        f = codecs.open(index_path(), 'r', 'utf-8')
+    except IOError:
+        return None
+    data = json.loads(f.read())
+    f.close()
+    return data
+
+
+def index(force=False, verbose=False):
+    '''
+    Designed to be run from shell.
+    (Re)builds the bank's index. Only the files changed since the last
+    time are read and rendered again, unless ``force``. Returns the number
+    of problems indexed.
+    '''
+    old = None if force else read_index()
+    if old and old.get('math_output') != MATH_OUTPUT:
+        old = None
+    old_files = old['files'] if old else {}
+    old_problems = old['problems'] if old else {}
+
+    files = {}
+    problems = {}
+    for path in bank_files():
+        name = os.path.relpath(path, PROBLEM_BANK_PATH)
+        st = os.stat(path)
+        signature = [st.st_mtime, st.st_size]
+
+        if old_files.get(name, {}).get('signature') == signature:
+            files[name] = old_files[name]
+            for slug in files[name]['slugs']:
+                problems[slug] = old_problems[slug]
+            continue
+
+        if verbose:
+            print('Indexing: ', name)
+        f = codecs.open(path, 'r', 'utf-8')
+        items = parse(f.read()) or []
+        f.close()
+
+        slugs = []
+        stem = os.path.splitext(name)[0].replace(os.sep, '/')
+        for i, problem in enumerate(items):
+            if not isinstance(problem, dict):
+                continue
+            slug = '{}'.format(problem.get('slug') or (stem if len(items) == 1 else '{}-{}'.format(stem, i + 1)))
+            if slug in problems:
+                print('Duplicate problem slug: ', slug, name)
+            problems[slug] = {
+                'problem'       : problem,
+                'file'          : name,
+                'math_output'   : MATH_OUTPUT,
+                'html'          : render_problem(problem, 'html'),
+                'latex'         : render_problem(problem, 'latex'),
+            }
+            slugs.append(slug)
+        files[name] = {'signature': signature, 'slugs': slugs}
+
+    data = {
+        'math_output'   : MATH_OUTPUT,
+        'files'         : files,
+        'problems'      : problems,
+    }
+    if not os.path.isdir(PROBLEM_BANK_PATH):
+        os.makedirs(PROBLEM_BANK_PATH)
+    temp_path = '{}.{}.tmp'.format(index_path(), os.getpid())
+    f = codecs.open(temp_path, 'w', 'utf-8')
+    f.write(json.dumps(data))
+    f.close()
+    os.rename(temp_path, index_path())
+    return len(problems)
+
+
+def lookup(slug):
+    '''
+    Returns the bank's entry for the slug, or None. The bank is indexed
+    on first use if it hasn't been already.
+    '''
+    try:
+        mtime = os.path.getmtime(index_path())
+    except OSError:
+        if not os.path.isdir(PROBLEM_BANK_PATH):
+            return None
+        index()
+        mtime = os.path.getmtime(index_path())
+
+    if mtime != loaded['mtime']:
+        data = read_index() or {}
+        loaded['problems'] = data.get('problems', {})
+        loaded['mtime'] = mtime
+    return loaded['problems'].get(slug)
+
+
+def version(source):
+    '''
+    Returns the version of the bank that rendering the source depends on:
+    the index's mtime if the source has a problem set (which may take
+    problems from the bank), else None. Whatever caches rendered pages
+    keys on it, so that they follow the bank when it is indexed again.
+    '''
+    if 'problem-set::' not in source:
+        return None
+    try:
+        return os.path.getmtime(index_path())
+    except OSError:
+        return None
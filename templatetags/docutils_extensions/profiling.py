@@ -0,0 +1,126 @@
+from __future__ import division
+from __future__ import unicode_literals
+
+import functools
+import threading
+import time
+
+## -------------------------------------------------------------------------- ##
+
+# Opt-in timing of the rendering pipeline. Nothing is recorded unless
+# profiling has been started in the current thread (see the middleware),
+# so the timers cost next to nothing otherwise.
+#
+# Timings are inclusive: "docutils.read" contains the directives and roles
+# run while parsing, a "tbl" directive contains the rst2latex calls for its
+# cells, and so on. A timer nested inside another of the same name (e.g.
+# rst2html called from within a directive) adds to the call count only.
+
+_local = threading.local()
+
+def start():
+    _local.timings = {}
+    _local.running = set()
+
+
+def stop():
+    '''
+    Stops profiling in this thread and returns {name: [calls, seconds]}.
+    '''
+    timings = getattr(_local, 'timings', None)
+    _local.timings = None
+    _local.running = None
+    return timings or {}
+
+
+def active():
+    return getattr(_local, 'timings', None) is not None
+
+
+def record(name, seconds, calls=1):
+    if active():
+        entry = _local.timings.setdefault(name, [0, 0.0])
+        entry[0] += calls
+        entry[1] += seconds
+
+
+class timer(object):
+    '''
+    Context manager adding the time spent within it to ``name``.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.outer = active() and self.name not in _local.running
+        if self.outer:
+            _local.running.add(self.name)
+        self.start = time.time()
+
+    def __exit__(self, *args):
+        if self.outer:
+            _local.running.discard(self.name)
+            record(self.name, time.time() - self.start)
+        else:
+            record(self.name, 0.0)
+
+
+def timed(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+## -------------------------------------------------------------------------- ##
+
+def timed_directive(name, directive):
+    '''
+    Returns a subclass of ``directive`` whose runs are timed.
+    '''
+    class TimedDirective(directive):
+        def run(self):
+            with timer('directive.{}'.format(name)):
+                return directive.run(self)
+
+    TimedDirective.__name__ = directive.__name__
+    return TimedDirective
+
+
+def timed_role(name, role):
+    return timed('role.{}'.format(name))(role)
+
+## -------------------------------------------------------------------------- ##
+
+def publish_parts(source, writer=None, writer_name='pseudoxml', settings_overrides=None):
+    '''
+    Same as docutils.core.publish_parts, but timing the read (parse),
+    transform and write phases while profiling.
+    '''
+    from docutils import core, io
+
+    if not active():
+        return core.publish_parts(
+            source=source,
+            writer=writer,
+            writer_name=writer_name,
+            settings_overrides=settings_overrides,
+        )
+
+    pub = core.Publisher(
+        writer=writer,
+        source_class=io.StringInput,
+        destination_class=io.StringOutput,
+    )
+    pub.set_components('standalone', 'restructuredtext', writer_name)
+    pub.process_programmatic_settings(None, settings_overrides, None)
+    pub.set_source(source, None)
+    pub.set_destination(None, None)
+    pub.reader.read = timed('docutils.read')(pub.reader.read)
+    pub.apply_transforms = timed('docutils.transform')(pub.apply_transforms)
+    pub.writer.write = timed('docutils.write')(pub.writer.write)
+    pub.publish()
+    return pub.writer.parts
@@ -4,6 +4,20 @@ from __future__ import unicode_literals
 from docutils import nodes
 
 from config import *
+from mathml import inline_html
+from mathml import math_output
+from utils import writes
+
+## -------------------------------------------------------------------------- ##
+
+def raw_nodes(inliner, **texts):
+    '''
+    Returns raw nodes with the texts given by format, for the formats the
+    document is being written to.
+    '''
+    settings = inliner.document.settings
+    return [nodes.raw(text=texts[format], format=format)
+            for format in ['latex', 'html'] if writes(settings, format)]
 
 ## -------------------------------------------------------------------------- ##
 
@@ -32,24 +46,23 @@ def sci_role(role, rawtext, text, lineno, inliner, options={}, content=[]):
     * Works only for ``latex`` and ``html`` writers ...
     """
 
+    html = text
     try:
         n = text.lower().split('e')
         a = float(n[0]) # just want to make sure it's a legit number
         a = n[0]        # make sure to take the abscissa as given
         b = int(n[1])   # must be an integer, this will drop the plus sign
         if a == '1':
-            text = r'\(10^{%s}\)' % b
+            math = r'10^{%s}' % b
         else:
-            text = r'\(%s \times 10^{%s}\)' % (a, b)
+            math = r'%s \times 10^{%s}' % (a, b)
+        text = r'\(%s\)' % math
+        if writes(inliner.document.settings, 'html'):
+            html = inline_html(math, inliner.document.settings) # MathML or MathJax
     except:
         pass
 
-    node_list = [
-        nodes.raw(text=text, format='latex'),
-        nodes.raw(text=text, format='html'), # this pushes the work to MathJax
-    ]
-
-    return node_list, []
+    return raw_nodes(inliner, latex=text, html=html), []
 
 ## -------------------------------------------------------------------------- ##
 
@@ -202,6 +215,7 @@ def atm_role(role, rawtext, text, lineno, inliner, options={}, content=[]):
         'electron'  : ('e', 0, -1),
     }
 
+    html = text
     try:
         if text in specials:
             symbol, a, z = specials[text]
@@ -217,15 +231,19 @@ def atm_role(role, rawtext, text, lineno, inliner, options={}, content=[]):
             text = r'\({}^{\phantom{%s}%s}_{%s}\text{%s}\)' % (-offset, a, z, symbol)
         else:
             text = r'\({}^{%s}_{%s}\text{%s}\)' % (a, z, symbol)
+        html = text # this pushes the work to MathJax
+
+        if writes(inliner.document.settings, 'html') and math_output(inliner.document.settings) == 'MathML':
+            # prescripts line up by themselves, no need for phantoms
+            html = (
+                '<math xmlns="http://www.w3.org/1998/Math/MathML"><mmultiscripts>'
+                '<mtext>%s</mtext><none/><none/><mprescripts/><mn>%s</mn><mn>%s</mn>'
+                '</mmultiscripts></math>' % (symbol, z, a)
+            )
     except:
         pass
 
-    node_list = [
-        nodes.raw(text=text, format='latex'),
-        nodes.raw(text=text, format='html'), # this pushes the work to MathJax
-    ]
-
-    return node_list, []
+    return raw_nodes(inliner, latex=text, html=html), []
 
 ## -------------------------------------------------------------------------- ##
 
@@ -329,12 +347,7 @@ def jargon_role(role, rawtext, text, lineno, inliner, options={}, content=[]):
         t['latex'] = r'\textbf{%s}\index{%s}' % (text,text)
         t['html'] = '<strong>%s</strong>' % text
 
-    node_list = [
-        nodes.raw(text=t['latex'], format='latex'),
-        nodes.raw(text=t['html'], format='html')
-    ]
-
-    return node_list, []
+    return raw_nodes(inliner, **t), []
 
 # -------------------------------------------------------------------------- ##
 
@@ -353,9 +366,4 @@ def highlight_role(role, rawtext, text, lineno, inliner, options={}, content=[])
     t['latex'] = '\\underline{{{}}}'.format(text)
     t['html'] = '<span class="highlight">{}</span>'.format(text)
 
-    node_list = [
-        nodes.raw(text=t['latex'], format='latex'),
-        nodes.raw(text=t['html'], format='html')
-    ]
-
-    return node_list, []
+    return raw_nodes(inliner, **t), []
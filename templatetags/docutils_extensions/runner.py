@@ -0,0 +1,160 @@
+from __future__ import division
+from __future__ import unicode_literals
+
+import errno
+import fcntl
+import os
+import resource
+import signal
+import threading
+import time
+
+from subprocess import Popen, PIPE
+
+import governor
+from config import *
+from profiling import record
+
+## -------------------------------------------------------------------------- ##
+
+# Every external program (pdflatex, makeindex, gs, ffmpeg, python) is run
+# through run(), which
+#
+# - starts it in a process group of its own, so that on timeout everything
+#   it spawned (e.g. the workers of a parallel animation) is killed with it
+# - caps its address space, so a runaway script fails rather than swapping
+# - gives it an empty stdin, so a LaTeX document waiting for input fails
+# - holds one of RUNNER_SLOTS per-host slots while a heavy job runs
+
+class Result(object):
+
+    def __init__(self, cmd, returncode=None, stdout='', stderr='', duration=0.0, timed_out=False, no_slot=False):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration
+        self.timed_out = timed_out
+        self.no_slot = no_slot # never started, for want of a slot
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.cut_short
+
+    @property
+    def cut_short(self):
+        '''
+        Whether the job didn't run its course (so whatever it left behind
+        may be incomplete).
+        '''
+        return self.timed_out or self.no_slot
+
+    def __repr__(self):
+        if self.no_slot:
+            status = 'no free slot'
+        elif self.timed_out:
+            status = 'timed out'
+        else:
+            status = 'exit status {}'.format(self.returncode)
+        return '<Result {}: {} after {:.1f}s>'.format(os.path.basename(self.cmd[0]), status, self.duration)
+
+
+def limits(memory):
+    def preexec():
+        os.setsid()
+        if memory:
+            resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    return preexec
+
+## -------------------------------------------------------------------------- ##
+
+class slot(object):
+    '''
+    Context manager holding one of the per-host slots for heavy jobs, waiting
+    at most ``timeout`` seconds for one to come free. ``acquired`` tells
+    whether it did (light jobs always go ahead, without a slot).
+    '''
+
+    def __init__(self, timeout, heavy=True):
+        self.timeout = timeout
+        self.heavy = heavy
+        self.lock = None
+
+    def __enter__(self):
+        if not self.heavy:
+            return self
+
+        if not os.path.isdir(RUNNER_LOCK_PATH):
+            try:
+                os.makedirs(RUNNER_LOCK_PATH)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        deadline = time.time() + self.timeout
+        while True:
+            for i in range(RUNNER_SLOTS):
+                f = open(os.path.join(RUNNER_LOCK_PATH, 'slot-{}'.format(i)), 'a')
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    self.lock = f
+                    return self
+                except IOError:
+                    f.close()
+            if time.time() > deadline:
+                return self
+            time.sleep(0.1)
+
+    def __exit__(self, *args):
+        if self.lock is not None:
+            fcntl.flock(self.lock, fcntl.LOCK_UN)
+            self.lock.close()
+            self.lock = None
+
+    @property
+    def acquired(self):
+        return self.lock is not None or not self.heavy
+
+
+def run(cmd, cwd=None, env=None, timeout=RUNNER_TIMEOUT, memory=RUNNER_MEMORY, heavy=True, slot_wait=None):
+    '''
+    Runs ``cmd`` (a list) to completion, or until it has run for ``timeout``
+    seconds, and returns a Result. Heavy jobs wait ``slot_wait`` seconds at
+    most for a slot (by default RUNNER_SLOT_WAIT, or ``timeout`` for
+    background work); light jobs (e.g. probing a video's size) don't wait.
+    '''
+    if slot_wait is None:
+        slot_wait = timeout if governor.is_patient() else RUNNER_SLOT_WAIT
+    with slot(slot_wait, heavy) as lock:
+        if not lock.acquired:
+            return Result(cmd, stderr='No free slot to run in', no_slot=True)
+
+        start = time.time()
+        devnull = open(os.devnull)
+        try:
+            p = Popen(cmd, cwd=cwd, env=env, stdin=devnull, stdout=PIPE, stderr=PIPE,
+                      close_fds=True, preexec_fn=limits(memory))
+        except OSError as e: # e.g. not installed
+            return Result(cmd, stderr=str(e))
+        finally:
+            devnull.close()
+
+        killed = []
+        def kill():
+            killed.append(True)
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        watchdog = threading.Timer(timeout, kill)
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            out, err = p.communicate()
+        finally:
+            watchdog.cancel()
+
+        duration = time.time() - start
+        record('subprocess.{}'.format(os.path.basename(cmd[0])), duration)
+        return Result(cmd, p.returncode, out, err, duration, bool(killed))
@@ -0,0 +1,378 @@
+from __future__ import division
+from __future__ import unicode_literals
+
+import hashlib
+import re
+import time
+
+from django.core.cache import cache
+from django.utils.safestring import mark_safe
+
+import problems
+import variants
+from config import *
+from profiling import record
+from utils import rst2html
+
+## -------------------------------------------------------------------------- ##
+
+# Long pages are rendered section by section. The source is split (without
+# parsing it) at its top-level section titles, i.e. those below the page's
+# title and subtitle:
+#
+#     head        title, subtitle, docinfo and any text before the first
+#                 section; rendered as a document of its own
+#     sections    one per top-level section, rendered with doctitle_xform
+#                 off so that the section stays a section
+#
+# Each part is cached by the hash of exactly what is fed to docutils (and
+# the version of the problem bank, for a part with a problem set), so
+# editing one section only re-renders that section.
+#
+# Document-level state is handled by rewriting each part's source:
+#
+# - substitution definitions and external (or indirect) targets are moved
+#   out of the parts and prepended to every one of them
+# - a reference to a section title or internal target in another part gets
+#   a target pointing at that anchor (e.g. ".. _`intro`: #intro"), and one
+#   to a name given by an embedded URI in another part (`Docs <http://x/>`_)
+#   a target pointing at that URI
+# - ids are given as docutils would give them in the page as a whole: a
+#   part defining a name whose id an earlier part has used, or needing ids
+#   of its own making ("id1", ...), first reserves the ids used before it
+#   with targets of the same names (which the HTML writer leaves out)
+#
+# Anything whose meaning can't survive the split (auto-numbered footnotes,
+# anonymous hyperlinks, contents, sectnum, include, ...) falls back to
+# rendering the page whole, as does a page with fewer than two sections.
+
+ADORNMENT = re.compile(r'^([!-/:-@\[-`{-~])\1+\s*$')
+UNDERLINE = re.compile(r'^([!-/:-@\[-`{-~])\1*\s*$') # "-" under "A" will do
+
+UNSPLITTABLE = re.compile(r'|'.join([
+    r'^\.\. +(contents|sectnum|section-numbering|include|header|footer|'
+    r'target-notes|default-role|role|title)::',      # document-wide directives
+    r'^\.\. +__:|^__ |`__|\w__(\W|$)',              # anonymous hyperlinks
+    r'\[[^\]\s]+\]_',                               # footnotes and citations
+]), re.MULTILINE)
+
+EXPLICIT_TARGET = re.compile(r'^\.\. +_(`[^`]+`|[^:`]+):(.*)$')
+SUBSTITUTION = re.compile(r'^\.\. +\|[^|]+\|')
+
+INLINE_TARGET = re.compile(r'(?<![\w`])_`([^`]+)`')
+PHRASE_REFERENCE = re.compile(r'`([^`]+)`_(?!_)')
+EMBEDDED = re.compile(r'^(.*?)\s*<([^<>]+)>$', re.DOTALL)
+URI_SCHEME = re.compile(r'^[a-zA-Z][a-zA-Z0-9.+-]*:')
+SIMPLE_REFERENCE = re.compile(r'(?<![\w`|])(\w+(?:[-.+:]\w+)*)_(?![\w_])', re.UNICODE)
+
+
+def normalize_name(name):
+    return ' '.join(name.strip('`').lower().split())
+
+
+def make_id(name):
+    from docutils.nodes import make_id
+    return make_id(name)
+
+
+def embedded(text):
+    '''
+    Returns (name, link) for the text of a phrase reference, where link is
+    the URI or alias (e.g. "intro_") it embeds, or None if it embeds none.
+    '''
+    m = EMBEDDED.match(text)
+    if not m:
+        return normalize_name(text), None
+    link = ''.join(m.group(2).split())
+    if link.endswith('_') and not URI_SCHEME.match(link): # alias
+        return normalize_name(m.group(1) or link[:-1]), link
+    return normalize_name(m.group(1) or link), link
+
+## -------------------------------------------------------------------------- ##
+
+def headings(lines):
+    '''
+    Yields (index, style, text) for each section title, where index is the
+    title's first line (its overline, if any) and style is (char, overlined).
+    '''
+    i = 0
+    blank = True # the line before was blank (or there was none)
+    while i < len(lines):
+        line = lines[i]
+        following = lines[i + 1:i + 3]
+
+        if blank and ADORNMENT.match(line) and len(following) == 2 \
+                and following[0].strip() and following[1].rstrip() == line.rstrip():
+            yield i, (line[0], True), following[0].strip()
+            i += 3
+            blank = False
+            continue
+
+        if blank and line.strip() and not line[0].isspace() and not ADORNMENT.match(line) \
+                and following and UNDERLINE.match(following[0]) \
+                and len(following[0].rstrip()) >= len(line.rstrip()):
+            yield i, (following[0][0], False), line.strip()
+            i += 2
+            blank = False
+            continue
+
+        blank = not line.strip()
+        i += 1
+
+
+def explicit_block(lines, i):
+    '''
+    Returns the index just past the explicit markup block starting at i.
+    '''
+    j = i + 1
+    while j < len(lines) and (not lines[j].strip() or lines[j][0].isspace()):
+        j += 1
+    while j > i + 1 and not lines[j - 1].strip():
+        j -= 1
+    return j
+
+
+def split(source):
+    '''
+    Returns (shared, parts): the definitions every part needs, and a list
+    of parts, each {'lines': [...], 'names': set(), 'refs': set(),
+    'defined': [(name, link), ...]}, the last in the order docutils meets
+    them (link being the URI or alias of an embedded one, else None).
+    Returns None if the source can't be split safely.
+    '''
+    if UNSPLITTABLE.search(source):
+        return None
+
+    lines = source.splitlines()
+    found = list(headings(lines))
+    if not found:
+        return None
+
+    # The title (and subtitle) are only promoted if theirs is the first
+    # title in the document and the only one of its style
+    styles = [style for i, style, text in found]
+    skip = 0
+    end = 0 # of the title before
+    for level in range(2):
+        if skip >= len(found):
+            break
+        i, style, text = found[skip]
+        if styles.count(style) != 1 or any(line.strip() for line in lines[end:i]):
+            break
+        end = i + (3 if style[1] else 2)
+        skip += 1
+    if skip >= len(found):
+        return None
+
+    top = found[skip][1]
+    starts = [0] + [i for i, style, text in found[skip:] if style == top]
+    if len(starts) < 3: # the head and at least two sections
+        return None
+
+    # Pull the shared definitions out of the parts
+    shared = []
+    kept = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if SUBSTITUTION.match(line):
+            j = explicit_block(lines, i)
+            shared.extend(lines[i:j] + [''])
+            kept.extend([None] * (j - i))
+            i = j
+            continue
+        m = EXPLICIT_TARGET.match(line)
+        if m:
+            j = explicit_block(lines, i)
+            if m.group(2).strip() or j > i + 1: # external or indirect
+                shared.extend(lines[i:j] + [''])
+                kept.extend([None] * (j - i))
+                i = j
+                continue
+        kept.append(line)
+        i += 1
+
+    parts = []
+    for start, end in zip(starts, starts[1:] + [len(lines)]):
+        part = {
+            'lines' : [],
+            'refs'  : set(),
+        }
+        titles = dict((i, text) for i, style, text in found if start <= i < end)
+        defined = [] # (offset, name, link)
+        offset = 0
+        for i in range(start, end):
+            line = kept[i]
+            if line is None:
+                continue
+            if i in titles:
+                defined.append((offset, normalize_name(titles[i]), None))
+            m = EXPLICIT_TARGET.match(line)
+            if m:
+                defined.append((offset, normalize_name(m.group(1)), None))
+            part['lines'].append(line)
+            offset += len(line) + 1
+        text = '\n'.join(part['lines'])
+        for m in INLINE_TARGET.finditer(text):
+            defined.append((m.start(), normalize_name(m.group(1)), None))
+        for m in PHRASE_REFERENCE.finditer(text):
+            name, link = embedded(m.group(1))
+            if link is None:
+                part['refs'].add(name)
+                continue
+            defined.append((m.start(), name, link))
+            if link.endswith('_') and not URI_SCHEME.match(link):
+                part['refs'].add(normalize_name(link[:-1]))
+        for m in SIMPLE_REFERENCE.finditer(text):
+            part['refs'].add(normalize_name(m.group(1)))
+        part['defined'] = [(name, link) for offset, name, link in sorted(defined)]
+        part['names'] = set(name for name, link in part['defined'])
+        parts.append(part)
+
+    return shared, parts
+
+
+def part_sources(source):
+    '''
+    Returns the source of each part, ready to render on its own, or None.
+    '''
+    result = split(source)
+    if result is None:
+        return None
+    shared, parts = result
+
+    shared_names = []
+    for line in shared:
+        m = EXPLICIT_TARGET.match(line)
+        if m:
+            shared_names.append(normalize_name(m.group(1)))
+
+    # Give out ids as docutils does (see nodes.document.set_id): the shared
+    # targets come first in every part, then each part's names in order.
+    # Aliases are indirect targets, which get no id of their own.
+    used = set(make_id(name) for name in shared_names)
+    counter = [1]
+    def new_id(name):
+        id = make_id(name)
+        if not id or id in used:
+            id = ''
+            while not id or id in used:
+                id = 'id{}'.format(counter[0])
+                counter[0] += 1
+        used.add(id)
+        return id
+
+    links = {}
+    for part in parts:
+        part['used'] = set(used) # by the parts before
+        part['reserve'] = set()
+        for name, link in part['defined']:
+            if link and link.endswith('_') and not URI_SCHEME.match(link):
+                links.setdefault(name, link)
+                continue
+            id = new_id(name)
+            if id != make_id(name): # taken before, or empty
+                part['reserve'].add(id)
+            links.setdefault(name, link or '#' + id)
+
+    def resolve(name, depth=0):
+        link = links.get(name)
+        while link and link.endswith('_') and not URI_SCHEME.match(link) and depth < 10:
+            alias = normalize_name(link[:-1])
+            if alias in shared_names or alias not in links:
+                break
+            link = links[alias]
+            depth += 1
+        return link
+
+    sources = []
+    for part in parts:
+        reserved = []
+        if part['reserve']:
+            own = set(make_id(name) for name in part['names'])
+            for id in sorted(part['used'] - set(make_id(name) for name in shared_names)):
+                if id in own or re.match(r'^id\d+$', id):
+                    reserved.append('.. _`{}`: #{}'.format(id, id))
+        elsewhere = []
+        for name in sorted(part['refs'] - part['names'] - set(shared_names)):
+            if name in links:
+                elsewhere.append('.. _`{}`: {}'.format(name, resolve(name)))
+        text = '\n'.join(reserved + shared + elsewhere + [''] + part['lines'])
+        sources.append(text.strip('\n') + '\n')
+    return sources
+
+## -------------------------------------------------------------------------- ##
+
+def section_key(source, initial_header_level, doctitle, prefix='wiki-section'):
+    key = '|'.join([source, repr(initial_header_level), repr(doctitle), MATH_OUTPUT,
+        repr(problems.version(source))])
+    return '{}:{}'.format(prefix, hashlib.md5(key.encode('utf-8')).hexdigest())
+
+
+def rst2html_sections(source, initial_header_level=2):
+    '''
+    Same as rst2html(source), but rendered and cached section by section
+    (see above) when the page allows it.
+    '''
+    sources = part_sources(source)
+    if sources is None:
+        return rst2html(source, initial_header_level)
+
+    doctitles = [True] + [False] * (len(sources) - 1)
+    keys = [section_key(s, initial_header_level, d) for s, d in zip(sources, doctitles)]
+    cached = cache.get_many(keys)
+    record('sections.cached', 0.0, calls=len(cached))
+
+    html = []
+    for key, part_source, doctitle in zip(keys, sources, doctitles):
+        if key in cached:
+            html.append(cached[key])
+            continue
+        requests = variants.requests
+        part_html = render_part(part_source, initial_header_level, doctitle)
+        if variants.requests == requests: # else it will soon change
+            cache.set(key, unicode(part_html), SECTION_CACHE_TIMEOUT)
+        html.append(part_html)
+
+    return mark_safe('\n'.join(html))
+
+
+def render_part(source, initial_header_level, doctitle, placeholders=False):
+    html = rst2html(source, initial_header_level, doctitle=doctitle, placeholders=placeholders)
+    # links to anchors in other parts are internal, as in the whole page
+    return html.replace('class="reference external" href="#', 'class="reference internal" href="#')
+
+
+def rst2html_preview(source, budget, initial_header_level=2):
+    '''
+    Renders the editor's buffer for the live preview. Returns the HTML of
+    each part (the whole page, if it can't be split), or None for the parts
+    left over once ``budget`` seconds are spent; the editor asks again for
+    those. Parts already cached for the page itself are reused, and figures
+    that aren't built yet are shown as placeholders rather than built.
+    '''
+    sources = part_sources(source) or [source]
+
+    doctitles = [True] + [False] * (len(sources) - 1)
+    keys = [section_key(s, initial_header_level, d) for s, d in zip(sources, doctitles)]
+    preview_keys = [section_key(s, initial_header_level, d, 'wiki-preview') for s, d in zip(sources, doctitles)]
+    cached = cache.get_many(keys + preview_keys)
+    record('sections.cached', 0.0, calls=len(cached))
+
+    start = time.time()
+    rendered = False
+    html = []
+    for key, preview_key, part_source, doctitle in zip(keys, preview_keys, sources, doctitles):
+        if key in cached:
+            html.append(mark_safe(cached[key]))
+        elif preview_key in cached:
+            html.append(mark_safe(cached[preview_key]))
+        elif rendered and time.time() - start > budget:
+            html.append(None)
+        else:
+            part_html = render_part(part_source, initial_header_level, doctitle, placeholders=True)
+            cache.set(preview_key, unicode(part_html), PREVIEW_CACHE_TIMEOUT)
+            html.append(part_html)
+            rendered = True
+
+    return html
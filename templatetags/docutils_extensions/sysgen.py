@@ -0,0 +1,180 @@
+from __future__ import division
+from __future__ import unicode_literals
+
+import codecs
+import hashlib
+import json
+import os
+import time
+
+from config import *
+from variants import remove_variants
+import blobstore
+
+## -------------------------------------------------------------------------- ##
+
+# System-generated files are named by content hash. They are sharded into
+# subfolders by the first two characters of that hash so that no directory
+# grows without bound, e.g.
+#
+#     sysgen/3f/3fa2...e1.png
+#
+# Anything sharing the part of the name before the first dot belongs to the
+# same source (e.g. "3fa2...e1.mp4" and "3fa2...e1.poster.png").
+
+def sysgen_key(name):
+    return os.path.basename(name).split('.')[0]
+
+
+def poster_name(name):
+    return '{}.poster.png'.format(sysgen_key(name))
+
+
+def sysgen_path(name):
+    path = os.path.join(SYSGEN_PATH, name[:2], name)
+    if not os.path.exists(path):
+        # pull in anything left over from the old flat layout
+        legacy_path = os.path.join(SYSGEN_PATH, name)
+        if os.path.isfile(legacy_path):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            os.rename(legacy_path, path)
+    return path
+
+
+def sysgen_url(name):
+    return '/'.join([SYSGEN_URL, name[:2], name])
+
+
+def blob_name(name):
+    '''
+    Name of the sysgen file in the shared blob store (see blobstore.py).
+    '''
+    return '/'.join([SYSGEN_FOLDER, name[:2], name])
+
+
+def remove(name):
+    '''
+    Removes a sysgen file with its poster and variants, here and from the
+    blob store, so that the next render builds it afresh.
+    '''
+    path = sysgen_path(name)
+    for file_name in [name, poster_name(name)]:
+        try:
+            os.remove(sysgen_path(file_name))
+        except OSError:
+            pass
+        blobstore.discard(blob_name(file_name))
+    remove_variants(path)
+
+## -------------------------------------------------------------------------- ##
+
+def refs_path(pg):
+    filename = '{}.json'.format(hashlib.md5(pg.encode('utf-8')).hexdigest())
+    return os.path.join(SYSGEN_PATH, SYSGEN_REFS_FOLDER, filename)
+
+
+def record_refs(pg, names):
+    '''
+    Remember which sysgen files a page refers to. Written atomically, so that
+    a concurrent sweep never sees a half-written record.
+    '''
+    path = refs_path(pg)
+    names = sorted(set(names))
+    if not names:
+        forget_refs(pg)
+        return
+
+    d = os.path.dirname(path)
+    if not os.path.isdir(d):
+        os.makedirs(d)
+
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    f = codecs.open(temp_path, 'w', 'utf-8')
+    f.write(json.dumps({'pg': pg, 'refs': names}))
+    f.close()
+    os.rename(temp_path, path)
+
+
+def forget_refs(pg):
+    try:
+        os.remove(refs_path(pg))
+    except OSError:
+        pass
+
+
+def load_refs():
+    '''
+    Returns a dictionary of recorded references: {pg: [name, ...]}.
+    '''
+    refs = {}
+    d = os.path.join(SYSGEN_PATH, SYSGEN_REFS_FOLDER)
+    if os.path.isdir(d):
+        for filename in os.listdir(d):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                f = codecs.open(os.path.join(d, filename), 'r', 'utf-8')
+                record = json.loads(f.read())
+                f.close()
+                refs[record['pg']] = record['refs']
+            except (IOError, ValueError, KeyError):
+                pass
+    return refs
+
+## -------------------------------------------------------------------------- ##
+
+def sysgen_files():
+    '''
+    Yields the path of every stored sysgen file, sharded or not.
+    '''
+    if not os.path.isdir(SYSGEN_PATH):
+        return
+    for entry in sorted(os.listdir(SYSGEN_PATH)):
+        if entry.startswith('_'): # bookkeeping, not sysgen files
+            continue
+        path = os.path.join(SYSGEN_PATH, entry)
+        if os.path.isfile(path): # old flat layout
+            yield path
+        elif os.path.isdir(path):
+            for filename in sorted(os.listdir(path)):
+                file_path = os.path.join(path, filename)
+                if os.path.isfile(file_path):
+                    yield file_path
+
+
+def collect(pgs=None, grace=SYSGEN_GC_GRACE, dry_run=False):
+    '''
+    Mark and sweep. Every file referenced by a recorded page is marked; the
+    rest are removed once they are older than the grace period (which keeps
+    figures built moments ago, before their page was saved, alive).
+
+    If ``pgs`` is given, records for pages not in it are dropped first.
+    Returns the list of removed paths.
+    '''
+    refs = load_refs()
+    if pgs is not None:
+        pgs = set(pgs)
+        for pg in refs.keys():
+            if pg not in pgs:
+                if not dry_run:
+                    forget_refs(pg)
+                del refs[pg]
+
+    marked = set()
+    for names in refs.values():
+        marked.update(sysgen_key(name) for name in names)
+
+    removed = []
+    now = time.time()
+    for path in sysgen_files():
+        if sysgen_key(path) in marked:
+            continue
+        if now - os.path.getmtime(path) < grace:
+            continue
+        if not dry_run:
+            os.remove(path)
+            remove_variants(path)
+        removed.append(path)
+
+    return removed
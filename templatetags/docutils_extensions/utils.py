@@ -2,27 +2,90 @@ from __future__ import division
 from __future__ import unicode_literals
 
 import codecs
+import hashlib
 import os
+import shutil
+import time
 import xml.etree.ElementTree as ET
 
-from subprocess import Popen, PIPE
+from tempfile import mkdtemp
 
 from django.utils.safestring import mark_safe
 
-from docutils.core import publish_parts
-from docutils.writers import latex2e
-
 from config import *
+import blobstore
+import governor
+from runner import run
+from profiling import publish_parts
+from profiling import timed_directive
+from profiling import timed_role
+from profiling import timer
 
 # Directory to find working folder
 TEMP_PATH = os.path.join(WORK_PATH, 'latex', '_')
 
+# Directory where finished PDFs are kept, named by the hash of their LaTeX
+PDF_PATH = os.path.join(WORK_PATH, 'latex', 'pdf')
+
 ## -------------------------------------------------------------------------- ##
 
+registered = False
+
+def register():
+    '''
+    Registers our roles and directives with docutils. Done on first render
+    rather than on import, so that importing the app (admin, management
+    commands) doesn't load docutils, yaml or PIL.
+    '''
+    global registered
+    if registered:
+        return
+
+    from docutils.parsers import rst
+
+    from roles import sci_role, atm_role, jargon_role, highlight_role
+    from directives import tbl_directive, fig_directive, problem_set_directive
+
+    rst.roles.register_local_role('sci', timed_role('sci', sci_role))
+    rst.roles.register_local_role('atm', timed_role('atm', atm_role))
+    rst.roles.register_local_role('jargon', timed_role('jargon', jargon_role))
+    rst.roles.register_local_role('highlight', timed_role('highlight', highlight_role))
+
+    # rst.roles.register_local_role('ref', ref_role)
+    # rst.roles.register_local_role('eqn', ref_role)
+    # rst.roles.register_local_role('tbl', ref_role)
+    # rst.roles.register_local_role('fig', ref_role)
+    # rst.roles.register_local_role('plt', ref_role)
+    # rst.roles.register_local_role('ani', ref_role)
+
+    # rst.directives.register_directive('toggle', toggle_directive)
+
+    rst.directives.register_directive('tbl', timed_directive('tbl', tbl_directive))
+    rst.directives.register_directive('fig', timed_directive('fig', fig_directive))
+    # rst.directives.register_directive('plt', plt_directive)
+    # rst.directives.register_directive('ani', plt_directive)
+
+    rst.directives.register_directive('problem-set', timed_directive('problem-set', problem_set_directive))
+
+    registered = True
+
+
+def writes(settings, format):
+    '''
+    Whether a document is being written to the format ('html' or 'latex'),
+    so that our roles and directives make only that output. Documents
+    published without saying get every output.
+    '''
+    return getattr(settings, 'wiki_writer', format) == format
+
+
 def rst2xml(source, part='whole'):
+    register()
     source = '.. default-role:: math\n\n' + source
     writer_name = 'xml'        
-    settings_overrides = {}
+    settings_overrides = {
+        'wiki_writer' : '', # only read for the docinfo, none of our output
+    }
     
     text = publish_parts(
         source=source, 
@@ -34,21 +97,55 @@ def rst2xml(source, part='whole'):
     return root
 
 
-def rst2html(source, initial_header_level=2, inline=False, part='body'):
+def sysgen_refs(source, build=False):
+    '''
+    Returns the names of the sysgen files referenced by the source, having
+    built any that are missing if ``build``.
+    '''
+    from docutils.core import publish_doctree
+
+    register()
     source = '.. default-role:: math\n\n' + source
-    writer_name = 'html'        
+    refs = []
+    settings_overrides = {
+        'sysgen_refs' : refs,
+        'sysgen_build' : build,
+        'report_level' : 5,
+        'wiki_writer' : '', # no output at all
+    }
+
+    with timer('sysgen.refs'):
+        publish_doctree(
+            source=source,
+            settings_overrides=settings_overrides,
+        )
+    return refs
+
+
+def rst2html(source, initial_header_level=2, inline=False, part='body', doctitle=True, placeholders=False):
+    from writers import MyHTMLWriter
+
+    if not source.strip(): # e.g. a page without subtitle
+        return mark_safe('')
+
+    register()
+    source = '.. default-role:: math\n\n' + source
+    writer = MyHTMLWriter()
     settings_overrides = {
         'compact_lists' : True,
         'footnote_references' : 'superscript',
         'math_output' : 'MathJax',
+        'wiki_math_output' : MATH_OUTPUT,
         'stylesheet_path' : None,
         'initial_header_level' : initial_header_level,
-        # 'doctitle_xform' : 0,
+        'doctitle_xform' : doctitle,
+        'sysgen_placeholders' : placeholders,
+        'wiki_writer' : 'html',
     }
 
     html = publish_parts(
         source=source,
-        writer_name=writer_name,
+        writer=writer,
         settings_overrides=settings_overrides,
     )[part].strip()
 
@@ -67,45 +164,15 @@ def rst2html(source, initial_header_level=2, inline=False, part='body'):
     
 ## -------------------------------------------------------------------------- ##
 
-class MyLatexWriter(latex2e.Writer):
-
-    def __init__(self, initial_header_level=1):
-        latex2e.Writer.__init__(self)
-        if initial_header_level == 2:
-            self.translator_class = MyLatexTranslator2
-        elif initial_header_level == 1:
-            self.translator_class = MyLatexTranslator1
-        else:
-            self.translator_class = MyLatexTranslator0
-
-class MyLatexTranslator2(latex2e.LaTeXTranslator):
-    section_level = 2
-
-    def __init__(self, node):
-        latex2e.LaTeXTranslator.__init__(self, node)
-        self._section_number = self.section_level*[0]
-
-class MyLatexTranslator1(latex2e.LaTeXTranslator):
-    section_level = 1
-
-    def __init__(self, node):
-        latex2e.LaTeXTranslator.__init__(self, node)
-        self._section_number = self.section_level*[0]
-
-class MyLatexTranslator0(latex2e.LaTeXTranslator):
-    section_level = 0
-
-    def __init__(self, node):
-        latex2e.LaTeXTranslator.__init__(self, node)
-        self._section_number = self.section_level*[0]
-
-## -------------------------------------------------------------------------- ##
-
 def rst2latex(source, initial_header_level=-1, part='body'):
+    from writers import MyLatexWriter
+
+    register()
     source = '.. default-role:: math\n\n' + source
     writer = MyLatexWriter(initial_header_level)
     settings_overrides = {
         'use_latex_docinfo': True,
+        'wiki_writer' : 'latex',
     }
     
     latex = publish_parts(
@@ -129,53 +196,126 @@ def get_latex_path(filename):
 
 ## -------------------------------------------------------------------------- ##
     
-def make_pdf(latex, repeat=1):
+def pdf_blob_name(name):
+    return '/'.join(['pdf', '{}.pdf'.format(name)])
 
-    curdir = os.getcwd()
-    os.chdir(TEMP_PATH)
-
-    basename = 'temp'
-
-    for ext in ['idx','ind','ilg','aux','log','out','toc','tex','pdf','png']:
-        try:
-            os.remove('{}.{}'.format(basename, ext))
-        except:
-            pass
-
-    texname = '{}.tex'.format(basename)
-    idxname = '{}.idx'.format(basename)
-    pdfname = '{}.pdf'.format(basename)
-
-    texfile = codecs.open(texname, 'w', 'utf-8')
-    texfile.write(latex)
-    texfile.close()
-
-    for i in range(repeat):
-        cmd = os.path.join(LATEX_PATH, 'pdflatex')
-        cmd = [cmd, '--interaction=nonstopmode', texname]
-        p = Popen(cmd,stdout=PIPE,stderr=PIPE)
-        out, err = p.communicate()
 
+def touch(path):
+    '''
+    Marks a PDF as asked for now (see collect_pdfs).
+    '''
     try:
-        open(idxname)
-        if os.path.getsize(idxname):
-
-            cmd = os.path.join(LATEX_PATH, 'makeindex')
-            cmd = [cmd,  idxname]
-            p = Popen(cmd, stdout=PIPE, stderr=PIPE)
-            out, err = p.communicate()
-
-            cmd = os.path.join(LATEX_PATH, 'pdflatex')
-            cmd = [cmd, '--interaction=nonstopmode', texname]
-            p = Popen(cmd, stdout=PIPE, stderr=PIPE)
-            out, err = p.communicate()
-    except:
+        os.utime(path, None)
+    except OSError: # just collected
         pass
 
-    os.chdir(curdir)
 
-    # assert False
-    
-    return os.path.join(TEMP_PATH, pdfname)
+def cached_pdf(name):
+    pdf_path = os.path.join(PDF_PATH, '{}.pdf'.format(name))
+    if blobstore.fetch(pdf_blob_name(name), pdf_path):
+        touch(pdf_path)
+        return pdf_path
+    return None
+
+
+def make_pdf(latex, repeat=1, name=None, date=None):
+    '''
+    Compiles LaTeX and returns the path of the resulting PDF, kept under
+    ``name`` (by default the hash of the LaTeX). Identical LaTeX is only
+    ever compiled once, by whichever node sharing the blob store gets to it
+    first. Each compile gets its own job folder within TEMP_PATH (where the
+    style files are), so several can run at once.
+    Given a ``date`` (a datetime), the PDF's own dates are that date rather
+    than the time of the compile, so the same LaTeX gives the same bytes.
+    Raises governor.Saturated if the host is too busy to compile it now.
+    The path returned doesn't exist if the compile failed.
+    '''
+    if not name:
+        name = hashlib.md5(latex.encode('utf-8')).hexdigest()
+    pdf_path = os.path.join(PDF_PATH, '{}.pdf'.format(name))
+    if os.path.exists(pdf_path):
+        touch(pdf_path)
+        return pdf_path
+
+    def build():
+        # The programs run in a job folder of their own (our cwd is shared
+        # by the threads of the process)
+        jobdir = mkdtemp(dir=TEMP_PATH)
+        try:
+            env = dict(os.environ, TEXINPUTS=TEMP_PATH + os.pathsep)
+            if date:
+                env['SOURCE_DATE_EPOCH'] = str(int(time.mktime(date.timetuple())))
+                env['FORCE_SOURCE_DATE'] = '1' # for \today and the like too
+
+            basename = 'temp'
+
+            texname = '{}.tex'.format(basename)
+            idxname = os.path.join(jobdir, '{}.idx'.format(basename))
+            pdfname = os.path.join(jobdir, '{}.pdf'.format(basename))
+
+            texfile = codecs.open(os.path.join(jobdir, texname), 'w', 'utf-8')
+            texfile.write(latex)
+            texfile.close()
+
+            # pdflatex fails on errors it recovers from, and still writes a
+            # PDF worth keeping: only a run cut short stops the compile
+            pdflatex = [os.path.join(LATEX_PATH, 'pdflatex'), '--interaction=nonstopmode', texname]
+            results = []
+            for i in range(repeat):
+                results.append(run(pdflatex, cwd=jobdir, env=env))
+                if results[-1].cut_short:
+                    break
+
+            if not results[-1].cut_short and os.path.exists(idxname) and os.path.getsize(idxname):
+                results.append(run([os.path.join(LATEX_PATH, 'makeindex'), os.path.basename(idxname)], cwd=jobdir, env=env))
+                if not results[-1].cut_short:
+                    results.append(run(pdflatex, cwd=jobdir, env=env))
+
+            # Keep the PDF (written atomically, another job may want it too),
+            # unless a run was cut short and it may be incomplete
+            if not any(result.cut_short for result in results) and os.path.exists(pdfname):
+                if not os.path.isdir(PDF_PATH):
+                    os.makedirs(PDF_PATH)
+                temp_path = '{}.{}.tmp'.format(pdf_path, os.getpid())
+                shutil.copyfile(pdfname, temp_path)
+                os.rename(temp_path, pdf_path)
+        finally:
+            shutil.rmtree(jobdir, ignore_errors=True)
+
+    return blobstore.obtain(pdf_blob_name(name), pdf_path, governor.governed('pdf', build), kind='pdf')
+
+
+def collect_pdfs(max_age=PDF_MAX_AGE, max_size=PDF_MAX_SIZE, dry_run=False):
+    '''
+    Removes this node's PDFs not asked for in ``max_age`` seconds, then the
+    least recently asked for until they take ``max_size`` bytes at most.
+    (The blob store keeps its copies; they are fetched again if need be.)
+    Returns the list of removed paths.
+    '''
+    if not os.path.isdir(PDF_PATH):
+        return []
+
+    pdfs = []
+    for name in os.listdir(PDF_PATH):
+        path = os.path.join(PDF_PATH, name)
+        if name.endswith('.pdf') and os.path.isfile(path):
+            st = os.stat(path)
+            pdfs.append((st.st_mtime, st.st_size, path))
+    pdfs.sort(reverse=True) # the most recently asked for first
+
+    removed = []
+    now = time.time()
+    total = 0
+    for mtime, size, path in pdfs:
+        total += size
+        if now - mtime < max_age and (max_size is None or total <= max_size):
+            continue
+        if not dry_run:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        removed.append(path)
+    return removed
     
 ## -------------------------------------------------------------------------- ##
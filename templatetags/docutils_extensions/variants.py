@@ -0,0 +1,169 @@
+from __future__ import division
+from __future__ import unicode_literals
+
+import glob
+import os
+import threading
+import Queue
+
+from config import *
+
+## -------------------------------------------------------------------------- ##
+
+# Each image gets a set of smaller copies (and WebP copies, if this PIL can
+# write them) kept in a folder beside it, e.g.
+#
+#     sysgen/3f/3fa2...e1.png
+#     sysgen/3f/_variants/3fa2...e1-320w.png
+#     sysgen/3f/_variants/3fa2...e1-320w.webp
+#
+# Variants are built by a background thread. Until they are ready, pages
+# simply get the full-size image.
+
+SOURCE_FORMATS = {
+    'png'   : 'png',
+    'jpg'   : 'jpeg',
+    'jpeg'  : 'jpeg',
+}
+
+def webp_supported():
+    from PIL import Image
+
+    Image.init()
+    return 'WEBP' in Image.SAVE
+
+
+def variant_formats(path):
+    ext = path.rsplit('.', 1)[-1].lower()
+    if ext not in SOURCE_FORMATS: # e.g. gif, which may be animated
+        return []
+    formats = [ext]
+    if webp_supported():
+        formats.append('webp')
+    return formats
+
+
+def variant_path(path, width, format):
+    root = os.path.basename(path).rsplit('.', 1)[0]
+    filename = '{}-{}w.{}'.format(root, width, format)
+    return os.path.join(os.path.dirname(path), VARIANT_FOLDER, filename)
+
+
+def variant_url(url, path, width, format):
+    filename = os.path.basename(variant_path(path, width, format))
+    return '/'.join([url.rsplit('/', 1)[0], VARIANT_FOLDER, filename])
+
+
+def variant_widths(size, format):
+    widths = [w for w in VARIANT_WIDTHS if w < size[0]]
+    if format == 'webp': # there is no full-size original to fall back on
+        widths.append(size[0])
+    return widths
+
+## -------------------------------------------------------------------------- ##
+
+def build(path):
+    '''
+    Writes every variant of an image. Each is written to a temporary file
+    first, so a half-written variant is never served.
+    '''
+    from PIL import Image
+
+    formats = variant_formats(path)
+    if not formats:
+        return
+
+    img = Image.open(path)
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA')
+
+    for format in formats:
+        for width in variant_widths(img.size, format):
+            height = int(round(img.size[1] * width / img.size[0]))
+            out = img.resize((width, height), Image.ANTIALIAS)
+            out_path = variant_path(path, width, format)
+            d = os.path.dirname(out_path)
+            if not os.path.isdir(d):
+                os.makedirs(d)
+            temp_path = '{}.{}.tmp'.format(out_path, os.getpid())
+            if SOURCE_FORMATS.get(format) == 'jpeg' and out.mode == 'RGBA':
+                out = out.convert('RGB')
+            out.save(temp_path, SOURCE_FORMATS.get(format, format), optimize=True)
+            os.rename(temp_path, out_path)
+
+
+def remove_variants(path):
+    root = os.path.basename(path).rsplit('.', 1)[0]
+    pattern = os.path.join(os.path.dirname(path), VARIANT_FOLDER, root + '-*w.*')
+    for variant in glob.glob(pattern):
+        try:
+            os.remove(variant)
+        except OSError:
+            pass
+
+## -------------------------------------------------------------------------- ##
+
+_queue = Queue.Queue()
+_pending = set()
+_lock = threading.Lock()
+_worker = None
+
+# Bumped whenever a render asks for variants that aren't ready, so callers
+# caching rendered HTML can tell that it will soon be out of date
+requests = 0
+
+def _work():
+    while True:
+        path = _queue.get()
+        try:
+            build(path)
+        except Exception as e:
+            print '* ERROR: Could not build variants of {}: {}'.format(path, e)
+        finally:
+            with _lock:
+                _pending.discard(path)
+
+
+def schedule(path):
+    '''
+    Queues an image for its variants to be built in the background.
+    '''
+    global _worker, requests
+    with _lock:
+        requests += 1
+        if path in _pending:
+            return
+        _pending.add(path)
+        if _worker is None:
+            _worker = threading.Thread(target=_work, name='wiki-variants')
+            _worker.daemon = True
+            _worker.start()
+    _queue.put(path)
+
+
+def srcset(path, url, size):
+    '''
+    Returns {format: srcset} for an image of the given pixel size, or None if
+    its variants are missing or out of date (in which case they are queued).
+    '''
+    formats = variant_formats(path)
+    if not any(variant_widths(size, format) for format in formats):
+        return None
+
+    mtime = os.path.getmtime(path)
+    for format in formats:
+        for width in variant_widths(size, format):
+            variant = variant_path(path, width, format)
+            if not os.path.exists(variant) or os.path.getmtime(variant) < mtime:
+                schedule(path)
+                return None
+
+    sets = {}
+    for format in formats:
+        candidates = []
+        for width in variant_widths(size, format):
+            candidates.append('{} {}w'.format(variant_url(url, path, width, format), width))
+        if format == formats[0]:
+            candidates.append('{} {}w'.format(url, size[0]))
+        sets[format] = ', '.join(candidates)
+    return sets
@@ -0,0 +1,67 @@
+from __future__ import division
+from __future__ import unicode_literals
+
+from docutils import nodes
+from docutils.writers import html4css1
+from docutils.writers import latex2e
+
+from mathml import math_output
+from mathml import to_mathml
+
+## -------------------------------------------------------------------------- ##
+
+# Kept apart from utils so that docutils is only loaded when rendering.
+
+class MyHTMLWriter(html4css1.Writer):
+
+    def __init__(self):
+        html4css1.Writer.__init__(self)
+        self.translator_class = MyHTMLTranslator
+
+class MyHTMLTranslator(html4css1.HTMLTranslator):
+
+    def visit_math(self, node, math_env=''):
+        # MathML where we can (see mathml.py), else MathJax as before
+        if math_output(self.settings) == 'MathML':
+            mathml = to_mathml(node.astext(), display=bool(math_env))
+            if mathml:
+                if math_env:
+                    self.body.append(self.starttag(node, 'div', CLASS='math'))
+                    self.body.append(mathml)
+                    self.body.append('</div>\n')
+                else:
+                    self.body.append(mathml)
+                raise nodes.SkipNode
+        html4css1.HTMLTranslator.visit_math(self, node, math_env)
+
+class MyLatexWriter(latex2e.Writer):
+
+    def __init__(self, initial_header_level=1):
+        latex2e.Writer.__init__(self)
+        if initial_header_level == 2:
+            self.translator_class = MyLatexTranslator2
+        elif initial_header_level == 1:
+            self.translator_class = MyLatexTranslator1
+        else:
+            self.translator_class = MyLatexTranslator0
+
+class MyLatexTranslator2(latex2e.LaTeXTranslator):
+    section_level = 2
+
+    def __init__(self, node):
+        latex2e.LaTeXTranslator.__init__(self, node)
+        self._section_number = self.section_level*[0]
+
+class MyLatexTranslator1(latex2e.LaTeXTranslator):
+    section_level = 1
+
+    def __init__(self, node):
+        latex2e.LaTeXTranslator.__init__(self, node)
+        self._section_number = self.section_level*[0]
+
+class MyLatexTranslator0(latex2e.LaTeXTranslator):
+    section_level = 0
+
+    def __init__(self, node):
+        latex2e.LaTeXTranslator.__init__(self, node)
+        self._section_number = self.section_level*[0]
@@ -4,8 +4,8 @@ from __future__ import unicode_literals
 from django import template
 from django.utils.safestring import mark_safe
 
-from docutils.core import publish_parts
-
+from docutils_extensions import mathml
+from docutils_extensions import sections
 from docutils_extensions import utils
 
 ## -------------------------------------------------------------------------- ##
@@ -23,3 +23,11 @@ def rst2html_inline(source, initial_header=2, inline=True):
 @register.filter(is_safe=True)
 def rst2latex(source, initial_header=-1):
     return utils.rst2latex(source, initial_header)
+
+@register.filter(is_safe=True)
+def rst2html_sections(source, initial_header=2):
+    return sections.rst2html_sections(source, initial_header)
+
+@register.filter
+def needs_mathjax(html):
+    return mathml.needs_mathjax(html)
@@ -0,0 +1,440 @@
+from __future__ import division
+from __future__ import unicode_literals
+
+import io
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.template import Context, loader
+from django.test import TestCase
+from django.utils import unittest
+
+try:
+    import botocore
+except ImportError:
+    botocore = None
+
+import drafts
+import revisions
+from models import Page
+from templatetags.docutils_extensions import blobstore
+from templatetags.docutils_extensions import governor
+from templatetags.docutils_extensions import mathml
+from templatetags.docutils_extensions.sections import rst2html_sections
+from templatetags.docutils_extensions.sections import split
+from templatetags.docutils_extensions.utils import rst2html
+
+## -------------------------------------------------------------------------- ##
+
+PROBLEM_SET = '''.. problem-set:: Homework
+    :answers: toggle
+
+    - question: "How fast is :sci:`3E8` m/s?"
+      answer: "The speed of light"
+      solution: "Look it up."
+    - question: "What is :math:`6 \\\\times 9`?"
+      answer: "42"
+'''
+
+SOURCE = '''=====
+Title
+=====
+
+:Author: Somebody
+
+Intro.
+
+First
+-----
+
+{problems}
+Second
+------
+
+{problems}
+'''.format(problems=PROBLEM_SET)
+
+
+class DeterminismTest(TestCase):
+    '''
+    The same source must render to the same bytes every time (from cold
+    caches), so that ETags, the response cache and PDFs stay stable.
+    '''
+
+    def render_twice(self, render):
+        renders = []
+        for i in range(2):
+            cache.clear()
+            mathml.memo.clear()
+            renders.append(render().encode('utf-8'))
+        return renders
+
+    def test_problem_set(self):
+        first, second = self.render_twice(lambda: rst2html(PROBLEM_SET))
+        self.assertEqual(first, second)
+
+    def test_sections(self):
+        first, second = self.render_twice(lambda: rst2html_sections(SOURCE))
+        self.assertEqual(first, second)
+
+    def test_ppdf(self):
+        page = Page(pg='/determinism/', raw_content=SOURCE, update_date=datetime(2014, 1, 2, 3, 4, 5))
+        template = loader.get_template('wiki/ppdf.tex')
+        first, second = self.render_twice(lambda: template.render(Context({'page': page}, autoescape=False)))
+        self.assertEqual(first, second)
+
+    def test_toggle_ids_unique(self):
+        # the same problem set at the same line of two sections (see sections.py)
+        for html in [rst2html(SOURCE), rst2html_sections(SOURCE)]:
+            ids = re.findall(r' id="([^"]+)"', html)
+            self.assertTrue(ids)
+            self.assertEqual(len(ids), len(set(ids)))
+
+## -------------------------------------------------------------------------- ##
+
+SHORT_TITLES = '''=====
+Title
+=====
+
+Intro, see `B`_.
+
+A
+-
+
+Text *a*.
+
+B
+-
+
+Text *b*, see A_.
+'''
+
+
+class SectionsTest(TestCase):
+    '''
+    Rendering a page a section at a time (see sections.py) must give what
+    rendering it whole does.
+    '''
+
+    def assertSplitRendersWhole(self, source):
+        self.assertEqual(len(split(source)[1]), 3)
+        cache.clear()
+        self.assertEqual(rst2html_sections(source), rst2html(source))
+
+    def test_short_titles(self):
+        self.assertSplitRendersWhole(SHORT_TITLES)
+
+    def test_long_titles(self):
+        self.assertSplitRendersWhole(SHORT_TITLES.replace('\n-\n', '\n---\n'))
+
+## -------------------------------------------------------------------------- ##
+
+class DraftsTest(TestCase):
+    '''
+    The editor's autosave (see drafts.py).
+    '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.saved = drafts.wiki_drafts_path, revisions.wiki_revisions_path
+        drafts.wiki_drafts_path = os.path.join(self.root, 'drafts')
+        revisions.wiki_revisions_path = os.path.join(self.root, 'revisions')
+        self.user = User.objects.create(username='editor')
+        self.published = drafts.revision('')
+
+    def tearDown(self):
+        drafts.wiki_drafts_path, revisions.wiki_revisions_path = self.saved
+        shutil.rmtree(self.root)
+
+    def test_patch(self):
+        # offsets count UTF-16 code units: the clef takes two
+        self.assertEqual(drafts.patch('a\U0001d11eb', 3, 4, 'c'), 'a\U0001d11ec')
+        self.assertEqual(drafts.patch('ab', 1, 1, 'x'), 'axb')
+        self.assertRaises(drafts.Conflict, drafts.patch, 'ab', 1, 3, 'x')
+
+    def test_autosave(self):
+        draft = drafts.autosave(self.user, '/p/', self.published, None, content='one\ntwo')
+        draft = drafts.autosave(self.user, '/p/', self.published, draft['revision'], 4, 7, 'three')
+        self.assertEqual(drafts.load(self.user, '/p/')['content'], 'one\nthree')
+        self.assertRaises(drafts.Conflict, drafts.autosave,
+            self.user, '/p/', self.published, drafts.revision('one\ntwo'), 0, 3, 'six')
+
+    def test_autosave_crlf(self):
+        # the editor's buffer has '\n' where the page has '\r\n'
+        Page.objects.bulk_create([Page(pg='/p/', raw_content='one\r\ntwo')])
+        published = drafts.revision('one\r\ntwo')
+        draft = drafts.autosave(self.user, '/p/', published, drafts.revision('one\ntwo'), 4, 7, 'three')
+        self.assertEqual(draft['content'], 'one\nthree')
+        draft = drafts.autosave(self.user, '/q/', published, None, content='one\r\ntwo')
+        self.assertEqual(draft['content'], 'one\ntwo')
+
+    def test_rebase(self):
+        revisions.record('/p/', 'one\n')
+        revisions.record('/p/', 'one\ntwo\n')
+        draft = drafts.autosave(self.user, '/p/', drafts.revision('one\n'), None, content='one\nmine\n')
+        changes = drafts.changes('/p/', draft, 'one\ntwo\n')
+        self.assertTrue('+two' in changes)
+        self.assertEqual(drafts.changes('/p/', {'published': 'unknown'}, 'one\ntwo\n'), 'one\ntwo\n')
+
+        drafts.rebase(self.user, '/p/', drafts.revision('one\ntwo\n'))
+        draft = drafts.load(self.user, '/p/')
+        self.assertEqual(draft['published'], drafts.revision('one\ntwo\n'))
+        self.assertEqual(draft['content'], 'one\nmine\n')
+
+## -------------------------------------------------------------------------- ##
+
+class RevisionsTest(TestCase):
+    '''
+    The revision history of pages (see revisions.py).
+    '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.saved = revisions.wiki_revisions_path
+        revisions.wiki_revisions_path = self.root
+        # more than a snapshot's worth, each changing a line or adding one
+        self.contents = []
+        lines = ['line {}\n'.format(i) for i in range(10)]
+        for n in range(revisions.SNAPSHOT_INTERVAL + 6):
+            if n % 3:
+                lines[n % len(lines)] = 'revision {}\n'.format(n)
+            else:
+                lines.append('added in {}\n'.format(n))
+            self.contents.append(''.join(lines))
+
+    def tearDown(self):
+        revisions.wiki_revisions_path = self.saved
+        shutil.rmtree(self.root)
+
+    def record_all(self, pg):
+        for content in self.contents:
+            revisions.record(pg, content, 'editor')
+
+    def assertHistory(self, pg, contents):
+        self.assertEqual(revisions.count(pg), len(contents))
+        for n, content in enumerate(contents):
+            self.assertEqual(revisions.get(pg, n), content)
+
+    def test_round_trip(self):
+        self.record_all('/p/')
+        self.assertHistory('/p/', self.contents)
+        snapshots = [e['number'] for e in revisions.read_index('/p/') if e['base'] == -1]
+        self.assertEqual(snapshots, [0, revisions.SNAPSHOT_INTERVAL])
+        self.assertEqual(revisions.record('/p/', self.contents[-1]), None)
+
+    def test_diff(self):
+        self.record_all('/p/')
+        diff = revisions.diff('/p/', 0, revisions.SNAPSHOT_INTERVAL + 1)
+        self.assertTrue('+revision {}\n'.format(revisions.SNAPSHOT_INTERVAL + 1) in diff)
+        self.assertTrue('-line 1\n' in diff)
+        self.assertEqual(revisions.diff('/p/', -1, -1), '')
+
+    def test_repack(self):
+        self.record_all('/p/')
+        revisions.repack('/p/')
+        self.assertHistory('/p/', self.contents)
+
+        # a revision that doesn't rebuild to what was saved
+        entries = revisions.read_index('/p/')
+        e = entries[5]
+        f = open(revisions.index_path('/p/'), 'r+b')
+        f.seek(5 * revisions.INDEX.size)
+        f.write(revisions.INDEX.pack(e['offset'], e['length'], e['base'], e['time'], b'x' * 16, b''))
+        f.close()
+        self.assertRaises(ValueError, revisions.repack, '/p/')
+
+    def test_move(self):
+        self.record_all('/old/')
+        revisions.move('/old/', '/new/')
+        self.assertHistory('/new/', self.contents)
+        self.assertEqual(revisions.count('/old/'), 0)
+
+    def test_move_onto_history(self):
+        revisions.record('/new/', 'theirs\n')
+        revisions.record('/new/', 'theirs, again\n')
+        self.record_all('/old/')
+        revisions.move('/old/', '/new/')
+        self.assertHistory('/new/', ['theirs\n', 'theirs, again\n'] + self.contents)
+        self.assertEqual(revisions.count('/old/'), 0)
+
+## -------------------------------------------------------------------------- ##
+
+def take_lease(root):
+    return blobstore.LocalBlobStore(root).lease('sysgen/ab/abc.png')
+
+
+def obtain_on_node(args):
+    # each process stands for a node, with a folder of its own
+    root, node = args
+    path = os.path.join(root, node, 'abc.png')
+
+    def build():
+        f = open(os.path.join(root, 'builds'), 'a')
+        f.write(node + '\n')
+        f.close()
+        time.sleep(0.5)
+        f = open(path, 'w')
+        f.write('built')
+        f.close()
+
+    blobstore.obtain('sysgen/ab/abc.png', path, build)
+    return open(path).read()
+
+
+class LocalBlobStoreTest(TestCase):
+    '''
+    Several processes sharing a folder as their blob store (see
+    blobstore.py).
+    '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = os.path.join(self.root, 'store')
+        self.saved = blobstore.BLOBSTORE
+        blobstore.BLOBSTORE = 'file://' + self.store
+        self.pool = multiprocessing.Pool(4)
+
+    def tearDown(self):
+        self.pool.terminate()
+        self.pool.join()
+        blobstore.BLOBSTORE = self.saved
+        shutil.rmtree(self.root)
+
+    def test_one_lease(self):
+        taken = self.pool.map(take_lease, [self.store] * 8)
+        self.assertEqual(taken.count(True), 1)
+
+    def test_stale_lease(self):
+        store = blobstore.LocalBlobStore(self.store)
+        self.assertTrue(store.lease('a'))
+        self.assertFalse(store.lease('a'))
+        stale = time.time() - blobstore.BLOBSTORE_LEASE - 1
+        os.utime(store.path('a') + blobstore.LEASE_SUFFIX, (stale, stale))
+        self.assertTrue(store.lease('a'))
+
+    def test_one_takes_over(self):
+        self.assertTrue(take_lease(self.store))
+        stale = time.time() - blobstore.BLOBSTORE_LEASE - 1
+        path = blobstore.LocalBlobStore(self.store).path('sysgen/ab/abc.png') + blobstore.LEASE_SUFFIX
+        os.utime(path, (stale, stale))
+        taken = self.pool.map(take_lease, [self.store] * 8)
+        self.assertEqual(taken.count(True), 1)
+        self.assertEqual(os.listdir(os.path.dirname(path)), [os.path.basename(path)])
+
+    def test_obtain_builds_once(self):
+        nodes = [(self.root, 'node{}'.format(i)) for i in range(4)]
+        self.assertEqual(self.pool.map(obtain_on_node, nodes), ['built'] * 4)
+        self.assertEqual(len(open(os.path.join(self.root, 'builds')).readlines()), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.store, 'sysgen', 'ab', 'abc.png' + blobstore.LEASE_SUFFIX)))
+
+    def test_obtain_busy(self):
+        # another node is building it, and takes longer than we may wait
+        self.assertTrue(take_lease(self.store))
+        path = os.path.join(self.root, 'abc.png')
+        saved = blobstore.GOVERNOR_WAIT, blobstore.BLOBSTORE_LEASE
+        blobstore.GOVERNOR_WAIT, blobstore.BLOBSTORE_LEASE = 0.2, 0.5
+        try:
+            self.assertRaises(governor.Saturated, blobstore.obtain, 'sysgen/ab/abc.png', path, self.fail)
+            with governor.patient(): # waits on, then builds it anyway
+                blobstore.obtain('sysgen/ab/abc.png', path, lambda: open(path, 'w').close())
+        finally:
+            blobstore.GOVERNOR_WAIT, blobstore.BLOBSTORE_LEASE = saved
+        self.assertTrue(os.path.exists(path))
+
+## -------------------------------------------------------------------------- ##
+
+class FakeS3(object):
+    '''
+    Just enough of boto3's S3 client for leases, with conditional writes or
+    (like the boto3 releases that run on Python 2) without.
+    '''
+
+    def __init__(self, conditional=True):
+        self.conditional = conditional
+        self.objects = {} # key: (body, etag, last modified)
+        self.lock = threading.Lock()
+
+    def error(self, code, operation):
+        return botocore.exceptions.ClientError({'Error': {'Code': code}}, operation)
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.error('404', 'HeadObject')
+        body, etag, modified = self.objects[Key]
+        return {'ETag': etag, 'LastModified': modified}
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.error('NoSuchKey', 'GetObject')
+        return {'Body': io.BytesIO(self.objects[Key][0])}
+
+    def put_object(self, Bucket, Key, Body, **condition):
+        if condition and not self.conditional:
+            raise botocore.exceptions.ParamValidationError(report='Unknown parameter')
+        with self.lock:
+            current = self.objects.get(Key)
+            if 'IfNoneMatch' in condition and current is not None \
+                    or 'IfMatch' in condition and (current is None or current[1] != condition['IfMatch']):
+                raise self.error('PreconditionFailed', 'PutObject')
+            self.objects[Key] = (Body, uuid.uuid4().hex, datetime.utcnow())
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def age(self, Key, seconds):
+        body, etag, modified = self.objects[Key]
+        self.objects[Key] = (body, etag, modified - timedelta(seconds=seconds))
+
+
+@unittest.skipIf(botocore is None, 'needs botocore')
+class S3BlobStoreTest(TestCase):
+    '''
+    Leases on an S3 blob store (see blobstore.py), with a stand-in client.
+    '''
+
+    def setUp(self):
+        self.saved = blobstore.LEASE_SETTLE
+        blobstore.LEASE_SETTLE = 0.1
+
+    def tearDown(self):
+        blobstore.LEASE_SETTLE = self.saved
+
+    def race(self, store, name, n=8):
+        taken = []
+        threads = [threading.Thread(target=lambda: taken.append(store.lease(name))) for i in range(n)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return taken
+
+    def test_one_lease(self):
+        store = blobstore.S3BlobStore('bucket', client=FakeS3())
+        self.assertEqual(self.race(store, 'a').count(True), 1)
+        self.assertTrue(store.conditional)
+
+    def test_one_takes_over(self):
+        client = FakeS3()
+        store = blobstore.S3BlobStore('bucket', client=client)
+        self.assertTrue(store.lease('a'))
+        client.age('a' + blobstore.LEASE_SUFFIX, blobstore.BLOBSTORE_LEASE + 1)
+        self.assertEqual(self.race(store, 'a').count(True), 1)
+        store.release('a')
+        self.assertTrue(store.lease('a'))
+
+    def test_without_conditional_writes(self):
+        store = blobstore.S3BlobStore('bucket', client=FakeS3(conditional=False))
+        self.assertTrue(store.lease('a'))
+        self.assertFalse(store.conditional)
+        self.assertFalse(store.lease('a'))
+        self.assertEqual(self.race(store, 'b').count(True), 1)
@@ -11,8 +11,11 @@ urlpatterns = patterns('',
     url(r'^show(?P<pg>(/[\w\-/]*))$', views.show, name='wiki_show'),
     url(r'^edit(?P<pg>(/[\w\-/]*))$', views.edit, name='wiki_edit'),
     url(r'^ppdf(?P<pg>(/[\w\-/]*))$', views.ppdf, name='wiki_ppdf'),
+    url(r'^pbook(?P<pg>(/[\w\-/]*))$', views.pbook, name='wiki_pbook'),
 
     url(r'^post/$', views.post, name='wiki_post'),
+    url(r'^preview/$', views.preview, name='wiki_preview'),
+    url(r'^autosave/$', views.autosave, name='wiki_autosave'),
 
     url(r'^login/$', 'django.contrib.auth.views.login', {'template_name': 'wiki/login.html'}, name='wiki_login'),
     url(r'^logout/$', views.wiki_logout, name='wiki_logout'),
@@ -5,10 +5,14 @@ from django.http import HttpResponse
 from django.template import RequestContext
 from django.template import loader
 
+from templatetags.docutils_extensions.profiling import timer
+
 def render_to_response(request, template, context):
     c = RequestContext(request, context)
     t = loader.get_template(template)
-    return HttpResponse(t.render(c))
+    with timer('template'):
+        html = t.render(c)
+    return HttpResponse(html)
 
 ## -------------------------------------------------------------------------- ##
 
@@ -18,9 +22,11 @@ import sys
 
 from models import Page
 from config import wiki_pages_path
-from templatetags.docutils_extensions.config import SYSGEN_FOLDER
+from templatetags.docutils_extensions.config import SYSGEN_PATH
+from templatetags.docutils_extensions import sysgen
+from templatetags.docutils_extensions.utils import sysgen_refs
 
-def rebuild(pull_docinfo=True, wipe_sysgen=False):
+def rebuild(pull_docinfo=True, wipe_sysgen=False, interactive=True):
     '''
     Designed to be run from shell. 
     Will wipe DB and load data from file system.
@@ -38,18 +44,19 @@ def rebuild(pull_docinfo=True, wipe_sysgen=False):
             print(pg)
             pg_list.append(pg)
 
-    confirm = raw_input('About to create {} pages. Ready to wipe DB ([y]/n)? '.format(len(pg_list)))
-    if confirm and confirm.upper() != 'Y':
-        print('Aborting...')
-        sys.exit()
+    if interactive:
+        confirm = raw_input('About to create {} pages. Ready to wipe DB ([y]/n)? '.format(len(pg_list)))
+        if confirm and confirm.upper() != 'Y':
+            print('Aborting...')
+            sys.exit()
 
     print('Deleting all Page data')
     Page.objects.all().delete()
 
     if wipe_sysgen:
         print('Wiping sysgen')
-        for file in os.listdir(SYSGEN_FOLDER):
-            file_path = os.path.join(SYSGEN_FOLDER, file)
+        for file in os.listdir(SYSGEN_PATH):
+            file_path = os.path.join(SYSGEN_PATH, file)
             if os.path.isdir(file_path):
                 shutil.rmtree(file_path)
             else:
@@ -60,3 +67,353 @@ def rebuild(pull_docinfo=True, wipe_sysgen=False):
         page = Page(pg=pg)
         page.update(pull_docinfo=pull_docinfo)
 
+
+def collect_sysgen(refresh=True, dry_run=False):
+    '''
+    Designed to be run from shell.
+    Removes sysgen files no longer referenced by any page. With ``refresh``,
+    every page's references are recorded afresh before the sweep.
+    '''
+    pgs = []
+    for page in Page.objects.all():
+        pgs.append(page.pg)
+        if refresh:
+            sysgen.record_refs(page.pg, sysgen_refs(page.content))
+
+    removed = sysgen.collect(pgs=pgs, dry_run=dry_run)
+    for path in removed:
+        print('Removing: ', path)
+    print('{} sysgen files removed'.format(len(removed)))
+    return removed
+
+
+def collect_pdfs(dry_run=False, **options):
+    '''
+    Designed to be run from shell.
+    Removes compiled PDFs (of pages and books) no longer asked for; see
+    templatetags.docutils_extensions.utils.collect_pdfs for the options.
+    '''
+    from templatetags.docutils_extensions.utils import collect_pdfs
+
+    removed = collect_pdfs(dry_run=dry_run, **options)
+    for path in removed:
+        print('Removing: ', path)
+    print('{} PDFs removed'.format(len(removed)))
+    return removed
+
+## -------------------------------------------------------------------------- ##
+
+import hashlib
+import json
+import multiprocessing
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.auth.models import AnonymousUser
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import RequestFactory
+
+from config import wiki_image_path
+from templatetags.docutils_extensions.config import SYSGEN_REFS_FOLDER
+from templatetags.docutils_extensions.config import WIKI_IMAGE_URL
+
+EXPORT_MANIFEST = '.wiki-export.json'
+
+# Precompressed copies are written beside each page, for e.g. nginx's
+# gzip_static and brotli_static
+EXPORT_SUFFIXES = {
+    'gzip'  : '.gz',
+    'br'    : '.br',
+}
+
+def write_file(path, data):
+    d = os.path.dirname(path)
+    if not os.path.isdir(d):
+        os.makedirs(d)
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    f = open(temp_path, 'wb')
+    f.write(data)
+    f.close()
+    os.rename(temp_path, path)
+
+
+def sync_tree(src, dst, skip=[]):
+    '''
+    Copies the files in ``src`` that are missing or different in ``dst``.
+    '''
+    for root, dirs, files in os.walk(src):
+        dirs[:] = [d for d in dirs if d not in skip]
+        for file in files:
+            src_path = os.path.join(root, file)
+            dst_path = os.path.join(dst, os.path.relpath(src_path, src))
+            if os.path.exists(dst_path):
+                s, d = os.stat(src_path), os.stat(dst_path)
+                if s.st_size == d.st_size and int(s.st_mtime) == int(d.st_mtime):
+                    continue
+            if not os.path.isdir(os.path.dirname(dst_path)):
+                os.makedirs(os.path.dirname(dst_path))
+            shutil.copy2(src_path, dst_path)
+
+
+def export_signatures(pdf=False):
+    '''
+    Returns {pg: signature}. A page has to be exported again only when its
+    signature changes, i.e. when its content, its navigation (children,
+    siblings and parent, with their titles) or the state of its figures do.
+    '''
+    pages = {}
+    children = {}
+    for pk, pg, title, parent_id, raw_content in Page.objects.values_list(
+            'pk', 'pg', 'raw_title', 'parent', 'raw_content'):
+        content_hash = hashlib.md5(raw_content.encode('utf-8')).hexdigest()
+        pages[pk] = (pg, title, parent_id, content_hash)
+        children.setdefault(parent_id, []).append(pk)
+
+    def family(parent_id):
+        return sorted(pages[id][:2] for id in children.get(parent_id, []))
+
+    refs = sysgen.load_refs()
+    signatures = {}
+    for pk, (pg, title, parent_id, content_hash) in pages.items():
+        parent = pages[parent_id][:2] if parent_id in pages else None
+        siblings = family(parent_id) if parent_id in pages else []
+        figures = [(name, os.path.exists(sysgen.sysgen_path(name))) for name in refs.get(pg, [])]
+        signature = [content_hash, title, family(pk), siblings, parent, figures, pdf]
+        signature = json.dumps(signature, sort_keys=True)
+        signatures[pg] = hashlib.md5(signature.encode('utf-8')).hexdigest()
+    return signatures
+
+
+def export_page(job):
+    '''
+    Renders one page (and maybe its PDF) into the export. Runs in a worker
+    process; returns the pg and an error message, if any.
+    '''
+    import compress
+    import views
+
+    dest, pg, pdf = job
+    try:
+        request = RequestFactory().get(reverse('wiki_show', args=[pg]))
+        request.user = AnonymousUser()
+        request.wiki_internal = True # not a reader's view
+
+        html = views.show(request, pg).content
+        urls = [reverse('wiki_show', args=[pg])]
+        if pg == '/':
+            urls.append(reverse('wiki_root'))
+        encoded = compress.encode(html.decode('utf-8'))
+        for url in urls:
+            path = os.path.join(dest, url.lstrip('/'), 'index.html')
+            write_file(path, html)
+            for encoding, data in encoded.items():
+                write_file(path + EXPORT_SUFFIXES[encoding], data)
+
+        if pdf:
+            url = reverse('wiki_ppdf', args=[pg])
+            response = views.ppdf(request, pg)
+            if response.status_code != 200:
+                raise IOError('No PDF ({})'.format(response.status_code))
+            write_file(os.path.join(dest, url.lstrip('/'), 'index.pdf'), response.content)
+    except Exception as e:
+        return pg, '{}: {}'.format(type(e).__name__, e)
+    return pg, None
+
+
+def export(dest, pdf=False, processes=None, force=False):
+    '''
+    Designed to be run from shell.
+    Writes the whole wiki into ``dest`` as a static site, laid out by URL
+    (so serve it with e.g. nginx's ``index index.html index.pdf;``).
+    Pages are rendered through ``show.html`` by a pool of processes. Later
+    runs only render pages whose signature changed (see above).
+    '''
+    dest = os.path.abspath(dest)
+
+    for page in Page.objects.all(): # pick up edits made on the file system
+        page.update()
+
+    manifest_path = os.path.join(dest, EXPORT_MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path) and not force:
+        f = open(manifest_path)
+        manifest = json.load(f)
+        f.close()
+
+    signatures = export_signatures(pdf)
+
+    for pg in set(manifest) - set(signatures):
+        print('Removing: ', pg)
+        files = [(reverse('wiki_show', args=[pg]), 'index.html' + suffix)
+                 for suffix in [''] + EXPORT_SUFFIXES.values()]
+        files.append((reverse('wiki_ppdf', args=[pg]), 'index.pdf'))
+        for url, filename in files:
+            try:
+                os.remove(os.path.join(dest, url.lstrip('/'), filename))
+            except OSError:
+                pass
+        del manifest[pg]
+
+    jobs = []
+    for pg in sorted(signatures):
+        if manifest.get(pg) != signatures[pg]:
+            jobs.append((dest, pg, pdf))
+    print('Exporting {} of {} pages'.format(len(jobs), len(signatures)))
+
+    exported = []
+    connection.close() # the workers must not share our connection
+    pool = multiprocessing.Pool(processes)
+    try:
+        for pg, error in pool.imap_unordered(export_page, jobs):
+            if error:
+                print('Failed: ', pg, error)
+            else:
+                print('Exported: ', pg)
+                exported.append(pg)
+    finally:
+        pool.terminate()
+        pool.join()
+
+        # figures may have been built along the way, so sign afresh
+        signatures = export_signatures(pdf)
+        for pg in exported:
+            manifest[pg] = signatures[pg]
+        write_file(manifest_path, json.dumps(manifest, indent=1, sort_keys=True))
+
+    media_url = WIKI_IMAGE_URL.replace('//', '/').lstrip('/')
+    sync_tree(wiki_image_path, os.path.join(dest, media_url), skip=[SYSGEN_REFS_FOLDER])
+    static_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    sync_tree(static_path, os.path.join(dest, settings.STATIC_URL.lstrip('/')))
+
+    return exported
+
+## -------------------------------------------------------------------------- ##
+
+from config import wiki_warm_state_path
+
+# After a deploy or a rebuild the caches are cold, and the first readers of
+# each page wait for it to be rendered and its figures built. warm() does
+# that ahead of them: the busiest pages first (views count each page's
+# views in the cache), then the rest. Its progress is saved as it goes, so
+# an interrupted run picks up where it stopped.
+#
+# Pages are warmed in worker processes, so only a cache the processes share
+# (memcached, a database, files) keeps what they render. With a cache of
+# the process's own (LocMemCache), or none (DummyCache), only figures and
+# PDFs are kept, and the views counted aren't there to order pages by.
+
+PROCESS_LOCAL_CACHES = [
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+]
+
+
+def shared_cache():
+    backend = getattr(settings, 'CACHES', {}).get('default', {}).get('BACKEND', '')
+    return backend not in PROCESS_LOCAL_CACHES
+
+
+def warm_page(job):
+    '''
+    Renders one page through ``show`` (filling the caches as a reader
+    would), builds whatever figures that left missing, and maybe its PDF.
+    Runs in a worker process; returns the pg, an error message, if any,
+    and the seconds it took.
+    '''
+    import views
+    from templatetags.docutils_extensions import blobstore
+    from templatetags.docutils_extensions import governor
+    from templatetags.docutils_extensions.utils import rst2html
+
+    pg, names, pdf = job
+    start = time.time()
+    try:
+        with governor.patient(): # wait for slots rather than give up
+            request = RequestFactory().get(reverse('wiki_show', args=[pg]))
+            request.user = AnonymousUser()
+            request.wiki_internal = True # not a reader's view
+            views.show(request, pg)
+
+            page = Page.objects.get(pg=pg)
+            if not all(blobstore.fetch(sysgen.blob_name(name), sysgen.sysgen_path(name)) for name in names):
+                rst2html(page.content) # builds them
+            if pdf and not os.path.exists(views.page_pdf(page)):
+                raise IOError('No PDF')
+    except Exception as e:
+        return pg, '{}: {}'.format(type(e).__name__, e), time.time() - start
+    return pg, None, time.time() - start
+
+
+def warm(order='hits', pdf=False, processes=None, resume=True):
+    '''
+    Designed to be run from shell.
+    Warms every page (see above) with a pool of ``processes`` (by default
+    one per CPU; heavy work is also bounded by the governor's slots).
+    ``order`` is 'hits' (the most viewed first) or 'pg'. Pages warmed by an
+    interrupted run are skipped, unless not ``resume``. Returns the pgs of
+    the pages that failed.
+    '''
+    import views
+
+    if not shared_cache():
+        print('Warning: the cache is not shared between processes, so only figures and PDFs will be warmed'
+              ' (and pages taken in pg order)')
+        if order == 'hits':
+            order = 'pg'
+
+    pgs = list(Page.objects.values_list('pg', flat=True))
+    if order == 'hits':
+        keys = dict((pg, views.hits_key(pg)) for pg in pgs)
+        hits = cache.get_many(keys.values())
+        pgs.sort(key=lambda pg: (-hits.get(keys[pg], 0), pg))
+    elif order == 'pg':
+        pgs.sort()
+    else:
+        raise ValueError('Unknown order: {}'.format(order))
+
+    state = {'pdf': pdf, 'done': []}
+    if resume and os.path.exists(wiki_warm_state_path):
+        f = open(wiki_warm_state_path)
+        saved = json.load(f)
+        f.close()
+        if saved.get('pdf') == pdf:
+            state = saved
+    done = set(state['done'])
+
+    refs = sysgen.load_refs()
+    jobs = [(pg, refs.get(pg, []), pdf) for pg in pgs if pg not in done]
+    print('Warming {} of {} pages'.format(len(jobs), len(pgs)))
+
+    failed = []
+    connection.close() # the workers must not share our connection
+    pool = multiprocessing.Pool(processes)
+    try:
+        for n, (pg, error, seconds) in enumerate(pool.imap_unordered(warm_page, jobs)):
+            if error:
+                print('[{}/{}] Failed: '.format(n + 1, len(jobs)), pg, error)
+                failed.append(pg)
+                continue
+            print('[{}/{}] Warmed: '.format(n + 1, len(jobs)), pg, '({:.1f}s)'.format(seconds))
+            state['done'].append(pg)
+            write_file(wiki_warm_state_path, json.dumps(state))
+    finally:
+        pool.terminate()
+        pool.join()
+
+    if not failed and os.path.exists(wiki_warm_state_path): # all done
+        os.remove(wiki_warm_state_path)
+    return failed
+
+## -------------------------------------------------------------------------- ##
+
+def book(pg, outfile, series=False):
+    '''
+    Designed to be run from shell.
+    Writes one PDF for a page and everything below it (or for its series).
+    '''
+    from views import book_pdf
+
+    page = Page.objects.get(pg=pg)
+    shutil.copyfile(book_pdf(page, series=series), outfile)
@@ -2,26 +2,54 @@ from __future__ import division
 from __future__ import unicode_literals
 
 import codecs
+import hashlib
+import json
 import os
+import time
 from datetime import datetime
 
 from django.contrib.auth import logout as logout
 from django.contrib.auth.decorators import login_required
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.http import Http404
 from django.http import HttpResponse
+from django.http import HttpResponseForbidden
+from django.http import HttpResponseNotModified
 from django.shortcuts import redirect
 from django.template import RequestContext, Context, loader
 from django.template.defaultfilters import slugify
+from django.utils.cache import patch_cache_control
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
+from django.utils.http import parse_etags
+from django.utils.http import parse_http_date_safe
+from django.utils.http import quote_etag
+from django.utils.safestring import mark_safe
 
 from config import wiki_pages_path
+from config import wiki_cache_max_age
+from config import wiki_tree_version_timeout
+from config import wiki_preview_budget
+from config import wiki_response_cache_timeout
+from config import wiki_hits_timeout
 
 from utils import render_to_response
+from templatetags.docutils_extensions.config import MATH_OUTPUT
+from templatetags.docutils_extensions.utils import cached_pdf
 from templatetags.docutils_extensions.utils import make_pdf
 from templatetags.docutils_extensions.utils import rst2latex
+from templatetags.docutils_extensions.sections import rst2html_preview
+from templatetags.docutils_extensions import governor
+from templatetags.docutils_extensions import problems
+from templatetags.docutils_extensions import variants
+from templatetags.docutils_extensions.profiling import record
 
 from models import *
 
+import compress
+import drafts
+
 
 def wiki_logout(request):
     logout(request)
@@ -31,6 +59,116 @@ def wiki_logout(request):
         return redirect('wiki_root')
 
 
+def viewer_role(request):
+    if request.user.is_staff:
+        return 'staff'
+    elif request.user.is_authenticated():
+        return 'user'
+    else:
+        return 'anonymous'
+
+
+def page_validators(request, page):
+    '''
+    Returns the ETag and Last-Modified timestamp of a page view. Neither
+    needs any rendering: a view only changes with the page's content, its
+    navigation (see tree versions), the problem bank (if the page uses it)
+    and who is looking at it.
+    '''
+    nav_version = page.nav_version
+    content_hash = hashlib.md5(page.raw_content.encode('utf-8')).hexdigest()
+    bank_version = problems.version(page.raw_content)
+    validator = '|'.join([content_hash, repr(nav_version), repr(bank_version), viewer_role(request), MATH_OUTPUT])
+    etag = hashlib.md5(validator.encode('utf-8')).hexdigest()
+
+    last_modified = time.mktime(page.update_date.timetuple())
+    last_modified = int(max([last_modified] + nav_version))
+    return etag, last_modified
+
+
+def page_nav(page):
+    '''
+    Returns the page's navigation: {'html': ..., 'book': ...}. It only
+    changes with the tree around the page, so it is rendered once per tree
+    version and cached.
+    '''
+    version = '|'.join([page.pg, repr(page.nav_version)])
+    key = 'wiki-nav:{}'.format(hashlib.md5(version.encode('utf-8')).hexdigest())
+    nav = cache.get(key)
+    if nav is None:
+        nav = {
+            'html' : loader.render_to_string('wiki/nav.html', {'page': page}).strip(),
+            'book' : bool(page.children or page.series),
+        }
+        cache.set(key, nav, wiki_tree_version_timeout)
+    nav['html'] = mark_safe(nav['html'])
+    return nav
+
+
+def not_modified(request, etag, last_modified):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = [e.rsplit('-', 1)[0] if e.endswith(('-gzip', '-br')) else e
+                 for e in parse_etags(if_none_match)]
+        return etag in etags or '*' in etags
+
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since:
+        if_modified_since = parse_http_date_safe(if_modified_since)
+        return if_modified_since is not None and last_modified <= if_modified_since
+
+    return False
+
+
+def busy(request, page, saturated):
+    '''
+    The response when the host is too busy building what the request needs
+    (see governor.py): 503, with a page that tries again by itself.
+    '''
+    template = 'wiki/busy.html'
+    context = {
+        'page' : page,
+        'retry_after' : saturated.retry_after,
+    }
+    response = render_to_response(request, template, context)
+    response.status_code = 503
+    response['Retry-After'] = str(saturated.retry_after)
+    patch_cache_control(response, no_cache=True, max_age=0)
+    return response
+
+
+def pdf_error(request, page):
+    '''
+    The response when a page's (or book's) PDF couldn't be compiled.
+    '''
+    template = 'wiki/pdf_error.html'
+    context = {
+        'page' : page,
+    }
+    response = render_to_response(request, template, context)
+    response.status_code = 500
+    patch_cache_control(response, no_cache=True, max_age=0)
+    return response
+
+
+def hits_key(pg):
+    return 'wiki-hits:{}'.format(hashlib.md5(pg.encode('utf-8')).hexdigest())
+
+
+def count_hit(pg):
+    '''
+    Counts a view of the page (see utils.warm).
+    '''
+    key = hits_key(pg)
+    try:
+        try:
+            cache.incr(key)
+        except ValueError: # the first in a while
+            cache.add(key, 1, wiki_hits_timeout)
+    except Exception: # a count isn't worth failing the page for
+        pass
+
+
 def show(request, pg='/'):            
     try:        
         page = Page.objects.get(pg=pg)
@@ -42,10 +180,63 @@ def show(request, pg='/'):
         else:
             template = 'wiki/404.html'
 
+    if template == 'wiki/show.html' and not getattr(request, 'wiki_internal', False): # e.g. warm(), export()
+        count_hit(pg)
+
     context = {
         'page' : page,
     }
-    return render_to_response(request, template, context)
+
+    etag, last_modified = page_validators(request, page)
+    encoding = compress.negotiate(request.META.get('HTTP_ACCEPT_ENCODING', ''), compress.encodings())
+    if getattr(request, 'wiki_profile_panel', False): # the panel goes into the HTML
+        encoding = 'identity'
+
+    if not_modified(request, etag, last_modified):
+        response = HttpResponseNotModified()
+    else:
+        try:
+            encoded = page_encodings(request, etag, template, context)
+        except governor.Saturated as e: # figures to build
+            return busy(request, page, e)
+        if encoding != 'identity' and encoding not in encoded: # cached without brotli
+            encoding = 'gzip'
+        response = HttpResponse(compress.decode(encoded, encoding), content_type='text/html; charset=utf-8')
+        response['Content-Length'] = str(len(response.content))
+        if encoding != 'identity':
+            response['Content-Encoding'] = encoding
+
+    # each encoding is a representation of its own
+    response['ETag'] = quote_etag(etag if encoding == 'identity' else '{}-{}'.format(etag, encoding))
+    response['Last-Modified'] = http_date(last_modified)
+    if viewer_role(request) == 'anonymous':
+        patch_cache_control(response, public=True, max_age=wiki_cache_max_age)
+    else:
+        patch_cache_control(response, private=True, max_age=0)
+    patch_vary_headers(response, ['Cookie', 'Accept-Encoding'])
+
+    return response
+
+
+def page_encodings(request, etag, template, context):
+    '''
+    Returns the page view compressed in every encoding we offer (see
+    compress.py). It is rendered and compressed once per ETag and cached;
+    later requests are served those bytes as they are.
+    '''
+    key = 'wiki-response:{}'.format(etag)
+    encoded = cache.get(key)
+    if encoded is not None:
+        record('response.cached', 0.0)
+        return encoded
+
+    requests = variants.requests
+    context['nav'] = page_nav(context['page'])
+    html = render_to_response(request, template, context).content.decode('utf-8')
+    encoded = compress.encode(html)
+    if variants.requests == requests: # else its images will soon change
+        cache.set(key, encoded, wiki_response_cache_timeout)
+    return encoded
 
 
 # @login_required(login_url=reverse('wiki_login')) # not sure why this doesn't work....
@@ -53,14 +244,40 @@ def show(request, pg='/'):
 def edit(request, pg='/'):
     try:
         page = Page.objects.get(pg=pg)
+        content = page.raw_content
     except: # we still have to pass 'pg' to the template...
         page = { 'pg': pg }
+        content = ''
+
+    return edit_response(request, page, content)
+
+
+def edit_response(request, page, content, conflict=False, changes=None, status=200):
+    '''
+    The editor, on the user's draft of the page if there is one. The
+    revisions it is given are sent back by autosave and submit (see
+    drafts.py). On a conflict, ``changes`` are those published meanwhile.
+    '''
+    published = drafts.revision(content)
+    draft = drafts.load(request.user, page['pg'] if isinstance(page, dict) else page.pg)
+    draft_saved = None
+    if draft:
+        content = draft['content']
+        draft_saved = drafts.saved_date(draft)
+    content = content.replace('\r\n','\n') # as the editor's buffer has it
 
     template = 'wiki/edit.html'
     context = {
         'page' : page,
+        'content' : content,
+        'published' : published,
+        'draft_saved' : draft_saved,
+        'conflict' : conflict,
+        'changes' : changes,
     }
-    return render_to_response(request, template, context)
+    response = render_to_response(request, template, context)
+    response.status_code = status
+    return response
 
 
 def post(request):
@@ -69,6 +286,7 @@ def post(request):
         pg = pg.replace('//', '/')
         
         if 'cancel' in request.POST:
+            drafts.discard(request.user, pg)
             return redirect('wiki_show', pg)
 
         try:
@@ -79,6 +297,7 @@ def post(request):
             
         if 'delete' in request.POST:
             parent = page.parent
+            drafts.discard(request.user, pg)
             page.delete()
             if parent:
                 return redirect('wiki_show', parent.pg)
@@ -88,13 +307,26 @@ def post(request):
         new_pg = request.POST['new_pg'] + '/'
         new_pg = new_pg.replace('//', '/')
         # new_pg = re.sub('[^\w^\/]+', '', new_pg) # poor man's validation attempt
-        content = request.POST['content']
+
+        if 'draft' in request.POST: # the editor's autosaved draft
+            draft = drafts.load(request.user, pg)
+            if not draft or draft['revision'] != request.POST['draft']:
+                return edit_response(request, page, page.raw_content, conflict=True, status=409)
+            if draft['published'] != drafts.revision(page.raw_content): # published since
+                # they're shown it now, so submitting again replaces it
+                changes = drafts.changes(pg, draft, page.raw_content)
+                drafts.rebase(request.user, pg, drafts.revision(page.raw_content))
+                return edit_response(request, page, page.raw_content, conflict=True, changes=changes, status=409)
+            content = draft['content']
+        else:
+            content = request.POST['content']
         content = content.replace('\r\n','\n')
 
         if 'update' in request.POST or 'submit' in request.POST:
             page.pg = new_pg
             page.raw_content = content
-            page.save()
+            page.save(editor=request.user.username)
+            drafts.discard(request.user, pg)
             if 'update' in request.POST:
                 return redirect('wiki_edit', page.pg)
             else:
@@ -102,14 +334,78 @@ def post(request):
 
     # nothing should ever get here...
     return redirect('wiki_root')
-    
-    
-def ppdf(request, pg=''):
-    try:        
+
+
+def autosave(request):
+    '''
+    Saves the editor's draft of a page (see drafts.py) without touching the
+    page itself. Returns JSON: {'revision': ...}, or a 409 if the patch
+    doesn't fit the draft (the editor then sends the whole buffer).
+    '''
+    if not (request.user.is_staff and request.method == 'POST'):
+        return HttpResponseForbidden()
+
+    pg = request.POST['pg'] + '/'
+    pg = pg.replace('//', '/')
+    published = request.POST['published']
+
+    try:
+        if 'content' in request.POST:
+            draft = drafts.autosave(request.user, pg, published, None,
+                content=request.POST['content'])
+        else:
+            draft = drafts.autosave(request.user, pg, published, request.POST['base'],
+                start=int(request.POST['start']),
+                end=int(request.POST['end']),
+                text=request.POST['text'])
+    except (drafts.Conflict, ValueError) as e:
+        result = {'error' : unicode(e)}
+        return HttpResponse(json.dumps(result), mimetype='application/json', status=409)
+
+    result = {
+        'revision' : draft['revision'],
+        'saved' : draft['saved'],
+    }
+    return HttpResponse(json.dumps(result), mimetype='application/json')
+
+
+def preview(request):
+    '''
+    Renders the editor's buffer without saving it, for the live preview.
+    Returns JSON: {'parts': [html, ...], 'pending': n}, where the n parts
+    that didn't fit in the time budget are null (the editor asks again).
+    '''
+    if not (request.user.is_staff and request.method == 'POST'):
+        return HttpResponseForbidden()
+
+    pg = request.POST['pg'] + '/'
+    pg = pg.replace('//', '/')
+    content = request.POST['content']
+    content = content.replace('\r\n','\n')
+
+    try:
         page = Page.objects.get(pg=pg)
     except:
-        return redirect('wiki_show', pg)
+        page = Page(pg=pg)
+        if pg != '/': # for sibling wiki-links, as in Page.save()
+            dirs = pg.split('/')
+            try:
+                page.parent = Page.objects.get(pg='/'.join(dirs[:-2] + dirs[:1]))
+            except:
+                pass
+    page.raw_content = content
 
+    start = time.time()
+    parts = rst2html_preview(page.content, wiki_preview_budget)
+    result = {
+        'parts' : parts,
+        'pending' : parts.count(None),
+        'elapsed' : round(time.time() - start, 3),
+    }
+    return HttpResponse(json.dumps(result), mimetype='application/json')
+    
+    
+def page_pdf(page):
     context = {
         'page' : page,
     }
@@ -119,10 +415,81 @@ def ppdf(request, pg=''):
     t = loader.get_template(template)
     latex = t.render(c)
 
-    pdfname = make_pdf(latex, repeat=2)
+    return make_pdf(latex, repeat=2, date=page.update_date)
+
+
+def ppdf(request, pg=''):
+    try:        
+        page = Page.objects.get(pg=pg)
+    except:
+        return redirect('wiki_show', pg)
+
+    try:
+        pdfname = page_pdf(page)
+    except governor.Saturated as e:
+        return busy(request, page, e)
+    if not os.path.exists(pdfname):
+        return pdf_error(request, page)
     pdffile = open(pdfname, 'rb')
     outfile = '%s.pdf' % slugify(page.title)
     response = HttpResponse(pdffile.read(), mimetype='application/pdf')
     # response['Content-disposition'] = 'attachment; filename=%s' % outfile
 
     return response
+
+
+def book_pdf(page, series=False):
+    '''
+    One PDF for a page and everything below it (or for its whole series),
+    each page a chapter, with one table of contents and one index. It is
+    kept under the combined hash of the pages, so an unchanged book is
+    never even rendered again.
+    '''
+    if series:
+        pages = page.series or [page]
+    else:
+        pages = [page] + list(page.descendants)
+
+    book_hash = hashlib.md5()
+    book_hash.update((('series:' if series else 'tree:') + page.pg).encode('utf-8'))
+    for p in pages:
+        book_hash.update(p.pg.encode('utf-8'))
+        book_hash.update(hashlib.md5(p.raw_content.encode('utf-8')).digest())
+        book_hash.update(repr(problems.version(p.raw_content)).encode('utf-8'))
+    name = 'book-{}'.format(book_hash.hexdigest())
+
+    pdfname = cached_pdf(name)
+    if not pdfname:
+        update_date = max(p.update_date for p in pages)
+        context = {
+            'book' : page,
+            'pages' : pages,
+            'update_date' : update_date,
+        }
+        template = 'wiki/pbook.tex'
+
+        c = Context(context,autoescape=False)
+        t = loader.get_template(template)
+        latex = t.render(c)
+
+        pdfname = make_pdf(latex, repeat=2, name=name, date=update_date)
+    return pdfname
+
+
+def pbook(request, pg=''):
+    try:
+        page = Page.objects.get(pg=pg)
+    except:
+        return redirect('wiki_show', pg)
+
+    series = 'series' in request.GET or (not page.children and page.series)
+    try:
+        pdfname = book_pdf(page, series=series)
+    except governor.Saturated as e:
+        return busy(request, page, e)
+    if not os.path.exists(pdfname):
+        return pdf_error(request, page)
+    pdffile = open(pdfname, 'rb')
+    response = HttpResponse(pdffile.read(), mimetype='application/pdf')
+
+    return response